@@ -0,0 +1,804 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from termcolor import colored
+from protocol import (FrameReader, encode_frame, parse_reply, REPLY, MESSAGE, CREATE, LOGIN, LIST, SEND,
+                      FILTER, ACKNOWLEDGE, CREATED, LOGGED_IN, SENT, QUEUED, ACCOUNTS)
+from server import Server
+from event_server import EventServer
+
+# Frontends that can be benchmarked, and the workloads run against each.
+# mix: logged-in users issuing a weighted mix of requests for a fixed time.
+# backlog: messages queued for offline users, who then log in and drain them.
+# storm: every user logs in at the same moment, each with a few pending messages.
+FRONTENDS = ("socket", "grpc")
+SCENARIOS = ("mix", "backlog", "storm")
+
+# Request mix of the mix scenario, as relative weights per opcode.
+DEFAULT_MIX = "s=70,u=10,f=10,l=5,c=5"
+
+# Statuses that count as success for each operation; anything else is an error.
+SUCCESS = {
+    CREATE: {CREATED},
+    LOGIN: {LOGGED_IN},
+    SEND: {SENT, QUEUED},
+    LIST: {ACCOUNTS},
+    FILTER: {ACCOUNTS},
+}
+
+# Throughput and latency figures compared against a baseline (True if higher is better).
+COMPARED = (("requests_per_sec", True), ("messages_per_sec", True), ("delivered_per_sec", True),
+            ("latency.p99_ms", False))
+
+# Messages received before a simulated gRPC user acknowledges them.
+ACK_BATCH = 64
+
+GRPC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "grpcApp")
+
+
+def load_grpc():
+    """Import grpc and the generated chatapp modules (grpcio is only needed for the gRPC frontend)."""
+
+    if GRPC_DIR not in sys.path:
+        sys.path.append(GRPC_DIR)
+    import grpc
+    import chatapp_pb2
+    import chatapp_pb2_grpc
+    return grpc, chatapp_pb2, chatapp_pb2_grpc
+
+
+def parse_mix(text):
+    """Turn "s=70,u=10" into {opcode: weight}, rejecting unknown opcodes."""
+
+    mix = {}
+    for part in text.split(','):
+        op_code, sep, weight = part.strip().partition('=')
+        if not sep or op_code not in SUCCESS:
+            raise ValueError(f"Invalid mix entry {part!r}, expected <op>=<weight> with op one of {''.join(SUCCESS)}")
+        mix[op_code] = float(weight)
+    if not any(mix.values()):
+        raise ValueError("The mix needs at least one operation with a positive weight")
+    return mix
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of sorted samples (None if there are none)."""
+
+    if not samples:
+        return None
+    rank = max(1, min(len(samples), int(fraction * len(samples) + 0.999999)))
+    return samples[rank - 1]
+
+
+def summarize(latencies_ns, errors=0):
+    """Count, errors and p50/p99/p999/max latency in milliseconds of a list of samples."""
+
+    samples = sorted(latencies_ns)
+    summary = {"count": len(samples), "errors": errors}
+    for name, fraction in (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999), ("max_ms", 1.0)):
+        value = percentile(samples, fraction)
+        summary[name] = None if value is None else round(value / 1e6, 3)
+    return summary
+
+
+class Recorder():
+    """Latencies and failures of one load-generating thread, per operation."""
+
+    def __init__(self):
+        # A dictionary with operation names as keys and lists of latencies (ns) as values.
+        self.latencies = {}
+
+        # A dictionary with operation names as keys and failure counts as values.
+        self.errors = {}
+
+    def time(self, name, call, success=None):
+        """Run `call`, recording its latency under `name`; returns its result (None if it raised).
+
+        A result outside `success` (when given) counts as an error.
+        """
+
+        start = time.perf_counter_ns()
+        try:
+            result = call()
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        self.latencies.setdefault(name, []).append(time.perf_counter_ns() - start)
+        if success is not None and result not in success:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return result
+
+    def count(self, name):
+        """Calls recorded under `name` that succeeded."""
+
+        return len(self.latencies.get(name, ())) - self.errors.get(name, 0)
+
+
+def merge(recorders):
+    """Combine the recorders of every thread into one."""
+
+    total = Recorder()
+    for recorder in recorders:
+        for name, samples in recorder.latencies.items():
+            total.latencies.setdefault(name, []).extend(samples)
+        for name, errors in recorder.errors.items():
+            total.errors[name] = total.errors.get(name, 0) + errors
+    return total
+
+
+class ProcessMonitor():
+    """CPU time and resident memory of the server process while a workload runs.
+
+    Reads /proc, so on systems without it the figures are None.
+    """
+
+    def __init__(self, pid, interval=0.1):
+        # The process being measured.
+        self.pid = pid
+
+        # Seconds between memory samples.
+        self.interval = interval
+
+        # Largest resident set seen since start(), in bytes.
+        self.peak_rss = 0
+
+        # Stops the sampling thread.
+        self.done = threading.Event()
+
+    def cpu_seconds(self):
+        """User plus system CPU time of the process (None if /proc is unavailable)."""
+
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        """Resident set size of the process in bytes (None if /proc is unavailable)."""
+
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss() or 0)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.server_cpu = self.cpu_seconds()
+        self.client_cpu = self.own_cpu_seconds()
+        self.peak_rss = self.rss() or 0
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        """Figures since start(): {"server": {...}, "load_generator": {...}}."""
+
+        elapsed = time.perf_counter() - self.started
+        self.done.set()
+        self.sampler.join()
+        rss = self.rss()
+        server_cpu = self.cpu_seconds()
+        client_cpu = self.own_cpu_seconds() - self.client_cpu
+        server = {"cpu_seconds": None, "cpu_percent": None, "rss_mb": None, "peak_rss_mb": None}
+        if server_cpu is not None and self.server_cpu is not None:
+            server["cpu_seconds"] = round(server_cpu - self.server_cpu, 3)
+            server["cpu_percent"] = round(100 * (server_cpu - self.server_cpu) / elapsed, 1)
+        if rss is not None:
+            server["rss_mb"] = round(rss / 2 ** 20, 1)
+            server["peak_rss_mb"] = round(max(self.peak_rss, rss) / 2 ** 20, 1)
+        return {"server": server,
+                "load_generator": {"cpu_seconds": round(client_cpu, 3),
+                                   "cpu_percent": round(100 * client_cpu / elapsed, 1)}}
+
+    @staticmethod
+    def own_cpu_seconds():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+
+class SocketUser():
+    """A simulated user on its own connection to a socket server.
+
+    Pushed messages are counted as they arrive with replies, and acknowledged once per
+    reply like client.py does.
+    """
+
+    def __init__(self, port):
+        self.connection = socket.create_connection(("localhost", port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader(self.connection)
+
+        # Distinct messages received, and the newest id received and acknowledged.
+        self.received = 0
+        self.last_message_id = 0
+        self.acked_message_id = 0
+
+    def request(self, op_code, *fields):
+        """Send one request and return its Reply, counting messages pushed meanwhile."""
+
+        self.connection.sendall(encode_frame(op_code, *fields))
+        while True:
+            frame = self.reader.read_frame()
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            if frame[0] == MESSAGE:
+                self.on_message(frame[1][0])
+            elif frame[0] == REPLY:
+                self.acknowledge()
+                return parse_reply(frame[1])
+
+    def on_message(self, msg_id):
+        if msg_id > self.last_message_id:
+            self.last_message_id = msg_id
+            self.received += 1
+
+    def acknowledge(self):
+        if self.last_message_id > self.acked_message_id:
+            self.connection.sendall(encode_frame(ACKNOWLEDGE, self.last_message_id))
+            self.acked_message_id = self.last_message_id
+
+    def create(self, username):
+        return self.request(CREATE, username).status
+
+    def login(self, username):
+        return self.request(LOGIN, username).status
+
+    def send(self, recipient, text):
+        return self.request(SEND, recipient, text).status
+
+    def list(self):
+        return self.request(LIST, "100", "").status
+
+    def filter(self, pattern):
+        return self.request(FILTER, pattern).status
+
+    def wait_for(self, count, timeout):
+        """Read pushed messages until `count` have arrived in total; False on timeout."""
+
+        deadline = time.monotonic() + timeout
+        try:
+            while self.received < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.connection.settimeout(remaining)
+                frame = self.reader.read_frame()
+                if frame is None:
+                    return False
+                if frame[0] == MESSAGE:
+                    self.on_message(frame[1][0])
+        except socket.timeout:
+            return False
+        finally:
+            self.connection.settimeout(None)
+            self.acknowledge()
+        return True
+
+    def close(self):
+        self.connection.close()
+
+
+class GrpcUser():
+    """A simulated user on its own channel to a gRPC server.
+
+    Logging in opens the message stream, read by a thread that acknowledges every
+    ACK_BATCH messages; closing the channel ends the session.
+    """
+
+    def __init__(self, port):
+        self.grpc, self.app, rpc = load_grpc()
+        self.channel = self.grpc.insecure_channel(f"localhost:{port}")
+        self.stub = rpc.ChatAppStub(self.channel)
+        self.username = None
+
+        # The open listenForMessages call, once logged in.
+        self.stream = None
+
+        # Distinct messages received, and the newest id received and acknowledged.
+        self.received = 0
+        self.last_message_id = 0
+        self.acked_message_id = 0
+
+        # Notified by the stream thread whenever a message arrives.
+        self.arrived = threading.Condition()
+
+    def create(self, username):
+        return self.stub.createAccount(self.app.Account(username=username)).status
+
+    def login(self, username):
+        reply = self.stub.logIn(self.app.Account(username=username))
+        if reply.status == self.app.LOGGED_IN:
+            self.username = username
+            self.stream = self.stub.listenForMessages(self.app.ListenRequest(username=username))
+            threading.Thread(target=self.listen, args=(self.stream,), daemon=True).start()
+        return reply.status
+
+    def listen(self, stream):
+        try:
+            for msg in stream:
+                with self.arrived:
+                    if msg.id > self.last_message_id:
+                        self.last_message_id = msg.id
+                        self.received += 1
+                    self.arrived.notify_all()
+                if self.last_message_id - self.acked_message_id >= ACK_BATCH:
+                    self.acknowledge()
+        except self.grpc.RpcError:
+            pass
+
+    def acknowledge(self):
+        msg_id = self.last_message_id
+        if msg_id > self.acked_message_id:
+            self.acked_message_id = msg_id
+            self.stub.acknowledge(self.app.Acknowledgement(username=self.username, message_id=msg_id))
+
+    def send(self, recipient, text):
+        return self.stub.sendMessage(self.app.Message(senderName=self.username, recipientName=recipient,
+                                                      message=text)).status
+
+    def list(self):
+        """Fetch the first page of the listing, like the socket frontend's single page."""
+
+        pages = self.stub.listAccounts(self.app.ListRequest(page_size=100))
+        next(pages)
+        pages.cancel()
+        return ACCOUNTS
+
+    def filter(self, pattern):
+        return self.stub.filterAccounts(self.app.FilterString(filter=pattern)).status
+
+    def wait_for(self, count, timeout):
+        """Wait until `count` messages have arrived in total; False on timeout."""
+
+        with self.arrived:
+            done = self.arrived.wait_for(lambda: self.received >= count, timeout)
+        self.acknowledge()
+        return done
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.cancel()
+        self.channel.close()
+
+
+def run_threads(count, target):
+    """Run target(i) on `count` threads released together; returns the seconds they took."""
+
+    barrier = threading.Barrier(count + 1)
+
+    def run(i):
+        barrier.wait()
+        target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def run_mix(connect, args, monitor):
+    """`users` logged-in users issue the weighted request mix for `duration` seconds.
+
+    Creations and logins run on short-lived side sessions, since a logged-in session
+    can do neither. Each login takes an account the thread created and never logged in
+    to, so a session still closing on the server cannot turn it away.
+    """
+
+    mix = parse_mix(args.mix)
+    users = [f"u{i}" for i in range(args.users)]
+    setup = connect()
+    for username in users:
+        setup.create(username)
+    setup.close()
+
+    sessions = [connect() for _ in users]
+    for session, username in zip(sessions, users):
+        session.login(username)
+    recorders = [Recorder() for _ in users]
+    text = "x" * args.message_size
+    ops, weights = list(mix), list(mix.values())
+
+    def side_session(call):
+        side = connect()
+        try:
+            return call(side)
+        finally:
+            side.close()
+
+    def work(i):
+        rng = random.Random(args.seed * 1000 + i)
+        session, recorder = sessions[i], recorders[i]
+        serial = 0
+
+        # Accounts this thread created and has not logged in to yet.
+        unused = []
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            op_code = rng.choices(ops, weights)[0]
+            if op_code == SEND:
+                recipient = users[rng.randrange(len(users))]
+                recorder.time(SEND, lambda: session.send(recipient, text), SUCCESS[SEND])
+            elif op_code == LIST:
+                recorder.time(LIST, session.list, SUCCESS[LIST])
+            elif op_code == FILTER:
+                recorder.time(FILTER, lambda: session.filter(f"u{rng.randrange(10)}.*"), SUCCESS[FILTER])
+            elif op_code == CREATE:
+                username = f"c{i}x{serial}"
+                serial += 1
+                if side_session(lambda side: recorder.time(CREATE, lambda: side.create(username),
+                                                           SUCCESS[CREATE])) == CREATED:
+                    unused.append(username)
+            elif op_code == LOGIN:
+                if not unused:
+                    unused.append(f"c{i}x{serial}")
+                    serial += 1
+                    side_session(lambda side: side.create(unused[-1]))
+                username = unused.pop()
+                side_session(lambda side: recorder.time(LOGIN, lambda: side.login(username), SUCCESS[LOGIN]))
+
+    monitor.start()
+    elapsed = run_threads(len(users), work)
+    total = merge(recorders)
+
+    # Let the last messages reach their (online) recipients before counting them.
+    sent = total.count(SEND)
+    deadline = time.monotonic() + 2
+    for session in sessions:
+        session.wait_for(session.received + 1, max(0.0, deadline - time.monotonic()))
+    delivered = sum(session.received for session in sessions)
+    figures = monitor.stop()
+    for session in sessions:
+        session.close()
+
+    requests = sum(len(samples) for samples in total.latencies.values())
+    return report(total, elapsed, figures, requests_per_sec=requests / elapsed,
+                  messages_per_sec=sent / elapsed, delivered_per_sec=delivered / elapsed)
+
+
+def run_backlog(connect, args, monitor):
+    """`users` senders queue `backlog` messages for each of `recipients` offline users,
+    who then log in together and drain their queues."""
+
+    recipients = [f"r{i}" for i in range(args.recipients)]
+    senders = [f"w{i}" for i in range(args.users)]
+    setup = connect()
+    for username in recipients + senders:
+        setup.create(username)
+    setup.close()
+
+    sessions = [connect() for _ in senders]
+    for session, username in zip(sessions, senders):
+        session.login(username)
+    recorders = [Recorder() for _ in senders]
+    text = "x" * args.message_size
+    total_messages = args.recipients * args.backlog
+
+    def enqueue(i):
+        for n in range(i, total_messages, len(senders)):
+            recipient = recipients[n % len(recipients)]
+            recorders[i].time(SEND, lambda: sessions[i].send(recipient, text), SUCCESS[SEND])
+
+    monitor.start()
+    enqueue_elapsed = run_threads(len(senders), enqueue)
+    for session in sessions:
+        session.close()
+
+    readers = [connect() for _ in recipients]
+    drain_recorders = [Recorder() for _ in recipients]
+
+    def drain(i):
+        reader, recorder = readers[i], drain_recorders[i]
+        start = time.perf_counter_ns()
+        if recorder.time(LOGIN, lambda: reader.login(recipients[i]), SUCCESS[LOGIN]) is None:
+            return
+        if reader.wait_for(args.backlog, args.timeout):
+            recorder.latencies.setdefault("drain", []).append(time.perf_counter_ns() - start)
+        else:
+            recorder.errors["drain"] = recorder.errors.get("drain", 0) + 1
+
+    drain_elapsed = run_threads(len(recipients), drain)
+    delivered = sum(reader.received for reader in readers)
+    figures = monitor.stop()
+    for reader in readers:
+        reader.close()
+
+    total = merge(recorders + drain_recorders)
+    sent = total.count(SEND)
+    return report(total, enqueue_elapsed + drain_elapsed, figures, requests_per_sec=sent / enqueue_elapsed,
+                  messages_per_sec=sent / enqueue_elapsed, delivered_per_sec=delivered / drain_elapsed)
+
+
+def run_storm(connect, args, monitor):
+    """`users` users, each with `pending` queued messages, log in at the same moment."""
+
+    users = [f"s{i}" for i in range(args.users)]
+    setup = connect()
+    setup.create("sender")
+    for username in users:
+        setup.create(username)
+    setup.login("sender")
+    for username in users:
+        for n in range(args.pending):
+            setup.send(username, f"pending {n}")
+    setup.close()
+
+    sessions = [connect() for _ in users]
+    recorders = [Recorder() for _ in users]
+
+    def login(i):
+        session, recorder = sessions[i], recorders[i]
+        start = time.perf_counter_ns()
+        if recorder.time(LOGIN, lambda: session.login(users[i]), SUCCESS[LOGIN]) is None:
+            return
+        if session.wait_for(args.pending, args.timeout):
+            recorder.latencies.setdefault("drain", []).append(time.perf_counter_ns() - start)
+        else:
+            recorder.errors["drain"] = recorder.errors.get("drain", 0) + 1
+
+    monitor.start()
+    elapsed = run_threads(len(users), login)
+    delivered = sum(session.received for session in sessions)
+    figures = monitor.stop()
+    for session in sessions:
+        session.close()
+
+    total = merge(recorders)
+    return report(total, elapsed, figures, requests_per_sec=total.count(LOGIN) / elapsed,
+                  messages_per_sec=0.0, delivered_per_sec=delivered / elapsed)
+
+
+# Workload functions by scenario name.
+WORKLOADS = {"mix": run_mix, "backlog": run_backlog, "storm": run_storm}
+
+
+def report(total, elapsed, figures, **rates):
+    """The result of one workload: per-operation and overall latency, rates and resource use."""
+
+    result = {"elapsed_s": round(elapsed, 3)}
+    result.update({name: round(rate, 1) for name, rate in rates.items()})
+    everything = [sample for name, samples in total.latencies.items() if name != "drain" for sample in samples]
+    result["latency"] = summarize(everything, sum(errors for name, errors in total.errors.items()
+                                                  if name != "drain"))
+    names = set(total.latencies) | set(total.errors)
+    result["operations"] = {name: summarize(total.latencies.get(name, []), total.errors.get(name, 0))
+                            for name in sorted(names)}
+    result.update(figures)
+    return result
+
+
+def serve_frontend(frontend, port, stop_event, workdir, options):
+    """Child process running one frontend in `workdir` until `stop_event` is set."""
+
+    os.chdir(workdir)
+    if not options["server_output"]:
+        sys.stdout = open(os.devnull, "w")
+    if frontend == "socket":
+        server_class = EventServer if options["socket_server"] == "event" else Server
+        server_class("localhost", port, stop_event, durability=options["durability"],
+                     storage=options["storage"])
+    else:
+        asyncio.run(serve_chatapp(port, stop_event, options["storage"]))
+
+
+async def serve_chatapp(port, stop_event, storage):
+    """Serve grpcApp's ChatApp on `port` until `stop_event` is set."""
+
+    grpc, _, rpc = load_grpc()
+    spec = importlib.util.spec_from_file_location("chatapp_server", os.path.join(GRPC_DIR, "server.py"))
+    chatapp_server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(chatapp_server)
+
+    server = grpc.aio.server()
+    rpc.add_ChatAppServicer_to_server(chatapp_server.ChatApp(storage=storage, path="chatapp.db"), server)
+    server.add_insecure_port(f"localhost:{port}")
+    await server.start()
+    while not stop_event.is_set():
+        await asyncio.sleep(0.1)
+    await server.stop(0)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    """Wait until the server accepts connections; raises if it exits or takes too long."""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError(f"Server exited with code {process.exitcode} before listening")
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not listen on port {port} within {timeout}s")
+
+
+def benchmark(frontend, scenario, args):
+    """Run one workload against a fresh server of one frontend and return its result."""
+
+    options = {"socket_server": args.socket_server, "durability": args.durability,
+               "storage": args.storage, "server_output": args.server_output}
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        stop_event = context.Event()
+        process = context.Process(target=serve_frontend, args=(frontend, port, stop_event, workdir, options),
+                                  daemon=True)
+        process.start()
+        try:
+            wait_for_port(port, process)
+            user_class = SocketUser if frontend == "socket" else GrpcUser
+            result = WORKLOADS[scenario](lambda: user_class(port), args, ProcessMonitor(process.pid))
+        finally:
+            stop_event.set()
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+    return {"frontend": frontend, "scenario": scenario, **result}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def metric(result, name):
+    """A figure of a result by dotted name, such as "latency.p99_ms"."""
+
+    value = result
+    for key in name.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results, baseline, tolerance):
+    """Figures of `results` that are worse than in `baseline` by more than `tolerance`.
+
+    Returns (frontend, scenario, metric, baseline value, new value) tuples.
+    """
+
+    previous = {(r["frontend"], r["scenario"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["frontend"], result["scenario"]))
+        if old is None:
+            continue
+        for name, higher_is_better in COMPARED:
+            before, after = metric(old, name), metric(result, name)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append((result["frontend"], result["scenario"], name, before, after))
+    return regressions
+
+
+def print_result(result):
+    server = result["server"]
+    print(colored(f"\n{result['frontend']} / {result['scenario']}", "yellow")
+          + f"  {result['elapsed_s']}s, {result['requests_per_sec']} requests/s, "
+          f"{result['messages_per_sec']} messages/s sent, {result['delivered_per_sec']} delivered/s")
+    print(f"server cpu {server['cpu_percent']}% ({server['cpu_seconds']}s), rss {server['rss_mb']} MB "
+          f"(peak {server['peak_rss_mb']} MB); load generator cpu {result['load_generator']['cpu_percent']}%")
+    print(f"{'op':>8} {'count':>8} {'errors':>7} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'max ms':>9}")
+    for name, stats in list(result["operations"].items()) + [("all", result["latency"])]:
+        print(f"{name:>8} {stats['count']:>8} {stats['errors']:>7} " + " ".join(
+            f"{'-' if stats[key] is None else stats[key]:>9}" for key in ("p50_ms", "p99_ms", "p999_ms", "max_ms")))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the socket and gRPC frontends under load.")
+    parser.add_argument("--frontends", default=",".join(FRONTENDS), help="comma separated, from: socket, grpc")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from: mix, backlog, storm")
+    parser.add_argument("--users", type=int, default=32, help="concurrent simulated users (senders for backlog)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds the mix scenario runs")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request weights of the mix scenario")
+    parser.add_argument("--message-size", type=int, default=64, help="bytes per message")
+    parser.add_argument("--recipients", type=int, default=8, help="offline users in the backlog scenario")
+    parser.add_argument("--backlog", type=int, default=500, help="messages queued per offline user")
+    parser.add_argument("--pending", type=int, default=5, help="messages waiting per user in the login storm")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for queued messages to arrive")
+    parser.add_argument("--socket-server", choices=("server", "event"), default="server",
+                        help="server.py (a thread per connection) or event_server.py")
+    parser.add_argument("--durability", choices=("sync", "async", "none"), default="sync",
+                        help="write-ahead log durability of the socket server")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite", help="storage engine")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the request mix")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change beyond which a figure counts as a regression")
+    parser.add_argument("--server-output", action="store_true", help="show the server's own output")
+    args = parser.parse_args(argv)
+
+    args.frontends = [name.strip() for name in args.frontends.split(',') if name.strip()]
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in args.frontends:
+        if name not in FRONTENDS:
+            parser.error(f"unknown frontend {name}")
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if "grpc" in args.frontends:
+        try:
+            load_grpc()
+        except ImportError as e:
+            parser.error(f"the grpc frontend needs grpcio ({e}); pass --frontends socket to skip it")
+    return args
+
+
+def main(argv=None):
+    """Run every requested workload against every requested frontend; returns the exit status."""
+
+    args = parse_args(argv)
+    results = []
+    for frontend in args.frontends:
+        for scenario in args.scenarios:
+            result = benchmark(frontend, scenario, args)
+            print_result(result)
+            results.append(result)
+
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "revision": git_revision(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(),
+                 "args": {key: value for key, value in vars(args).items()
+                          if key not in ("json", "baseline", "server_output")}},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json}\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for frontend, scenario, name, before, after in regressions:
+            print(colored(f"Regression: {frontend} / {scenario} {name} {before} -> {after}", "red"))
+        if regressions:
+            return 1
+        print(colored(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}", "green"))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
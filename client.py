@@ -3,14 +3,58 @@ import sys
 import select
 from termcolor import colored
 import threading, multiprocessing
+import time
+from protocol import (FrameReader, encode_frame, parse_reply, REPLY, MESSAGE, LIST, LOGIN, REDIRECT, FILTER,
+                      HELP, ACKNOWLEDGE, ACCOUNTS, DELETED)
+from rendering import render_reply, render_message, render_help
+from heartbeat import FailureDetector
 
 class Client():
-    def __init__(self, HOST, PORTS, stop_event):
+    def __init__(self, HOST, PORTS, stop_event, heartbeat_interval=0.2, heartbeat_timeout=2,
+                 suspicion_threshold=8):
         self.host = HOST
         self.ports = PORTS
         self.stop_event = stop_event
         self.conns = []
-        self.alive_conns = []
+
+        # A dictionary with connections as keys and their buffered frame readers as values.
+        self.readers = {}
+
+        # A dictionary with connections as keys and the (host, port) they reach as values.
+        self.addresses = {}
+
+        # Pings every replica in the background and reports the ones that seem to have failed.
+        self.detector = FailureDetector(stop_event, heartbeat_interval, heartbeat_timeout, suspicion_threshold)
+
+        # Whether the session must be re-established after failing over to another replica.
+        self.needs_login = False
+
+        # The connection to the replica believed to be the leader.
+        self.curr_conn = None
+
+        # The last login request, repeated after switching to a new leader.
+        self.login_request = None
+
+        # Id of the newest message shown; pushes up to it are repeats and are skipped.
+        self.last_message_id = 0
+
+        # Id of the newest message acknowledged to the server.
+        self.acked_message_id = 0
+
+        # Seconds to wait before retrying while the replicas elect a leader.
+        self.election_wait = 0.05
+
+        # Redirects followed for one batch of requests before giving up.
+        self.max_redirects = 100
+
+        # Requests any replica answers, so they go to the fastest one instead of the leader.
+        self.read_ops = {LIST, FILTER, HELP}
+
+        # A dictionary with connections as keys and their smoothed reply times (seconds) as values.
+        self.latency = {}
+
+        # Weight of the newest sample in the smoothed reply times.
+        self.smoothing = 0.2
 
         # Form a connection to all of the servers on input ports
         for PORT in PORTS:
@@ -18,31 +62,38 @@ class Client():
                 conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 conn.connect((HOST, PORT))
-                self.conns.append(conn)
+                self.add_connection(conn, HOST, PORT)
             except:
                 print(f"Failed to connect to server at port: {PORT}\n")
-        
+        if not self.conns:
+            print(colored("\nCould not connect to any server.\n", "red"))
+            return
+        self.curr_conn = self.conns[0]
+
         # Main loop for clients to receive and send messages to the server.
         while not self.stop_event.is_set():
-            # Find currently active replicas, and arbitrarily choose a "primary".   
-            self.check_alive_conns()
-            self.curr_conn = self.alive_conns[0]
+            # Leave a leader the failure detector suspects before a request has to find out.
+            if self.suspected(self.curr_conn) and not self.fail_over():
+                print(colored("\nLost connection to every server.\n", "red"))
+                return
 
             # List of input streams.
             sockets_list = [sys.stdin, self.curr_conn]
 
-            # Initialize read sockets to process inputs from the server.
-            read_sockets, _, _ = select.select(sockets_list, [], [])
+            # Wake up every heartbeat interval to check the leader's suspicion level.
+            read_sockets, _, _ = select.select(sockets_list, [], [], self.detector.interval)
 
             for socks in read_sockets:
                 # Display messages received from the "primary" server.
                 if socks == self.curr_conn:
-                    # If "primary" crashes, try again with a different server.
+                    # If "primary" closed the connection, move on to a different server.
                     try:
-                        msg = socks.recv(4096)
-                        print(msg.decode('UTF-8'))
-                    except:
-                        continue
+                        alive = self.display_frames(socks)
+                    except OSError:
+                        alive = False
+                    if not alive and not self.drop_connection(socks):
+                        print(colored("\nLost connection to every server.\n", "red"))
+                        return
 
                 # Send requests to all living replicas from the client.
                 else:
@@ -50,37 +101,267 @@ class Client():
 
                     self.send_request(request)
 
-    def send_request(self, request):
-        for conn in self.alive_conns:
-            conn.send(request.encode('UTF-8'))
+    def encode_request(self, request):
+        """Turn a typed command such as s|<recipient>|<message> into a request frame."""
 
-            # Only process a response from the "primary" server.
-            if conn == self.curr_conn:
-                data = conn.recv(4096)
-            
-        print(str(data.decode('UTF-8')))
-    
-    def welcome_msg(self):
-        msg = "\nWelcome to the chat application! Begin by logging in or creating an account. Below, you will find a list of supported commands :\n"
-        msg += "\nCreate an account.        c|<username>"
-        msg += "\nLog into an account.      l|<username>"
-        msg += "\nSend a message.           s|<recipient_username>|<message>"
-        msg += "\nFilter accounts.          f|<filter_regex>"
-        msg += "\nDelete your account.      d|<confirm_username>"
-        msg += "\nList users and names.     u"
-        msg += "\nUsage help (this page).   h\n"
-        msg = colored(msg, 'yellow')
-        print(msg)
-
-    def check_alive_conns(self):
-        '''Pulse each connection to see if if is currently alive.'''
-        self.alive_conns = []
-        for elt in self.conns: 
+        msg_list = [elt.strip() for elt in request.split('|')]
+
+        # Anything that is not a single-letter command is sent as an invalid opcode.
+        op_code = msg_list[0] if len(msg_list[0]) == 1 and msg_list[0].isascii() else '?'
+        return encode_frame(op_code, *msg_list[1:])
+
+    def send_request(self, *requests):
+        """Pipeline one or more requests to the leader and print its replies.
+
+        The leader replicates every mutation to the followers itself, in parallel, and
+        answers once a write quorum holds it. Requests that reach a follower come back
+        as redirects and are resent to the leader it names. A batch of reads only goes
+        to the replica that has been answering fastest.
+        """
+
+        for request in requests:
+            if request.split('|')[0].strip() == LOGIN:
+                if request != self.login_request:
+                    self.last_message_id = self.acked_message_id = 0
+                self.login_request = request
+
+        if self.suspected(self.curr_conn) and not self.fail_over():
+            print(colored("\nLost connection to every server.\n", "red"))
+            return
+        pending = list(requests)
+        if self.needs_login and self.login_request and self.login_request not in pending:
+            pending.insert(0, self.resume_request())
+        self.needs_login = False
+        for _ in range(self.max_redirects):
+            # Show pushed messages as they arrive along with the replies.
+            redirected = []
+            pages = []
+            leader = None
+            replies = 0
+            expected = len(pending)
+            if all(request.split('|')[0].strip() in self.read_ops for request in pending):
+                conn = self.fastest_conn()
+            else:
+                conn = self.curr_conn
+            reader = self.readers[conn]
             try:
-                elt.send(b"")
-                self.alive_conns.append(elt)
-            except:
+                sent = time.monotonic()
+                conn.sendall(b"".join(self.encode_request(request) for request in pending))
+            except OSError:
+                pass
+            frame = self.read_reply(conn, reader)
+            if frame is not None:
+                self.record_latency(conn, time.monotonic() - sent)
+            while replies < expected:
+                # The leader went away or is suspected: resend what it did not answer elsewhere.
+                if frame is None:
+                    redirected.extend(pending[replies:])
+                    if not self.drop_connection(conn):
+                        print(colored("\nLost connection to every server.\n", "red"))
+                        return
+                    break
+
+                op_code, fields = frame
+                if op_code == REDIRECT:
+                    if replies < len(pending):
+                        redirected.append(pending[replies])
+                    leader = fields
+                    replies += 1
+                elif op_code == REPLY:
+                    # Replies past the requests sent are the extra listing pages fetched below.
+                    request = pending[replies] if replies < len(pending) else pages[replies - len(pending)]
+                    request_op = request.split('|')[0].strip()
+                    reply = parse_reply(fields)
+                    print(render_reply(request_op, reply))
+                    replies += 1
+
+                    # A deleted account's message ids start over if it is created again.
+                    if reply.status == DELETED:
+                        self.last_message_id = self.acked_message_id = 0
+
+                    # A listing or filter page with a continuation token: fetch the next page, one at a time.
+                    if reply.status == ACCOUNTS and reply.page_token:
+                        if request_op == FILTER:
+                            pages.append(f"{FILTER}|{request.split('|')[1]}||{reply.page_token}")
+                        else:
+                            pages.append(f"{LIST}||{reply.page_token}")
+                        conn.sendall(self.encode_request(pages[-1]))
+                        expected += 1
+                else:
+                    self.display_frame(frame)
+                if replies < expected:
+                    frame = self.read_reply(conn, reader)
+
+            self.acknowledge(conn)
+            if not redirected:
+                return
+            pending = redirected
+            if leader is not None and not self.switch_leader(*leader):
                 continue
+            if self.login_request and self.login_request not in pending:
+                pending.insert(0, self.resume_request())
+            self.needs_login = False
+        print(colored("\nNo leader available, please try again.\n", "red"))
+
+    def read_reply(self, conn, reader):
+        """Wait for the next frame on a connection.
+
+        Returns None if the connection closes or the failure detector starts suspecting
+        its replica while we wait, so the caller can retry elsewhere.
+        """
+
+        conn.settimeout(self.detector.interval)
+        try:
+            while True:
+                try:
+                    return reader.read_frame()
+                except socket.timeout:
+                    if self.suspected(conn):
+                        return None
+        except OSError:
+            return None
+        finally:
+            try:
+                conn.settimeout(None)
+            except OSError:
+                pass
+
+    def add_connection(self, conn, host, port):
+        """Start using a new connection and have the failure detector watch its replica."""
+
+        self.conns.append(conn)
+        self.readers[conn] = FrameReader(conn)
+        self.addresses[conn] = (host, port)
+        self.detector.watch(host, port)
+
+    def suspected(self, conn):
+        """Whether the failure detector suspects the replica behind a connection."""
+
+        return conn in self.addresses and self.detector.suspected(*self.addresses[conn])
+
+    def fail_over(self):
+        """Switch from a suspected leader to a replica that still answers; False if none is left.
+
+        The suspected connection is dropped. A replica that turns out to be a follower
+        redirects the next request to the new leader.
+        """
+
+        if not self.drop_connection(self.curr_conn):
+            return False
+        healthy = [conn for conn in self.conns if not self.suspected(conn)]
+        if healthy:
+            self.curr_conn = healthy[0]
+        print(colored("\nServer not responding, switching to another replica.\n", "red"))
+        return True
+
+    def drop_connection(self, conn):
+        """Forget a dead connection and fall back to another replica; False if none is left."""
+
+        if conn in self.conns:
+            self.conns.remove(conn)
+        self.readers.pop(conn, None)
+        self.latency.pop(conn, None)
+        self.addresses.pop(conn, None)
+        conn.close()
+        if not self.conns:
+            return False
+        if conn == self.curr_conn:
+            self.curr_conn = self.conns[0]
+            self.needs_login = True
+        return True
+
+    def record_latency(self, conn, seconds):
+        """Fold one reply time into a connection's smoothed latency."""
+
+        previous = self.latency.get(conn)
+        if previous is None:
+            self.latency[conn] = seconds
+        else:
+            self.latency[conn] = previous + self.smoothing * (seconds - previous)
+
+    def fastest_conn(self):
+        """The unsuspected connection with the lowest smoothed latency; unmeasured ones are tried first."""
+
+        return min(self.conns, key=lambda conn: (self.suspected(conn), self.latency.get(conn, 0)))
+
+    def switch_leader(self, host, port):
+        """Make the named leader the current connection; False while an election is running.
+
+        An existing connection to the leader is reused, so failover does not reconnect.
+        """
+
+        if not port:
+            time.sleep(self.election_wait)
+            return False
+        for conn in self.conns:
+            if self.addresses[conn][1] == port:
+                self.curr_conn = conn
+                return True
+        try:
+            conn = socket.create_connection((host or self.host, port))
+        except OSError:
+            # The named leader is gone and the replicas have not noticed yet.
+            time.sleep(self.election_wait)
+            return False
+        self.add_connection(conn, host or self.host, port)
+        self.curr_conn = conn
+        return True
+
+    def display_frames(self, conn):
+        """Print the frame waiting on a connection plus any others already buffered.
+
+        Returns False once the server has closed the connection.
+        """
+
+        reader = self.readers[conn]
+        frame = reader.read_frame()
+        if frame is None:
+            return False
+        while frame is not None:
+            self.display_frame(frame)
+            frame = reader.next_frame()
+        self.acknowledge(conn)
+        return True
+
+    def display_frame(self, frame):
+        """Print a message pushed by the server, or a reply that arrived on its own.
+
+        A message already shown (pushed again after a reconnect) is skipped.
+        """
+
+        op_code, fields = frame
+        if op_code == MESSAGE:
+            msg_id, sender, text = fields
+            if msg_id <= self.last_message_id:
+                return
+            self.last_message_id = msg_id
+            print(render_message(sender, text))
+        elif op_code == REPLY:
+            print(render_reply(None, parse_reply(fields)))
+    
+    def acknowledge(self, conn):
+        """Acknowledge every message shown so far with one cumulative acknowledgement.
+
+        Sent once per batch of frames read, never waited on; if it is lost the server
+        pushes the messages again and they are skipped.
+        """
+
+        if self.last_message_id <= self.acked_message_id:
+            return
+        try:
+            conn.sendall(encode_frame(ACKNOWLEDGE, self.last_message_id))
+            self.acked_message_id = self.last_message_id
+        except OSError:
+            pass
+
+    def resume_request(self):
+        """The login request repeated on another replica, resuming after the newest message shown."""
+
+        fields = [field.strip() for field in self.login_request.split('|')][:2]
+        return "|".join(fields + [str(self.last_message_id)])
+
+    def welcome_msg(self):
+        print(render_help("\nWelcome to the chat application! Begin by logging in or creating an account. Below, you will find a list of supported commands :\n"))
 
 if __name__ == '__main__':
 
@@ -0,0 +1,246 @@
+import os
+import random
+import socket
+import threading
+import time
+from protocol import FrameReader, ProtocolError, encode_frame, VOTE
+from replication import ReplicaLink
+
+# Replica roles.
+FOLLOWER = "follower"
+CANDIDATE = "candidate"
+LEADER = "leader"
+
+
+class Election():
+    """Raft-style leader election among the replicas of a group.
+
+    Followers expect a heartbeat from the leader every `heartbeat_interval`; one that
+    hears nothing for a randomized election timeout starts an election for the next
+    term. A candidate that collects votes from a majority becomes leader and starts
+    shipping its log. The leader holds a lease: it steps down once it has not heard
+    from a majority for `election_timeout[0]`, which is also how long followers refuse
+    to vote after hearing from it, so two replicas never serve clients at once.
+    """
+
+    def __init__(self, server, heartbeat_interval=0.05, election_timeout=(0.15, 0.3)):
+        # The Server taking part in the election.
+        self.server = server
+
+        # Seconds between heartbeats from the leader.
+        self.heartbeat_interval = heartbeat_interval
+
+        # Range the randomized election timeout is drawn from (seconds).
+        self.election_timeout = election_timeout
+
+        # (host, port) of every other replica in the group.
+        self.peers = [replica for replica in server.replicas if replica != (server.ip, server.port)]
+
+        # Votes needed to win an election, counting our own.
+        self.majority = len(self.peers) // 2 + 1
+
+        # Guards the election state below.
+        self.lock = threading.Lock()
+
+        # Where the current term and vote are kept across restarts.
+        self.state_path = f"{server.port}.term"
+
+        # The latest term seen, and who we voted for in it ("host:port" or "").
+        self.term, self.voted_for = self.load()
+
+        # FOLLOWER, CANDIDATE or LEADER.
+        self.role = FOLLOWER
+
+        # (host, port) of the leader of the current term, once known.
+        self.leader = None
+
+        # When we last heard from the leader or granted a vote (time.monotonic()).
+        self.last_contact = time.monotonic()
+
+        # When a follower with no news from a leader starts an election.
+        self.deadline = self.next_deadline()
+
+        # When this replica last became leader.
+        self.leader_since = 0
+
+        # ReplicaLinks shipping our log while we are leader.
+        self.links = []
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load(self):
+        """Read the persisted term and vote."""
+
+        try:
+            with open(self.state_path, 'r') as f:
+                term, voted_for = f.read().split(',', 1)
+                return int(term), voted_for.strip()
+        except (FileNotFoundError, ValueError):
+            return 0, ""
+
+    def save(self):
+        """Persist the term and vote before acting on them (called with the lock held)."""
+
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(f"{self.term},{self.voted_for}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def next_deadline(self):
+        return time.monotonic() + random.uniform(*self.election_timeout)
+
+    def is_leader(self, term=None):
+        """Whether this replica leads (the given term, if any)."""
+
+        return self.role == LEADER and (term is None or term == self.term)
+
+    def run(self):
+        """Start elections when the leader goes quiet, and drop a lapsed lease."""
+
+        while not self.server.stop_event.is_set():
+            time.sleep(self.heartbeat_interval / 5)
+            now = time.monotonic()
+            if self.role == LEADER:
+                with self.lock:
+                    if self.role == LEADER and not self.has_lease(now):
+                        self.server.log.warning("election", "Lost contact with a majority, stepping down",
+                                                term=self.term)
+                        self.become_follower(self.term, None)
+            elif now >= self.deadline and not self.server.installing:
+                self.start_election()
+        with self.lock:
+            self.links = []
+
+    def has_lease(self, now):
+        """Whether a majority (counting us) has acknowledged us within the lease."""
+
+        lease = self.election_timeout[0]
+        if now - self.leader_since < lease:
+            return True
+        acks = 1 + sum(1 for link in self.links if now - link.last_ack < lease)
+        return acks >= self.majority
+
+    def start_election(self):
+        """Become a candidate for the next term and ask every peer for its vote."""
+
+        with self.lock:
+            self.term += 1
+            self.voted_for = f"{self.server.ip}:{self.server.port}"
+            self.role = CANDIDATE
+            self.leader = None
+            self.deadline = self.next_deadline()
+            self.save()
+            term = self.term
+        last_term, last_seq = self.server.last_log()
+        self.server.log.info("election", "Starting election", term=term)
+
+        # Ask all peers at once; the election is decided as soon as a majority answers.
+        votes = [1]
+        decided = threading.Condition()
+
+        def ask(host, port):
+            granted = self.ask_vote(host, port, term, last_seq, last_term)
+            with decided:
+                votes[0] += granted
+                decided.notify_all()
+
+        for host, port in self.peers:
+            threading.Thread(target=ask, args=(host, port), daemon=True).start()
+        with decided:
+            decided.wait_for(lambda: votes[0] >= self.majority, timeout=self.election_timeout[0])
+            won = votes[0] >= self.majority
+
+        with self.lock:
+            won = won and self.role == CANDIDATE and self.term == term
+            if won:
+                self.become_leader()
+        if won:
+            self.server.start_term(term)
+
+    def ask_vote(self, host, port, term, last_seq, last_term):
+        """Request a peer's vote; returns 1 if granted, 0 otherwise."""
+
+        try:
+            with socket.create_connection((host, port), timeout=self.election_timeout[0]) as connection:
+                connection.sendall(encode_frame(VOTE, term, self.server.ip, self.server.port, last_seq, last_term))
+                frame = FrameReader(connection).read_frame()
+        except (OSError, ProtocolError):
+            return 0
+        if frame is None or frame[0] != VOTE:
+            return 0
+        peer_term, granted = frame[1]
+        self.observe_term(peer_term)
+        return granted
+
+    def request_vote(self, term, host, port, last_seq, last_term):
+        """Answer a candidate: returns (our term, 1 if the vote is granted else 0).
+
+        The vote goes to the first candidate of a term whose log is at least as up to
+        date as ours, unless we heard from a live leader within the minimum election
+        timeout. Logs are compared by the term of their newest record, then by length,
+        so a replica holding records only a deposed leader had cannot win over one
+        holding the records a newer leader committed.
+        """
+
+        candidate = f"{host}:{port}"
+        with self.lock:
+            recent = time.monotonic() - self.last_contact < self.election_timeout[0]
+            if term > self.term and (self.role == LEADER or (self.leader is not None and recent)):
+                return self.term, 0
+            if term > self.term:
+                self.become_follower(term, None)
+            granted = (term == self.term and self.voted_for in ("", candidate)
+                       and (last_term, last_seq) >= self.server.last_log())
+            if granted:
+                self.voted_for = candidate
+                self.save()
+                self.last_contact = time.monotonic()
+                self.deadline = self.next_deadline()
+            return self.term, int(granted)
+
+    def observe_leader(self, term, host, port):
+        """Record contact from a leader; False if its term is stale and it must be refused."""
+
+        with self.lock:
+            if term < self.term or (term == self.term and self.role == LEADER):
+                return False
+            if term > self.term or self.role != FOLLOWER or self.leader != (host, port):
+                self.become_follower(term, (host, port))
+                self.server.log.info("election", "Following leader", leader=f"{host}:{port}", term=term)
+            self.last_contact = time.monotonic()
+            self.deadline = self.next_deadline()
+            return True
+
+    def observe_term(self, term):
+        """Step down if a peer reports a newer term."""
+
+        with self.lock:
+            if term > self.term:
+                self.become_follower(term, None)
+
+    def become_follower(self, term, leader):
+        """Follow `leader` (None until it is known) in `term` (called with the lock held)."""
+
+        if self.role == LEADER:
+            self.server.end_sessions()
+        if term != self.term:
+            self.term = term
+            self.voted_for = ""
+            self.save()
+        self.role = FOLLOWER
+        self.leader = leader
+        self.links = []
+        self.deadline = self.next_deadline()
+
+    def become_leader(self):
+        """Take over as leader and start shipping the log (called with the lock held)."""
+
+        self.server.log.info("election", "Elected leader", term=self.term)
+        self.role = LEADER
+        self.leader = (self.server.ip, self.server.port)
+        self.leader_since = time.monotonic()
+        self.server.replication.reset_acks()
+        self.links = [ReplicaLink(self.server, host, port, self.term) for host, port in self.peers]
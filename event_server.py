@@ -0,0 +1,382 @@
+import socket, sys
+import threading
+import selectors
+import queue
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from server import Server
+from replication import parse_replica
+from protocol import FrameReader, ProtocolError, encode_reply, reply_fields, FILTER, REPLICATE, FAILED
+
+
+class ClientState():
+    """Per-connection buffers kept by the event loop."""
+
+    def __init__(self):
+        # Incoming bytes, split into request frames as they complete.
+        self.reader = FrameReader()
+
+        # Encoded bytes waiting for the socket to become writable.
+        self.outbuf = bytearray()
+
+        # When the connection last sent a request (time.monotonic()).
+        self.last_seen = time.monotonic()
+
+        # Replies and pushed messages in order as [frame, seq] ([frame, seq, True] for pushes);
+        # a frame is None until its worker finishes, and it is held back until log record
+        # `seq` is committed.
+        self.replies = deque()
+
+
+class EventServer(Server):
+    """Single-threaded readiness-loop server sharing the handlers of Server."""
+
+    # Queue as many pending connections as the kernel allows.
+    backlog = socket.SOMAXCONN
+
+    def __init__(self, ip, port, stop_event, workers=4, durability="sync", idle_timeout=None,
+                 queue_policy="spill", replicas=None, write_quorum=None, storage="sqlite", metrics_port=None, log_level="info",
+                 peer_secret=None):
+        # Number of worker threads for blocking requests (0 handles everything on the loop).
+        self.workers = workers
+
+        # Opcodes whose handlers may block and are handed to the worker pool.
+        self.offload_ops = {FILTER}
+
+        # A dictionary with connections as keys and their ClientState as values.
+        self.clients = {}
+
+        # Finished worker requests waiting to be written back by the loop.
+        self.completed = queue.SimpleQueue()
+
+        # Newest log record written by the request currently being handled on the loop.
+        self.request_seq = 0
+
+        # Connections with replies held back until the log commits them.
+        self.awaiting_commit = set()
+
+        # When close_idle() next scans for idle connections (time.monotonic()).
+        self.next_idle_check = 0
+
+        super().__init__(ip, port, stop_event, durability, idle_timeout, queue_policy, replicas, write_quorum,
+                         storage, metrics_port, log_level, peer_secret)
+
+    def serve(self, server):
+        """Multiplex every connection on one selector until the stop event is set."""
+
+        server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server, selectors.EVENT_READ, "accept")
+
+        # Worker threads wake the loop by writing a byte to this socket pair.
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, "wakeup")
+
+        self.pool = ThreadPoolExecutor(self.workers) if self.workers else None
+
+        # Release held replies whenever a group commit lands or the write quorum advances.
+        self.wal.on_durable = lambda seq: self.wake()
+        self.replication.on_commit = self.wake
+
+        try:
+            while not self.stop_event.is_set():
+                # Poll more often while replies wait, so ones whose quorum timed out go out.
+                timeout = 0.05 if self.awaiting_commit else 1
+                for key, mask in self.selector.select(timeout=timeout):
+                    if key.data == "accept":
+                        self.accept(server)
+                    elif key.data == "wakeup":
+                        self.drain_wakeups()
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            self.on_readable(key.fileobj)
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush(key.fileobj)
+                self.finish_completed()
+                self.release_committed()
+                self.close_idle()
+        finally:
+            self.wal.on_durable = None
+            self.replication.on_commit = None
+            for connection in list(self.clients):
+                self.close(connection)
+            if self.pool:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+            self.selector.close()
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+
+    def accept(self, server):
+        """Accept every connection that is waiting on the listening socket."""
+
+        while True:
+            try:
+                connection, address = server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.log.info("connection", "Connected", address=f"{address[0]}:{address[1]}")
+            connection.setblocking(False)
+            self.clients[connection] = ClientState()
+            self.selector.register(connection, selectors.EVENT_READ, "client")
+
+    def on_readable(self, connection):
+        """Read what is available and answer every complete request frame."""
+
+        state = self.clients.get(connection)
+        if state is None:
+            return
+        try:
+            data = connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(connection)
+            return
+
+        state.last_seen = time.monotonic()
+        state.reader.feed(data)
+        self.bytes_received.inc(amount=len(data))
+        try:
+            frame = state.reader.next_frame()
+            while frame is not None:
+                op_code, fields = frame
+
+                # A leader shipping its log gets a blocking thread of its own.
+                if op_code == REPLICATE:
+                    self.detach(connection, fields)
+                    return
+
+                msg_list = [op_code] + [elt.strip() if isinstance(elt, str) else elt for elt in fields]
+                redirect = self.redirect(op_code)
+                if redirect is not None:
+                    state.replies.append([redirect, 0])
+                elif self.pool and op_code in self.offload_ops:
+                    slot = [None, 0]
+                    state.replies.append(slot)
+                    future = self.pool.submit(self.run_request, msg_list, connection)
+                    future.add_done_callback(
+                        lambda f, c=connection, s=slot: self.complete(c, s, f))
+                else:
+                    self.request_seq = 0
+                    reply = self.run_request(msg_list, connection)
+                    if reply is not None:
+                        state.replies.append([self.reply_frame(reply), self.request_seq])
+                frame = state.reader.next_frame()
+        except ProtocolError:
+            self.close(connection)
+            return
+        self.queue_replies(connection)
+
+    def detach(self, connection, fields):
+        """Take a replication connection off the loop and follow the leader on a thread."""
+
+        state = self.clients.pop(connection)
+        self.selector.unregister(connection)
+        connection.setblocking(True)
+        state.reader.connection = connection
+        threading.Thread(target=self.follow_detached, args=(connection, state.reader, fields),
+                         daemon=True).start()
+
+    def follow_detached(self, connection, reader, fields):
+        """Replication thread for a detached connection."""
+
+        try:
+            self.follow(connection, reader, *fields)
+        finally:
+            connection.close()
+
+    def run_request(self, msg_list, connection):
+        """Run a handler, turning unexpected errors into a reply instead of stopping the loop."""
+
+        started = time.perf_counter()
+        try:
+            return self.handle_request(msg_list, connection)
+        except Exception as e:
+            self.log.error("request", "Request failed", op=msg_list[0], error=e)
+            return reply_fields(FAILED, detail="Request failed, please try again.")
+        finally:
+            self.observe_request(msg_list[0], started)
+
+    def commit(self, seq):
+        """Note the record instead of blocking; the reply waits in its slot instead."""
+
+        self.request_seq = max(self.request_seq, seq)
+
+    def complete(self, connection, slot, future):
+        """Hand a finished worker request back to the loop (runs on the worker)."""
+
+        self.completed.put((connection, slot, future))
+        self.wake()
+
+    def wake(self):
+        """Interrupt the selector from another thread."""
+
+        try:
+            self.wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def drain_wakeups(self):
+        """Empty the wakeup socket so it stops polling readable."""
+
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def release_committed(self):
+        """Write out replies whose log records have been committed."""
+
+        for connection in list(self.awaiting_commit):
+            self.queue_replies(connection)
+
+    def finish_completed(self):
+        """Fill the reply slots of worker requests that have finished."""
+
+        while True:
+            try:
+                connection, slot, future = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            if connection not in self.clients:
+                continue
+            slot[0] = self.reply_frame(future.result())
+            self.queue_replies(connection)
+
+    def queue_replies(self, connection):
+        """Move finished replies to the output buffer, keeping request order."""
+
+        state = self.clients.get(connection)
+        if state is None:
+            self.awaiting_commit.discard(connection)
+            return
+        while state.replies and state.replies[0][0] is not None:
+            frame, seq, *push = state.replies[0]
+            if not self.is_committed(seq):
+                if not self.is_expired(seq):
+                    break
+                # The write quorum did not acknowledge the record in time: the reply says so,
+                # and pushed messages stay queued until the next login instead.
+                frame = b"" if push else encode_reply(self.unavailable())
+            state.replies.popleft()
+            state.outbuf += frame
+        if state.replies and state.replies[0][0] is not None:
+            self.awaiting_commit.add(connection)
+        else:
+            self.awaiting_commit.discard(connection)
+        self.flush(connection)
+
+    def push(self, connection, data):
+        """Queue encoded frames for a client behind its earlier replies.
+
+        Like replies they wait until the log commits every record written so far, so a
+        client never sees a message whose id a crash could hand out again.
+        """
+
+        state = self.clients.get(connection)
+        if state is None:
+            return False
+        state.replies.append([bytes(data), self.wal.next_seq - 1, True])
+        self.queue_replies(connection)
+        return connection in self.clients
+
+    def disconnect(self, connection):
+        """End a connection's session; on the loop this is the same as closing it."""
+
+        self.close(connection)
+
+    def close_idle(self):
+        """Close connections that have not sent a request within idle_timeout."""
+
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        if now < self.next_idle_check:
+            return
+        self.next_idle_check = now + min(1, self.idle_timeout)
+        for connection, state in list(self.clients.items()):
+            if now - state.last_seen > self.idle_timeout:
+                self.close(connection)
+
+    def flush(self, connection):
+        """Write buffered bytes without blocking, waiting for EVENT_WRITE if needed."""
+
+        state = self.clients.get(connection)
+        if state is None:
+            return
+        try:
+            while state.outbuf:
+                sent = connection.send(state.outbuf)
+                del state.outbuf[:sent]
+                self.bytes_sent.inc(amount=sent)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close(connection)
+            return
+
+        events = selectors.EVENT_READ
+        if state.outbuf:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(connection).events != events:
+            self.selector.modify(connection, events, "client")
+
+    def close(self, connection):
+        """Forget a connection, end its session and release its socket."""
+
+        username = self.sessions.logout_connection(connection)
+        if username is not None:
+            self.log.info("session", "Disconnected", user=username)
+        self.awaiting_commit.discard(connection)
+        self.delivered.pop(connection, None)
+        self.delivery_locks.pop(connection, None)
+        self.peers.discard(connection)
+        if self.clients.pop(connection, None) is None:
+            return
+        try:
+            self.selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        connection.close()
+
+
+if __name__ == '__main__':
+
+    # Serve metrics over HTTP when given --metrics <PORT>.
+    METRICS_PORT = None
+    if "--metrics" in sys.argv[:-1]:
+        index = sys.argv.index("--metrics")
+        METRICS_PORT = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+
+    # Log at the level given by --log-level <debug|info|warning|error>.
+    LOG_LEVEL = "info"
+    if "--log-level" in sys.argv[:-1]:
+        index = sys.argv.index("--log-level")
+        LOG_LEVEL = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+
+    # Validate command line arguments.
+    if len(sys.argv) >= 3:
+        HOST = sys.argv[1]
+        PORT = int(sys.argv[2])
+        WORKERS = int(sys.argv[3]) if len(sys.argv) >= 4 else 4
+
+        # The replica group as host:port (or port on this host).
+        REPLICAS = [parse_replica(address, HOST) for address in sys.argv[4:]]
+        stop_event_server = multiprocessing.Event()
+
+        # Start the event loop server.
+        EventServer(HOST, PORT, stop_event_server, WORKERS, replicas=REPLICAS, metrics_port=METRICS_PORT,
+                    log_level=LOG_LEVEL)
+    else:
+        print("Usage: python3 event_server.py <HOST> <PORT> [WORKERS [<REPLICA> ...]] [--metrics <METRICS_PORT>] "
+              "[--log-level <LEVEL>]")
+        sys.exit(1)
@@ -0,0 +1,194 @@
+import re
+import functools
+import itertools
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+
+# Accounts matched per task handed to a worker process.
+CHUNK_SIZE = 5000
+
+
+class FilterError(Exception):
+    """Raised when a filter pattern is invalid, too costly or times out."""
+
+
+@functools.lru_cache(maxsize=256)
+def compiled_pattern(pattern):
+    """Compile a pattern once per process (used inside the worker processes)."""
+
+    return re.compile(pattern)
+
+
+def count_repeats(pattern):
+    """Count the quantifiers (*, +, ?, {m,n}) outside character classes and escapes.
+
+    Backtracking a string of length n can cost n to the power of this count, so it is
+    an upper bound on how fast matching time grows (lazy quantifiers count twice).
+    """
+
+    count = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            # A ] right after [ or [^ is a literal member of the class.
+            if pattern[i + 1:i + 2] == "^":
+                i += 1
+            if pattern[i + 1:i + 2] == "]":
+                i += 1
+        elif char in "*+?{":
+            count += 1
+        i += 1
+    return count
+
+
+def match_chunk(pattern, accounts, limit):
+    """Worker task: return (matches, accounts examined), stopping after `limit` matches."""
+
+    regex = compiled_pattern(pattern)
+    matches = []
+    for i, account in enumerate(accounts):
+        if regex.fullmatch(account):
+            matches.append(account)
+            if limit is not None and len(matches) >= limit:
+                return matches, i + 1
+    return matches, len(accounts)
+
+
+class RegexFilter():
+    """Evaluates user supplied account filters with a compile cache and a time budget.
+
+    Only patterns that match in linear time run inline: those without groups or
+    backreferences and with at most one quantifier. Anything else, such as 'a*a*a*b',
+    whose cost grows with a power of the account name length, runs in a small process
+    pool, which is torn down when a pattern exceeds its budget, so a pathological regex
+    costs one timeout instead of a server thread.
+    """
+
+    def __init__(self, workers=2, timeout=0.5, cache_size=256, max_length=200):
+        # Number of worker processes for patterns that need a time budget.
+        self.workers = workers
+
+        # Seconds a single filter request may spend matching.
+        self.timeout = timeout
+
+        # Longest pattern accepted.
+        self.max_length = max_length
+
+        # LRU cache of compiled patterns in this process.
+        self.compile = functools.lru_cache(maxsize=cache_size)(re.compile)
+
+        # LRU set of patterns that already timed out, rejected without running again.
+        self.rejected = OrderedDict()
+
+        # Maximum number of remembered costly patterns.
+        self.rejected_size = cache_size
+
+        # Worker process pool, started on first use.
+        self.pool = None
+
+        # Guards pool creation and teardown.
+        self.lock = threading.Lock()
+
+    def needs_sandbox(self, pattern):
+        """Whether a pattern can backtrack more than linearly (it has groups, backreferences
+        or more than one quantifier)."""
+
+        return "(" in pattern or re.search(r"\\[1-9]", pattern) is not None or count_repeats(pattern) > 1
+
+    def match(self, pattern, accounts, limit=None, start=0):
+        """Return (matches, position) for accounts[start:] matching `pattern`.
+
+        Matching stops after `limit` matches; `position` is the index to resume from,
+        or None when every account has been examined. `accounts` is read in place, so
+        it may be a live list that other threads insert into.
+        """
+
+        if len(pattern) > self.max_length:
+            raise FilterError(f"Filter is longer than {self.max_length} characters.")
+        if pattern in self.rejected:
+            self.rejected.move_to_end(pattern)
+            raise FilterError("Filter is too expensive to evaluate.")
+        try:
+            regex = self.compile(pattern)
+        except re.error as e:
+            raise FilterError(f"Invalid filter: {e}.")
+
+        if not self.needs_sandbox(pattern) or not self.workers:
+            matches = []
+            for i, account in enumerate(itertools.islice(accounts, start, None), start):
+                if regex.fullmatch(account):
+                    matches.append(account)
+                    if limit is not None and len(matches) >= limit:
+                        return matches, (i + 1 if i + 1 < len(accounts) else None)
+            return matches, None
+
+        return self.match_sandboxed(pattern, accounts, limit, start)
+
+    def match_sandboxed(self, pattern, accounts, limit, start):
+        """Match chunk by chunk in the worker pool within the request's time budget."""
+
+        pool = self.get_pool()
+        matches = []
+        position = start
+        budget = self.timeout
+        try:
+            while position < len(accounts):
+                remaining = None if limit is None else limit - len(matches)
+                chunk = accounts[position:position + CHUNK_SIZE]
+                result = pool.apply_async(match_chunk, (pattern, chunk, remaining))
+                started = time.monotonic()
+                found, examined = result.get(timeout=max(budget, 0))
+                budget -= time.monotonic() - started
+                matches.extend(found)
+                position += examined
+                if limit is not None and len(matches) >= limit:
+                    break
+        except multiprocessing.TimeoutError:
+            if not self.reset_pool(pool):
+                raise FilterError("Filter was interrupted, please try again.")
+            self.rejected[pattern] = True
+            if len(self.rejected) > self.rejected_size:
+                self.rejected.popitem(last=False)
+            raise FilterError("Filter is too expensive to evaluate.")
+        return matches, (position if position < len(accounts) else None)
+
+    def get_pool(self):
+        """Start the worker pool if it is not running."""
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.get_context("spawn").Pool(self.workers)
+                # Wait for the workers to start so startup does not eat into request budgets.
+                self.pool.apply(match_chunk, ("", [], None))
+            return self.pool
+
+    def reset_pool(self, pool):
+        """Kill a pool whose worker is stuck; the next sandboxed filter starts a new one.
+
+        Returns False if another request already killed it (this request was collateral).
+        """
+
+        with self.lock:
+            if self.pool is not pool:
+                return False
+            self.pool = None
+        pool.terminate()
+        return True
+
+    def close(self):
+        """Stop the worker processes."""
+
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
@@ -13,25 +13,41 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rchatapp.proto\x12\x07\x63hatapp\"\x1b\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\"\x1e\n\x0bServerReply\x12\x0f\n\x07message\x18\x01 \x01(\t\"\x07\n\x05\x45mpty\"E\n\x07Message\x12\x12\n\nsenderName\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x15\n\rrecipientName\x18\x03 \x01(\t\"\x1e\n\x0c\x46ilterString\x12\x0e\n\x06\x66ilter\x18\x01 \x01(\t\"@\n\nLoginReply\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t2\xde\x03\n\x07\x43hatApp\x12\x39\n\rcreateAccount\x12\x10.chatapp.Account\x1a\x14.chatapp.ServerReply\"\x00\x12\x30\n\x05logIn\x12\x10.chatapp.Account\x1a\x13.chatapp.LoginReply\"\x00\x12\x36\n\x0clistAccounts\x12\x0e.chatapp.Empty\x1a\x14.chatapp.ServerReply\"\x00\x12?\n\x0e\x66ilterAccounts\x12\x15.chatapp.FilterString\x1a\x14.chatapp.ServerReply\"\x00\x12\x37\n\x0bsendMessage\x12\x10.chatapp.Message\x1a\x14.chatapp.ServerReply\"\x00\x12\x39\n\rdeleteAccount\x12\x10.chatapp.Account\x1a\x14.chatapp.ServerReply\"\x00\x12;\n\x11listenForMessages\x12\x10.chatapp.Account\x1a\x10.chatapp.Message\"\x00\x30\x01\x12<\n\x10listenForReplies\x12\x0e.chatapp.Empty\x1a\x14.chatapp.ServerReply\"\x00\x30\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rchatapp.proto\x12\x07\x63hatapp\"\x1b\n\x07\x41\x63\x63ount\x12\x10\n\x08username\x18\x01 \x01(\t\"\x9b\x01\n\x0bServerReply\x12\x1f\n\x06status\x18\x01 \x01(\x0e\x32\x0f.chatapp.Status\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x0e\n\x06\x64\x65tail\x18\x03 \x01(\t\x12\r\n\x05\x63ount\x18\x04 \x01(\r\x12&\n\x08\x61\x63\x63ounts\x18\x05 \x03(\x0b\x32\x14.chatapp.AccountInfo\x12\x12\n\npage_token\x18\x06 \x01(\t\"4\n\x0bListRequest\x12\x11\n\tpage_size\x18\x01 \x01(\r\x12\x12\n\npage_token\x18\x02 \x01(\t\"-\n\x0b\x41\x63\x63ountInfo\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0c\n\x04live\x18\x02 \x01(\x08\"N\n\x0b\x41\x63\x63ountPage\x12&\n\x08\x61\x63\x63ounts\x18\x01 \x03(\x0b\x32\x14.chatapp.AccountInfo\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\"\x07\n\x05\x45mpty\"Q\n\x07Message\x12\x12\n\nsenderName\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x15\n\rrecipientName\x18\x03 \x01(\t\x12\n\n\x02id\x18\x04 \x01(\x04\"7\n\rListenRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x14\n\x0cresume_after\x18\x02 \x01(\x04\"7\n\x0f\x41\x63knowledgement\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x12\n\nmessage_id\x18\x02 \x01(\x04\"2\n\x0cMessageBatch\x12\"\n\x08messages\x18\x01 \x03(\x0b\x32\x10.chatapp.Message\"C\n\rMessageStatus\x12\x1f\n\x06status\x18\x01 \x01(\x0e\x32\x0f.chatapp.Status\x12\x11\n\trecipient\x18\x02 \x01(\t\"D\n\nBatchReply\x12(\n\x08statuses\x18\x01 \x03(\x0b\x32\x16.chatapp.MessageStatus\x12\x0c\n\x04sent\x18\x02 \x01(\r\"E\n\x0c\x46ilterString\x12\x0e\n\x06\x66ilter\x18\x01 \x01(\t\x12\x11\n\tpage_size\x18\x02 \x01(\r\x12\x12\n\npage_token\x18\x03 \x01(\t*\xdc\x02\n\x06Status\x12\x06\n\x02OK\x10\x00\x12\x0b\n\x07\x43REATED\x10\x01\x12\r\n\tLOGGED_IN\x10\x02\x12\x0b\n\x07\x44\x45LETED\x10\x03\x12\x08\n\x04SENT\x10\x04\x12\n\n\x06QUEUED\x10\x05\x12\x0c\n\x08\x41\x43\x43OUNTS\x10\x06\x12\t\n\x05USAGE\x10\x07\x12\x15\n\x11INVALID_ARGUMENTS\x10\n\x12\x11\n\rNOT_LOGGED_IN\x10\x0b\x12\x15\n\x11\x41LREADY_LOGGED_IN\x10\x0c\x12\x12\n\x0e\x41\x43\x43OUNT_EXISTS\x10\r\x12\x14\n\x10INVALID_USERNAME\x10\x0e\x12\x10\n\x0cNO_SUCH_USER\x10\x0f\x12\x0f\n\x0bUSER_ONLINE\x10\x10\x12\x14\n\x10NOT_YOUR_ACCOUNT\x10\x11\x12\x0e\n\nQUEUE_FULL\x10\x12\x12\x0c\n\x08REJECTED\x10\x13\x12\x13\n\x0fUNKNOWN_REQUEST\x10\x14\x12\n\n\x06\x46\x41ILED\x10\x15\x12\x0f\n\x0bUNAVAILABLE\x10\x16\x32\xab\x05\n\x07\x43hatApp\x12\x39\n\rcreateAccount\x12\x10.chatapp.Account\x1a\x14.chatapp.ServerReply\"\x00\x12\x31\n\x05logIn\x12\x10.chatapp.Account\x1a\x14.chatapp.ServerReply\"\x00\x12>\n\x0clistAccounts\x12\x14.chatapp.ListRequest\x1a\x14.chatapp.AccountPage\"\x00\x30\x01\x12?\n\x0e\x66ilterAccounts\x12\x15.chatapp.FilterString\x1a\x14.chatapp.ServerReply\"\x00\x12\x37\n\x0bsendMessage\x12\x10.chatapp.Message\x1a\x14.chatapp.ServerReply\"\x00\x12\x39\n\x0csendMessages\x12\x10.chatapp.Message\x1a\x13.chatapp.BatchReply\"\x00(\x01\x12@\n\x10sendMessageBatch\x12\x15.chatapp.MessageBatch\x1a\x13.chatapp.BatchReply\"\x00\x12\x39\n\rdeleteAccount\x12\x10.chatapp.Account\x1a\x14.chatapp.ServerReply\"\x00\x12\x41\n\x11listenForMessages\x12\x16.chatapp.ListenRequest\x1a\x10.chatapp.Message\"\x00\x30\x01\x12?\n\x0b\x61\x63knowledge\x12\x18.chatapp.Acknowledgement\x1a\x14.chatapp.ServerReply\"\x00\x12<\n\x10listenForReplies\x12\x0e.chatapp.Empty\x1a\x14.chatapp.ServerReply\"\x00\x30\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chatapp_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
+  _STATUS._serialized_start=863
+  _STATUS._serialized_end=1211
   _ACCOUNT._serialized_start=26
   _ACCOUNT._serialized_end=53
-  _SERVERREPLY._serialized_start=55
-  _SERVERREPLY._serialized_end=85
-  _EMPTY._serialized_start=87
-  _EMPTY._serialized_end=94
-  _MESSAGE._serialized_start=96
-  _MESSAGE._serialized_end=165
-  _FILTERSTRING._serialized_start=167
-  _FILTERSTRING._serialized_end=197
-  _LOGINREPLY._serialized_start=199
-  _LOGINREPLY._serialized_end=263
-  _CHATAPP._serialized_start=266
-  _CHATAPP._serialized_end=744
+  _SERVERREPLY._serialized_start=56
+  _SERVERREPLY._serialized_end=211
+  _LISTREQUEST._serialized_start=213
+  _LISTREQUEST._serialized_end=265
+  _ACCOUNTINFO._serialized_start=267
+  _ACCOUNTINFO._serialized_end=312
+  _ACCOUNTPAGE._serialized_start=314
+  _ACCOUNTPAGE._serialized_end=392
+  _EMPTY._serialized_start=394
+  _EMPTY._serialized_end=401
+  _MESSAGE._serialized_start=403
+  _MESSAGE._serialized_end=484
+  _LISTENREQUEST._serialized_start=486
+  _LISTENREQUEST._serialized_end=541
+  _ACKNOWLEDGEMENT._serialized_start=543
+  _ACKNOWLEDGEMENT._serialized_end=598
+  _MESSAGEBATCH._serialized_start=600
+  _MESSAGEBATCH._serialized_end=650
+  _MESSAGESTATUS._serialized_start=652
+  _MESSAGESTATUS._serialized_end=719
+  _BATCHREPLY._serialized_start=721
+  _BATCHREPLY._serialized_end=789
+  _FILTERSTRING._serialized_start=791
+  _FILTERSTRING._serialized_end=860
+  _CHATAPP._serialized_start=1214
+  _CHATAPP._serialized_end=1897
 # @@protoc_insertion_point(module_scope)
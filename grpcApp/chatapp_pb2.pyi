@@ -1,8 +1,31 @@
+from google.protobuf.internal import containers as _containers
+from google.protobuf.internal import enum_type_wrapper as _enum_type_wrapper
 from google.protobuf import descriptor as _descriptor
 from google.protobuf import message as _message
-from typing import ClassVar as _ClassVar, Optional as _Optional
+from typing import ClassVar as _ClassVar, Iterable as _Iterable, Mapping as _Mapping, Optional as _Optional, Union as _Union
 
+ACCOUNTS: Status
+ACCOUNT_EXISTS: Status
+ALREADY_LOGGED_IN: Status
+CREATED: Status
+DELETED: Status
 DESCRIPTOR: _descriptor.FileDescriptor
+FAILED: Status
+INVALID_ARGUMENTS: Status
+INVALID_USERNAME: Status
+LOGGED_IN: Status
+NOT_LOGGED_IN: Status
+NOT_YOUR_ACCOUNT: Status
+NO_SUCH_USER: Status
+OK: Status
+QUEUED: Status
+QUEUE_FULL: Status
+REJECTED: Status
+SENT: Status
+UNAVAILABLE: Status
+UNKNOWN_REQUEST: Status
+USAGE: Status
+USER_ONLINE: Status
 
 class Account(_message.Message):
     __slots__ = ["username"]
@@ -10,38 +33,109 @@ class Account(_message.Message):
     username: str
     def __init__(self, username: _Optional[str] = ...) -> None: ...
 
+class AccountInfo(_message.Message):
+    __slots__ = ["live", "username"]
+    LIVE_FIELD_NUMBER: _ClassVar[int]
+    USERNAME_FIELD_NUMBER: _ClassVar[int]
+    live: bool
+    username: str
+    def __init__(self, username: _Optional[str] = ..., live: bool = ...) -> None: ...
+
+class AccountPage(_message.Message):
+    __slots__ = ["accounts", "next_page_token"]
+    ACCOUNTS_FIELD_NUMBER: _ClassVar[int]
+    NEXT_PAGE_TOKEN_FIELD_NUMBER: _ClassVar[int]
+    accounts: _containers.RepeatedCompositeFieldContainer[AccountInfo]
+    next_page_token: str
+    def __init__(self, accounts: _Optional[_Iterable[_Union[AccountInfo, _Mapping]]] = ..., next_page_token: _Optional[str] = ...) -> None: ...
+
+class Acknowledgement(_message.Message):
+    __slots__ = ["message_id", "username"]
+    MESSAGE_ID_FIELD_NUMBER: _ClassVar[int]
+    USERNAME_FIELD_NUMBER: _ClassVar[int]
+    message_id: int
+    username: str
+    def __init__(self, username: _Optional[str] = ..., message_id: _Optional[int] = ...) -> None: ...
+
+class BatchReply(_message.Message):
+    __slots__ = ["sent", "statuses"]
+    SENT_FIELD_NUMBER: _ClassVar[int]
+    STATUSES_FIELD_NUMBER: _ClassVar[int]
+    sent: int
+    statuses: _containers.RepeatedCompositeFieldContainer[MessageStatus]
+    def __init__(self, statuses: _Optional[_Iterable[_Union[MessageStatus, _Mapping]]] = ..., sent: _Optional[int] = ...) -> None: ...
+
 class Empty(_message.Message):
     __slots__ = []
     def __init__(self) -> None: ...
 
 class FilterString(_message.Message):
-    __slots__ = ["filter"]
+    __slots__ = ["filter", "page_size", "page_token"]
     FILTER_FIELD_NUMBER: _ClassVar[int]
+    PAGE_SIZE_FIELD_NUMBER: _ClassVar[int]
+    PAGE_TOKEN_FIELD_NUMBER: _ClassVar[int]
     filter: str
-    def __init__(self, filter: _Optional[str] = ...) -> None: ...
+    page_size: int
+    page_token: str
+    def __init__(self, filter: _Optional[str] = ..., page_size: _Optional[int] = ..., page_token: _Optional[str] = ...) -> None: ...
 
-class LoginReply(_message.Message):
-    __slots__ = ["message", "success", "username"]
-    MESSAGE_FIELD_NUMBER: _ClassVar[int]
-    SUCCESS_FIELD_NUMBER: _ClassVar[int]
+class ListRequest(_message.Message):
+    __slots__ = ["page_size", "page_token"]
+    PAGE_SIZE_FIELD_NUMBER: _ClassVar[int]
+    PAGE_TOKEN_FIELD_NUMBER: _ClassVar[int]
+    page_size: int
+    page_token: str
+    def __init__(self, page_size: _Optional[int] = ..., page_token: _Optional[str] = ...) -> None: ...
+
+class ListenRequest(_message.Message):
+    __slots__ = ["resume_after", "username"]
+    RESUME_AFTER_FIELD_NUMBER: _ClassVar[int]
     USERNAME_FIELD_NUMBER: _ClassVar[int]
-    message: str
-    success: bool
+    resume_after: int
     username: str
-    def __init__(self, success: bool = ..., message: _Optional[str] = ..., username: _Optional[str] = ...) -> None: ...
+    def __init__(self, username: _Optional[str] = ..., resume_after: _Optional[int] = ...) -> None: ...
 
 class Message(_message.Message):
-    __slots__ = ["message", "recipientName", "senderName"]
+    __slots__ = ["id", "message", "recipientName", "senderName"]
+    ID_FIELD_NUMBER: _ClassVar[int]
     MESSAGE_FIELD_NUMBER: _ClassVar[int]
     RECIPIENTNAME_FIELD_NUMBER: _ClassVar[int]
     SENDERNAME_FIELD_NUMBER: _ClassVar[int]
+    id: int
     message: str
     recipientName: str
     senderName: str
-    def __init__(self, senderName: _Optional[str] = ..., message: _Optional[str] = ..., recipientName: _Optional[str] = ...) -> None: ...
+    def __init__(self, senderName: _Optional[str] = ..., message: _Optional[str] = ..., recipientName: _Optional[str] = ..., id: _Optional[int] = ...) -> None: ...
+
+class MessageBatch(_message.Message):
+    __slots__ = ["messages"]
+    MESSAGES_FIELD_NUMBER: _ClassVar[int]
+    messages: _containers.RepeatedCompositeFieldContainer[Message]
+    def __init__(self, messages: _Optional[_Iterable[_Union[Message, _Mapping]]] = ...) -> None: ...
+
+class MessageStatus(_message.Message):
+    __slots__ = ["recipient", "status"]
+    RECIPIENT_FIELD_NUMBER: _ClassVar[int]
+    STATUS_FIELD_NUMBER: _ClassVar[int]
+    recipient: str
+    status: Status
+    def __init__(self, status: _Optional[_Union[Status, str]] = ..., recipient: _Optional[str] = ...) -> None: ...
 
 class ServerReply(_message.Message):
-    __slots__ = ["message"]
-    MESSAGE_FIELD_NUMBER: _ClassVar[int]
-    message: str
-    def __init__(self, message: _Optional[str] = ...) -> None: ...
+    __slots__ = ["accounts", "count", "detail", "page_token", "status", "username"]
+    ACCOUNTS_FIELD_NUMBER: _ClassVar[int]
+    COUNT_FIELD_NUMBER: _ClassVar[int]
+    DETAIL_FIELD_NUMBER: _ClassVar[int]
+    PAGE_TOKEN_FIELD_NUMBER: _ClassVar[int]
+    STATUS_FIELD_NUMBER: _ClassVar[int]
+    USERNAME_FIELD_NUMBER: _ClassVar[int]
+    accounts: _containers.RepeatedCompositeFieldContainer[AccountInfo]
+    count: int
+    detail: str
+    page_token: str
+    status: Status
+    username: str
+    def __init__(self, status: _Optional[_Union[Status, str]] = ..., username: _Optional[str] = ..., detail: _Optional[str] = ..., count: _Optional[int] = ..., accounts: _Optional[_Iterable[_Union[AccountInfo, _Mapping]]] = ..., page_token: _Optional[str] = ...) -> None: ...
+
+class Status(int, metaclass=_enum_type_wrapper.EnumTypeWrapper):
+    __slots__ = []
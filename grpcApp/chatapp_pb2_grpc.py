@@ -23,12 +23,12 @@ class ChatAppStub(object):
         self.logIn = channel.unary_unary(
                 '/chatapp.ChatApp/logIn',
                 request_serializer=chatapp__pb2.Account.SerializeToString,
-                response_deserializer=chatapp__pb2.LoginReply.FromString,
+                response_deserializer=chatapp__pb2.ServerReply.FromString,
                 )
-        self.listAccounts = channel.unary_unary(
+        self.listAccounts = channel.unary_stream(
                 '/chatapp.ChatApp/listAccounts',
-                request_serializer=chatapp__pb2.Empty.SerializeToString,
-                response_deserializer=chatapp__pb2.ServerReply.FromString,
+                request_serializer=chatapp__pb2.ListRequest.SerializeToString,
+                response_deserializer=chatapp__pb2.AccountPage.FromString,
                 )
         self.filterAccounts = channel.unary_unary(
                 '/chatapp.ChatApp/filterAccounts',
@@ -40,6 +40,16 @@ class ChatAppStub(object):
                 request_serializer=chatapp__pb2.Message.SerializeToString,
                 response_deserializer=chatapp__pb2.ServerReply.FromString,
                 )
+        self.sendMessages = channel.stream_unary(
+                '/chatapp.ChatApp/sendMessages',
+                request_serializer=chatapp__pb2.Message.SerializeToString,
+                response_deserializer=chatapp__pb2.BatchReply.FromString,
+                )
+        self.sendMessageBatch = channel.unary_unary(
+                '/chatapp.ChatApp/sendMessageBatch',
+                request_serializer=chatapp__pb2.MessageBatch.SerializeToString,
+                response_deserializer=chatapp__pb2.BatchReply.FromString,
+                )
         self.deleteAccount = channel.unary_unary(
                 '/chatapp.ChatApp/deleteAccount',
                 request_serializer=chatapp__pb2.Account.SerializeToString,
@@ -47,9 +57,14 @@ class ChatAppStub(object):
                 )
         self.listenForMessages = channel.unary_stream(
                 '/chatapp.ChatApp/listenForMessages',
-                request_serializer=chatapp__pb2.Account.SerializeToString,
+                request_serializer=chatapp__pb2.ListenRequest.SerializeToString,
                 response_deserializer=chatapp__pb2.Message.FromString,
                 )
+        self.acknowledge = channel.unary_unary(
+                '/chatapp.ChatApp/acknowledge',
+                request_serializer=chatapp__pb2.Acknowledgement.SerializeToString,
+                response_deserializer=chatapp__pb2.ServerReply.FromString,
+                )
         self.listenForReplies = channel.unary_stream(
                 '/chatapp.ChatApp/listenForReplies',
                 request_serializer=chatapp__pb2.Empty.SerializeToString,
@@ -91,6 +106,18 @@ class ChatAppServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def sendMessages(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def sendMessageBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def deleteAccount(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -103,6 +130,12 @@ class ChatAppServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def acknowledge(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def listenForReplies(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -120,12 +153,12 @@ def add_ChatAppServicer_to_server(servicer, server):
             'logIn': grpc.unary_unary_rpc_method_handler(
                     servicer.logIn,
                     request_deserializer=chatapp__pb2.Account.FromString,
-                    response_serializer=chatapp__pb2.LoginReply.SerializeToString,
+                    response_serializer=chatapp__pb2.ServerReply.SerializeToString,
             ),
-            'listAccounts': grpc.unary_unary_rpc_method_handler(
+            'listAccounts': grpc.unary_stream_rpc_method_handler(
                     servicer.listAccounts,
-                    request_deserializer=chatapp__pb2.Empty.FromString,
-                    response_serializer=chatapp__pb2.ServerReply.SerializeToString,
+                    request_deserializer=chatapp__pb2.ListRequest.FromString,
+                    response_serializer=chatapp__pb2.AccountPage.SerializeToString,
             ),
             'filterAccounts': grpc.unary_unary_rpc_method_handler(
                     servicer.filterAccounts,
@@ -137,6 +170,16 @@ def add_ChatAppServicer_to_server(servicer, server):
                     request_deserializer=chatapp__pb2.Message.FromString,
                     response_serializer=chatapp__pb2.ServerReply.SerializeToString,
             ),
+            'sendMessages': grpc.stream_unary_rpc_method_handler(
+                    servicer.sendMessages,
+                    request_deserializer=chatapp__pb2.Message.FromString,
+                    response_serializer=chatapp__pb2.BatchReply.SerializeToString,
+            ),
+            'sendMessageBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.sendMessageBatch,
+                    request_deserializer=chatapp__pb2.MessageBatch.FromString,
+                    response_serializer=chatapp__pb2.BatchReply.SerializeToString,
+            ),
             'deleteAccount': grpc.unary_unary_rpc_method_handler(
                     servicer.deleteAccount,
                     request_deserializer=chatapp__pb2.Account.FromString,
@@ -144,9 +187,14 @@ def add_ChatAppServicer_to_server(servicer, server):
             ),
             'listenForMessages': grpc.unary_stream_rpc_method_handler(
                     servicer.listenForMessages,
-                    request_deserializer=chatapp__pb2.Account.FromString,
+                    request_deserializer=chatapp__pb2.ListenRequest.FromString,
                     response_serializer=chatapp__pb2.Message.SerializeToString,
             ),
+            'acknowledge': grpc.unary_unary_rpc_method_handler(
+                    servicer.acknowledge,
+                    request_deserializer=chatapp__pb2.Acknowledgement.FromString,
+                    response_serializer=chatapp__pb2.ServerReply.SerializeToString,
+            ),
             'listenForReplies': grpc.unary_stream_rpc_method_handler(
                     servicer.listenForReplies,
                     request_deserializer=chatapp__pb2.Empty.FromString,
@@ -193,7 +241,7 @@ class ChatApp(object):
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/chatapp.ChatApp/logIn',
             chatapp__pb2.Account.SerializeToString,
-            chatapp__pb2.LoginReply.FromString,
+            chatapp__pb2.ServerReply.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
@@ -208,9 +256,9 @@ class ChatApp(object):
             wait_for_ready=None,
             timeout=None,
             metadata=None):
-        return grpc.experimental.unary_unary(request, target, '/chatapp.ChatApp/listAccounts',
-            chatapp__pb2.Empty.SerializeToString,
-            chatapp__pb2.ServerReply.FromString,
+        return grpc.experimental.unary_stream(request, target, '/chatapp.ChatApp/listAccounts',
+            chatapp__pb2.ListRequest.SerializeToString,
+            chatapp__pb2.AccountPage.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
@@ -248,6 +296,40 @@ class ChatApp(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def sendMessages(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/chatapp.ChatApp/sendMessages',
+            chatapp__pb2.Message.SerializeToString,
+            chatapp__pb2.BatchReply.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def sendMessageBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chatapp.ChatApp/sendMessageBatch',
+            chatapp__pb2.MessageBatch.SerializeToString,
+            chatapp__pb2.BatchReply.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def deleteAccount(request,
             target,
@@ -277,11 +359,28 @@ class ChatApp(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_stream(request, target, '/chatapp.ChatApp/listenForMessages',
-            chatapp__pb2.Account.SerializeToString,
+            chatapp__pb2.ListenRequest.SerializeToString,
             chatapp__pb2.Message.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def acknowledge(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chatapp.ChatApp/acknowledge',
+            chatapp__pb2.Acknowledgement.SerializeToString,
+            chatapp__pb2.ServerReply.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def listenForReplies(request,
             target,
@@ -1,11 +1,15 @@
 import grpc
 import threading
 import time
+import os
 import sys
 import chatapp_pb2 as app
 import chatapp_pb2_grpc as rpc
 from termcolor import colored
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rendering import render_reply, render_accounts, render_message, render_help, render_batch
+
 ip = "10.250.129.194"
 port = 50051
 
@@ -16,6 +20,19 @@ class Client:
         # Set initial client variables
         self.username = None
         self.loggedIn = False
+
+        # Id of the newest message shown, and of the newest one acknowledged to the server.
+        self.last_message_id = 0
+        self.acked_message_id = 0
+
+        # Messages are acknowledged together, once `ack_batch` have arrived or every
+        # `ack_interval` seconds; `ack_ready` wakes the acknowledging thread early.
+        self.ack_batch = 64
+        self.ack_interval = 0.2
+        self.ack_ready = threading.Event()
+
+        # Seconds to wait before reopening a broken message stream.
+        self.retry_wait = 1
         channel = grpc.insecure_channel(ip + ':' + str(port))
         self.conn = rpc.ChatAppStub(channel)
 
@@ -28,33 +45,90 @@ class Client:
             target=self.__listen_for_messages)
 
     def __listen_for_messages(self):
-        """Thread that listens for messages from other clients."""
+        """Thread that listens for messages from other clients.
+
+        A broken stream is reopened after the newest message shown, so only messages
+        not received yet are sent again; repeats are skipped.
+        """
+
+        threading.Thread(target=self.__acknowledge_messages, daemon=True).start()
+        while True:
+            request = app.ListenRequest(username=self.username, resume_after=self.last_message_id)
+            try:
+                for msg in self.conn.listenForMessages(request):
+                    if msg.id <= self.last_message_id:
+                        continue
+                    print(render_message(msg.senderName, msg.message) + "\n")
+                    self.last_message_id = msg.id
+                    if self.last_message_id - self.acked_message_id >= self.ack_batch:
+                        self.ack_ready.set()
+            except grpc.RpcError as e:
+                print(colored(f"\nMessage stream interrupted ({e.code().name}), reconnecting.\n", "red"))
+            time.sleep(self.retry_wait)
+
+    def __acknowledge_messages(self):
+        """Thread acknowledging the messages shown, with one cumulative call per batch."""
 
-        for msg in self.conn.listenForMessages(app.Account(username=self.username)):
-            str = colored(f"[{msg.senderName}] ", "grey")
-            print(f"{str} {msg.message}\n")
+        while True:
+            self.ack_ready.wait(self.ack_interval)
+            self.ack_ready.clear()
+            msg_id = self.last_message_id
+            if msg_id <= self.acked_message_id:
+                continue
+            try:
+                self.conn.acknowledge(app.Acknowledgement(username=self.username, message_id=msg_id))
+                self.acked_message_id = msg_id
+            except grpc.RpcError:
+                pass
+
+    def list_accounts(self, page_size):
+        """Print each page of the account listing as it arrives."""
+
+        empty = True
+        for page in self.conn.listAccounts(app.ListRequest(page_size=page_size)):
+            if page.accounts:
+                empty = False
+                print(render_accounts(page.accounts))
+        if empty:
+            print(colored("\nNo existing users!\n", "red"))
+
+    def send_messages(self, messages):
+        """Send (recipient, text) pairs in one call; returns the BatchReply.
+
+        For bursts, which would otherwise pay a round trip per message.
+        """
+
+        batch = app.MessageBatch(messages=[app.Message(senderName=self.username, recipientName=recipient,
+                                                       message=text)
+                                           for recipient, text in messages])
+        return self.conn.sendMessageBatch(batch)
+
+    def stream_messages(self, path):
+        """Stream the messages of a file, one "recipient|text" per line; returns the BatchReply.
+
+        Lines are read as they are sent, so the file need not fit in memory.
+        """
+
+        def messages(f):
+            for line in f:
+                recipient, sep, text = line.rstrip("\n").partition('|')
+                if sep:
+                    yield app.Message(senderName=self.username, recipientName=recipient.strip(),
+                                      message=text.strip())
+
+        with open(path) as f:
+            return self.conn.sendMessages(messages(f))
 
     def send_message(self):
         """Gather input and communicate with the client."""
 
         # Welcome message.
-        msg = "\nWelcome to the chat application! Begin by logging in or creating an account. Below, you will find a list of supported commands :\n"
-        msg += "\nCreate an account.        c|<username>"
-        msg += "\nLog into an account.      l|<username>"
-        msg += "\nSend a message.           s|<recipient_username>|<message>"
-        msg += "\nFilter accounts.          f|<filter_regex>"
-        msg += "\nDelete your account.      d|<confirm_username>"
-        msg += "\nList users and names.     u"
-        msg += "\nUsage help (this page).   h\n"
-        msg = colored(msg, 'yellow')
-        print(msg)
+        print(render_help("\nWelcome to the chat application! Begin by logging in or creating an account. Below, you will find a list of supported commands :\n",
+                          batches=True))
 
         # Loop indefinitely until client quits.
         while True:
 
-            # General message for invalid argument count.
-            invalid_args_msg = colored("\nInvalid number of arguments!", "red")
-
             # Get input from user, then preprocess it.
             msg_str = input("")
             msg_list = msg_str.split('|')
@@ -65,48 +139,48 @@ class Client:
             # Usage: c|<username>
             if op_code == 'c':
                 if len(msg_list) != 2:
-                    print(colored("\nInvalid arguments! Usage: c|<username>\n", "red"))
+                    self.show(op_code, app.INVALID_ARGUMENTS)
                     continue
 
                 # Check if user is already logged in.
                 if self.loggedIn:
-                    print(colored("\nPlease disconnect first!\n", "red"))
+                    self.show(op_code, app.ALREADY_LOGGED_IN)
                     continue
 
-                msg = self.conn.createAccount(
+                reply = self.conn.createAccount(
                     app.Account(username=msg_list[1]))
-                print(msg.message)
+                print(render_reply(op_code, reply))
 
             # Log into an account.
             # Usage: l|<username>
             elif op_code == 'l':
                 if len(msg_list) != 2:
-                    print(colored("\nInvalid arguments! Usage: l|<username>\n", "red"))
+                    self.show(op_code, app.INVALID_ARGUMENTS)
                     continue
 
                 # Check if user is already logged in
                 if self.loggedIn:
-                    print(colored("\nPlease log out first!\n", "red"))
+                    self.show(op_code, app.ALREADY_LOGGED_IN)
                     continue
 
                 # Begin listening for messages (& dequeue all queued messages).
                 response = self.conn.logIn(app.Account(username=msg_list[1]))
-                if response.success:
+                if response.status == app.LOGGED_IN:
                     self.username = response.username
                     self.loggedIn = True
                     self.messageThread.start()
-                print(response.message)
+                print(render_reply(op_code, response))
 
             # Send a message to a user.
             # Usage: s|<recipient_username>|<message>
             elif op_code == 's':
                 if len(msg_list) != 3:
-                    print(colored("\nInvalid arguments! Usage: s|<recipient_username>|<message>\n", "red"))
+                    self.show(op_code, app.INVALID_ARGUMENTS)
                     continue
 
                 # Initialize and send the message.
                 if not self.loggedIn:
-                    print(colored("\nPlease log in to send a message!\n", "red"))
+                    self.show(op_code, app.NOT_LOGGED_IN)
                     continue
 
                 msg = app.Message()
@@ -114,73 +188,101 @@ class Client:
                 msg.recipientName = msg_list[1]
                 msg.message = msg_list[2]
                 response = self.conn.sendMessage(msg)
-                if response.message:
-                    print(response.message)
+                print(render_reply(op_code, response))
+
+            # Send one message to several users in a single call.
+            # Usage: b|<recipient_username>,<recipient_username>,...|<message>
+            elif op_code == 'b':
+                recipients = [name.strip() for name in msg_list[1].split(',')] if len(msg_list) == 3 else []
+                if not all(recipients):
+                    self.show(op_code, app.INVALID_ARGUMENTS)
+                    continue
+                if not self.loggedIn:
+                    self.show(op_code, app.NOT_LOGGED_IN)
+                    continue
 
-            # Filter accounts using a regex.
-            # Usage: f|<filter_regex>
-            elif op_code == 'f':
+                response = self.send_messages([(recipient, msg_list[2]) for recipient in recipients])
+                print(render_batch(response))
+
+            # Send every message of a file over one stream.
+            # Usage: m|<path>
+            elif op_code == 'm':
                 if len(msg_list) != 2:
-                    print(invalid_args_msg)
-                    print(colored("Usage:   f|<filter_regex>\n", "red"))
+                    self.show(op_code, app.INVALID_ARGUMENTS)
+                    continue
+                if not self.loggedIn:
+                    self.show(op_code, app.NOT_LOGGED_IN)
+                    continue
+
+                try:
+                    response = self.stream_messages(msg_list[1])
+                except OSError as e:
+                    print(colored(f"\nCould not read {msg_list[1]}: {e.strerror}.\n", "red"))
                     continue
-                msg = app.FilterString(filter=msg_list[1])
-                response = self.conn.filterAccounts(msg)
-                print(response.message)
+                print(render_batch(response))
+
+            # Filter accounts using a regex, printing every page of matches.
+            # Usage: f|<filter_regex>|<page_size> (page size optional)
+            elif op_code == 'f':
+                if len(msg_list) not in (2, 3) or (len(msg_list) == 3 and not msg_list[2].isdigit()):
+                    self.show(op_code, app.INVALID_ARGUMENTS)
+                    continue
+                page_size = int(msg_list[2]) if len(msg_list) == 3 else 0
+                response = self.conn.filterAccounts(app.FilterString(filter=msg_list[1], page_size=page_size))
+                print(render_reply(op_code, response))
+                while response.status == app.ACCOUNTS and response.page_token:
+                    response = self.conn.filterAccounts(app.FilterString(filter=msg_list[1],
+                                                                         page_token=response.page_token))
+                    print(render_reply(op_code, response))
 
             # Delete the current client's account.
             # Usage: d|<confirm_username>
             elif op_code == 'd':
                 if len(msg_list) != 2:
-                    print(
-                        colored("\nInvalid arguments! Usage: d|<confirm_username>\n", "red"))
+                    self.show(op_code, app.INVALID_ARGUMENTS)
                     continue
 
                 # Ensure user is logged in and uses correct confirmation.
                 if not self.loggedIn:
-                    print(colored("\nPlease log in first!\n", "red"))
+                    self.show(op_code, app.NOT_LOGGED_IN)
                     continue
                 if self.username != msg_list[1]:
-                    print(colored("\nIncorrect username for confirmation.\n", "red"))
+                    self.show(op_code, app.NO_SUCH_USER)
                     continue
 
-                msg = self.conn.deleteAccount(
+                reply = self.conn.deleteAccount(
                     app.Account(username=self.username))
 
-                print(msg.message)
+                print(render_reply(op_code, reply))
 
                 # Exit the process so that a user must reconnect.
                 sys.exit(0)
 
-            # List all users and their status.
-            # Usage: u
+            # List all users and their status, streamed a page at a time.
+            # Usage: u|<page_size>
             elif op_code == 'u':
-                if len(msg_list) != 1:
-                    print(invalid_args_msg)
-                    print(colored("Usage: u\n", "red"))
+                if len(msg_list) > 2 or (len(msg_list) == 2 and not msg_list[1].isdigit()):
+                    self.show(op_code, app.INVALID_ARGUMENTS)
                     continue
-                response = self.conn.listAccounts(app.Empty())
-                print(response.message)
+                page_size = int(msg_list[1]) if len(msg_list) == 2 else 0
+                try:
+                    self.list_accounts(page_size)
+                except grpc.RpcError as e:
+                    print(colored(f"\n{e.details()}\n", "red"))
 
             # Usage help.
             # Usage: h
             elif op_code == 'h':
-                msg = "\nUsage help below:\n"
-                msg += "\nCreate an account.        c|<username>"
-                msg += "\nLog into an account.      l|<username>"
-                msg += "\nSend a message.           s|<recipient_username>|<message>"
-                msg += "\nFilter accounts.          f|<filter_regex>"
-                msg += "\nDelete your account.      d|<confirm_username>"
-                msg += "\nList users and names.     u"
-                msg += "\nUsage help (this page).   h\n"
-                msg = colored(msg, 'red')
-                print(msg)
+                print(render_help(batches=True))
 
             # Handles an invalid request and lists the correct usage for the user.
             else:
-                msg = "\nInvalid request, use \"h\" for usage help!\n"
-                msg = colored(msg, 'red')
-                print(msg)
+                self.show(op_code, app.UNKNOWN_REQUEST)
+
+    def show(self, op_code, status):
+        """Print the text for a request the client turns down before sending it."""
+
+        print(render_reply(op_code, app.ServerReply(status=status)))
 
 
 # Start a Client process to handle user actions.
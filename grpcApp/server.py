@@ -1,197 +1,493 @@
-from concurrent import futures
+import asyncio
+import functools
 import logging
 import grpc
 import time
 import random
 import re
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import chatapp_pb2 as app
 import chatapp_pb2_grpc as rpc
-from termcolor import colored
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from filters import RegexFilter, FilterError
+from paging import AccountIndex, PageTokenError, encode_token, page_request
+from offline_queue import pack_message, unpack_message
+from storage import open_storage
+from metrics import MetricsRegistry, MetricsServer
+from logger import Logger
 
 ip = "10.250.129.194"
 port = 50051
 
+# Port of the local HTTP endpoint serving metrics in Prometheus format.
+metrics_port = 9091
+
+# Lowest level of log records written (debug, info, warning or error).
+log_level = "info"
+
+
+class Mailbox():
+    """A user's unacknowledged messages in id order, which a listener awaits.
+
+    A message stays in the mailbox until the client acknowledges it, so one lost with a
+    broken stream is sent again when the client resumes. Only touched from the server's
+    event loop, so it needs no lock.
+    """
+
+    def __init__(self):
+        # Messages in the order they were sent (ascending ids).
+        self.queue = deque()
+
+        # Set when a message is added.
+        self.ready = asyncio.Event()
+
+    def put(self, msg):
+        self.queue.append(msg)
+        self.ready.set()
+
+    async def newer_than(self, msg_id):
+        """Wait for messages with an id above `msg_id` and return them, oldest first
+        (cancelled along with the listener's stream)."""
+
+        while True:
+            newer = []
+            for msg in reversed(self.queue):
+                if msg.id <= msg_id:
+                    break
+                newer.append(msg)
+            if newer:
+                newer.reverse()
+                return newer
+            self.ready.clear()
+            await self.ready.wait()
+
+    def acknowledge(self, msg_id):
+        """Remove the messages up to and including `msg_id`; returns how many."""
+
+        count = 0
+        while self.queue and self.queue[0].id <= msg_id:
+            self.queue.popleft()
+            count += 1
+        return count
+
+    def clear(self):
+        self.queue.clear()
+
+
+def instrumented(method):
+    """Count and time a unary RPC under its name, with the bytes of its request and reply."""
+
+    @functools.wraps(method)
+    async def wrapper(self, request, context):
+        started = time.perf_counter()
+        reply = await method(self, request, context)
+        self.requests.inc(method.__name__)
+        self.request_seconds.observe(time.perf_counter() - started, method.__name__)
+        if hasattr(request, "ByteSize"):
+            self.bytes_received.inc(amount=request.ByteSize())
+        self.bytes_sent.inc(amount=reply.ByteSize())
+        return reply
+    return wrapper
+
 
 # inheriting here from the protobuf rpc file which is generated
 class ChatApp(rpc.ChatAppServicer):
+    """The chat service on grpc.aio: every RPC is a coroutine on one event loop, so
+    open listener streams cost a suspended coroutine rather than a worker thread."""
 
-    def __init__(self):
+    # Fraction of log records kept, by category (see logger.Logger).
+    log_sampling = {"request": 0.1}
 
-        # A dictionary with key: username, value: user's pending messages queue.
-        self.messages = {}
+    # Log records per second allowed, by category, so heavy load cannot flood the log.
+    log_rate_limits = {"session": 100, "account": 100, "message": 100, "filter": 100}
 
-        # A list with all of account usernames.
-        self.accounts = []
+    def __init__(self, storage="sqlite", path="chatapp.db", log_level="info"):
 
-        # A list with usernames of accounts that are currently logged in.
-        self.live_users = []
+        # Leveled, sampled log written by a background thread, off the event loop.
+        self.log = Logger(log_level, self.log_sampling, self.log_rate_limits)
 
-    def createAccount(self, request, context):
+        # Storage engine keeping accounts and undelivered messages across restarts
+        # (see storage.STORAGE_ENGINES); the dictionaries below are its in-memory view.
+        self.storage = open_storage(storage, path)
+
+        # The one thread storage writes run on, off the event loop and in the order made.
+        self.storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+        # Messages of a sendMessages stream stored with one commit.
+        self.stream_batch = 256
+
+        # A dictionary with key: username, value: user's Mailbox of pending messages.
+        self.messages = {}
+
+        # A dictionary with all account usernames as keys, in creation order, and the
+        # newest message id given to each account as values.
+        self.accounts = {}
+
+        # Account names in sorted order, for paginated listings.
+        self.account_index = AccountIndex()
+
+        # A set with usernames of accounts that are currently logged in.
+        self.live_users = set()
+
+        # A dictionary with usernames as keys and a token for the listener stream that
+        # holds their session as values, so only that stream ends the session.
+        self.listeners = {}
+
+        # Compiles and evaluates filterAccounts patterns within a time budget.
+        self.filters = RegexFilter()
+
+        # Metrics named like those of the socket server, with RPC names as the op label.
+        self.metrics = MetricsRegistry()
+
+        # Calls handled and the time unary ones took, by RPC.
+        self.requests = self.metrics.counter("chat_requests_total", "Requests handled, by RPC.", ["op"])
+        self.request_seconds = self.metrics.histogram("chat_request_seconds",
+                                                      "Time spent handling requests, by RPC.", ["op"])
+
+        # Serialized bytes of requests received and replies and messages sent.
+        self.bytes_received = self.metrics.counter("chat_received_bytes_total", "Bytes of requests received.")
+        self.bytes_sent = self.metrics.counter("chat_sent_bytes_total", "Bytes of replies and messages sent.")
+
+        # Messages streamed to listeners.
+        self.messages_pushed = self.metrics.counter("chat_messages_pushed_total",
+                                                    "Queued messages streamed to listeners.")
+
+        # Time spent committing writes to storage.
+        self.persist_seconds = self.metrics.histogram("chat_persist_seconds",
+                                                      "Time spent writing state to disk, by kind.", ["kind"])
+
+        # Gauges read from the servicer's state when scraped.
+        self.metrics.gauge("chat_sessions", "Users logged in.", function=lambda: len(self.live_users))
+        self.metrics.gauge("chat_queue_depth", "Messages queued and not yet acknowledged, by recipient.",
+                           ["recipient"], function=lambda: {(username,): len(mailbox.queue) for username, mailbox
+                                                            in list(self.messages.items()) if mailbox.queue})
+
+        # Restore what was stored before the last restart.
+        # Messages stored before they were numbered get the account's next ids.
+        _, accounts, pending_messages = self.storage.load()
+        for username, last_id in accounts.items():
+            self.accounts[username] = last_id
+            self.account_index.add(username)
+        for username, queue in pending_messages.items():
+            mailbox = self.mailbox(username)
+            for entry in queue:
+                msg_id, sender, text = unpack_message(entry)
+                msg_id = msg_id or self.accounts.get(username, 0) + 1
+                self.accounts[username] = max(self.accounts.get(username, 0), msg_id)
+                mailbox.put(app.Message(senderName=sender, message=text, recipientName=username, id=msg_id))
+
+    @instrumented
+    async def createAccount(self, request, context):
         """Create an account. (c|<username>)"""
 
-        print(f"user {request.username} requesting account creation")
+        self.log.debug("request", "Account creation requested", user=request.username)
 
         # Check if the username is already in use.
         if request.username in self.accounts:
-            msg = colored(
-                f"\nAccount {request.username} already exists!\n", "red")
-            print(f"\nUser {request.username} account creation rejected\n")
-            return app.ServerReply(message=msg)
+            self.log.info("account", "Account creation rejected, name taken", user=request.username)
+            return app.ServerReply(status=app.ACCOUNT_EXISTS, username=request.username)
 
         # Check that the username is a valid alphanumeric.
-        if not re.fullmatch("\w{2,20}", request.username):
-            msg = colored(
-                f"\nUsername must be alphanumeric and 2-20 characters!\n", "red")
-            print(f"\nUser {request.username} account creation rejected\n")
-            return app.ServerReply(message=msg)
+        if not re.fullmatch(r"\w{2,20}", request.username):
+            self.log.info("account", "Account creation rejected, invalid name", user=request.username)
+            return app.ServerReply(status=app.INVALID_USERNAME, username=request.username)
 
-        # Register the user.
-        self.accounts.append(request.username)
-        msg = colored(f"\nNew account created! User ID: {request.username}. Please log in.\n", "green")
-        print(f"\nUser {request.username} account created\n")
+        # Register the user, replying once it is stored.
+        self.accounts[request.username] = 0
+        self.account_index.add(request.username)
+        await self.persist((self.storage.create_account, request.username))
+        self.log.info("account", "Account created", user=request.username)
 
-        return app.ServerReply(message=msg)
+        return app.ServerReply(status=app.CREATED, username=request.username)
 
-    def logIn(self, request: app.Account, context):
+    @instrumented
+    async def logIn(self, request: app.Account, context):
         """Log in as a specific user. (l|<username>)"""
 
-        print(f"login as user {request.username} requested")
+        self.log.debug("request", "Login requested", user=request.username)
 
         # Check if the user is already logged in.
         if request.username in self.live_users:
-            msg = f"\nUser {request.username} already logged in. Please try again.\n"
-            msg = colored(msg, "red")
-            print(f"\nLogin as user {request.username} denied\n")
-            return app.LoginReply(success=False, message=msg)
+            self.log.info("session", "Login denied, already online", user=request.username)
+            return app.ServerReply(status=app.USER_ONLINE, username=request.username)
 
         # Check if the user has created an account.
         elif request.username not in self.accounts:
-            msg = f"\nUser {request.username} is not a valid user, please try again.\n"
-            msg = colored(msg, "red")
-            print(f"login as user {request.username} denied")
-            return app.LoginReply(success=False, message=msg)
-
-        # Log in as the given user.
-        else:
-            self.live_users.append(request.username)
-            msg = f"\nLogin successful - welcome back {request.username}!\n"
-            msg = colored(msg, "green")
-            print(f"\nLogin as user {request.username} completed.\n")
-            return app.LoginReply(success=True, message=msg, username=request.username)
-
-    def listAccounts(self, request, context):
-        """List all of the registered users. (u)"""
-
-        print(f"\nListing accounts\n")
+            self.log.info("session", "Login denied, no such user", user=request.username)
+            return app.ServerReply(status=app.NO_SUCH_USER, username=request.username)
 
-        # Output a list of users, and whether they are currently online.
-        if len(list(self.accounts)) > 0:
-            acc_str = "\n" + "\n".join([(colored(f"{u} ", "blue") +
-                                         (colored("(live)", "green") if u in self.live_users else ""))
-                                        for u in self.accounts]) + "\n"
-
-        # No registered users on the server.
+        # Log in as the given user; count is the messages its listener will receive first.
         else:
-            acc_str = colored("\nNo existing users!\n", "red")
-
-        return app.ServerReply(message=acc_str)
-
-    def filterAccounts(self, request, context):
-        """Filter accounts using a regex. (f|<filter_regex>)"""
+            self.live_users.add(request.username)
+            self.log.info("session", "Logged in", user=request.username)
+            return app.ServerReply(status=app.LOGGED_IN, username=request.username,
+                                   count=len(self.mailbox(request.username).queue))
+
+    async def listAccounts(self, request, context):
+        """Stream the registered users page by page, with whether they are online. (u|<page_size>)
+
+        Each page carries the token to resume after it if the stream is interrupted.
+        """
+
+        self.log.debug("request", "Listing accounts")
+        self.requests.inc("listAccounts")
+
+        try:
+            page_size, last_username = page_request(request.page_size or None, request.page_token)
+        except PageTokenError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # Pages are built one at a time as the client consumes the stream.
+        while True:
+            usernames, token = self.account_index.page(page_size, last_username)
+            page = app.AccountPage(accounts=[app.AccountInfo(username=u, live=u in self.live_users)
+                                             for u in usernames],
+                                   next_page_token=token or "")
+            self.bytes_sent.inc(amount=page.ByteSize())
+            yield page
+            if token is None:
+                break
+            last_username = usernames[-1]
+
+    @instrumented
+    async def filterAccounts(self, request, context):
+        """Filter a page of accounts using a regex. (f|<filter_regex>|<page_size>)
+
+        Matches come in username order, in pages with the same tokens as listAccounts.
+        """
+
+        self.log.debug("request", "Filtering accounts")
 
-        print(f"\nFiltering accounts.\n")
-
-        # Find a list of matching accounts.
         fltr = request.filter
-        def fun(x): return re.fullmatch(fltr, x)
-        filtered_accounts = list(filter(fun, self.accounts))
-
-        # Output a list of users, and whether they are currently online.
-        if len(list(filtered_accounts)) > 0:
-            acc_str = "\n" + "\n".join([(colored(f"{u} ", "blue") +
-                                         (colored("(live)", "green") if u in self.live_users else ""))
-                                        for u in filtered_accounts]) + "\n"
-
-        # No matching accounts on the server.
-        else:
-            acc_str = colored("\nNo matching users!\n", "red")
-
-        return app.ServerReply(message=acc_str)
-
-    def sendMessage(self, request: app.Message, context):
+        try:
+            page_size, last_username = page_request(request.page_size or None, request.page_token)
+        except PageTokenError as e:
+            return app.ServerReply(status=app.REJECTED, detail=str(e))
+
+        # Find a page of matching accounts.
+        # Matching blocks on the filter's worker pool, so it runs off the event loop.
+        try:
+            filtered_accounts, position = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.filters.match, fltr, self.account_index.usernames,
+                                        limit=page_size, start=self.account_index.position(last_username)))
+        except FilterError as e:
+            self.log.info("filter", "Filter rejected", filter=fltr, reason=e)
+            return app.ServerReply(status=app.REJECTED, detail=str(e))
+
+        # The matching users, whether they are currently online, and where the next page starts.
+        token = encode_token(page_size, filtered_accounts[-1]) if position is not None else ""
+        return app.ServerReply(status=app.ACCOUNTS, page_token=token,
+                               accounts=[app.AccountInfo(username=u, live=u in self.live_users)
+                                         for u in filtered_accounts])
+
+    @instrumented
+    async def sendMessage(self, request: app.Message, context):
         """Send a message to a specified other user. (s|<username>|<message>)"""
 
-        print(
-            f"user {request.senderName} requesting message to user {request.recipientName}")
+        self.log.debug("request", "Message requested", sender=request.senderName, recipient=request.recipientName)
 
         # Check if the recipient is a registered user and send message.
-        if request.recipientName in self.accounts:
-            if self.messages.get(request.recipientName):
-                self.messages[request.recipientName].append(request)
-            else:
-                self.messages[request.recipientName] = [request]
-            msg = colored("\nMessage sent!\n", "green")
-            print(f"user {request.senderName} message to user {request.recipientName} sent")
+        (delivered,) = await self.deliver_batch([request])
+        status = delivered.status
+        if status != app.NO_SUCH_USER:
+            self.log.info("message", "Message sent", sender=request.senderName, recipient=request.recipientName)
 
         # Recipient is not a registered user.
         else:
-            msg = colored(
-                "\nMessage failed to send! Verify recipient username.\n", "red")
-            print(
-                f"user {request.senderName} message to user {request.recipientName} denied")
-
-        return app.ServerReply(message=msg)
-
-    def deleteAccount(self, request: app.Account, context):
+            self.log.info("message", "Message denied, no such user", sender=request.senderName,
+                          recipient=request.recipientName)
+
+        return app.ServerReply(status=status, username=request.recipientName)
+
+    async def sendMessages(self, request_iterator, context):
+        """Send every message of a client stream, storing them stream_batch at a time."""
+
+        started = time.perf_counter()
+        statuses = []
+        batch = []
+        received = 0
+        async for msg in request_iterator:
+            batch.append(msg)
+            received += msg.ByteSize()
+            if len(batch) >= self.stream_batch:
+                statuses += await self.deliver_batch(batch)
+                batch = []
+        statuses += await self.deliver_batch(batch)
+        reply = self.batch_reply(statuses)
+        self.requests.inc("sendMessages")
+        self.request_seconds.observe(time.perf_counter() - started, "sendMessages")
+        self.bytes_received.inc(amount=received)
+        self.bytes_sent.inc(amount=reply.ByteSize())
+        return reply
+
+    @instrumented
+    async def sendMessageBatch(self, request: app.MessageBatch, context):
+        """Send a batch of messages in one call."""
+
+        return self.batch_reply(await self.deliver_batch(request.messages))
+
+    def number(self, message):
+        """Give a message its recipient's next id.
+
+        Returns its MessageStatus (QUEUED while the recipient is offline) and the
+        numbered Message, or None if there is no such recipient.
+        """
+
+        recipient = message.recipientName
+        if recipient not in self.accounts:
+            return app.MessageStatus(status=app.NO_SUCH_USER, recipient=recipient), None
+        msg_id = self.accounts[recipient] = self.accounts[recipient] + 1
+        status = app.SENT if recipient in self.live_users else app.QUEUED
+        return (app.MessageStatus(status=status, recipient=recipient),
+                app.Message(senderName=message.senderName, message=message.message, recipientName=recipient,
+                            id=msg_id))
+
+    async def deliver_batch(self, messages):
+        """Queue messages under their recipients' next ids until they acknowledge them.
+
+        Ids are handed out in one pass of the event loop, so no other call sees half of
+        the batch. The batch is stored with a single commit, and only then put in the
+        mailboxes. Returns the MessageStatus of each message.
+        """
+
+        numbered = [self.number(message) for message in messages]
+        await self.persist(*[(self.storage.enqueue, msg.recipientName,
+                              pack_message(msg.id, msg.senderName, msg.message))
+                             for _, msg in numbered if msg is not None])
+        for _, msg in numbered:
+            if msg is not None:
+                self.mailbox(msg.recipientName).put(msg)
+        return [status for status, _ in numbered]
+
+    def batch_reply(self, statuses):
+        """The BatchReply for the statuses of a batch's messages."""
+
+        sent = sum(status.status != app.NO_SUCH_USER for status in statuses)
+        self.log.info("message", "Batch sent", sent=sent, messages=len(statuses))
+        return app.BatchReply(statuses=statuses, sent=sent)
+
+    @instrumented
+    async def deleteAccount(self, request: app.Account, context):
         """Delete the current user's account. (d|<confirm_username>)"""
 
-        print(f"\nUser {request.username} requesting account deletion.\n")
+        self.log.debug("request", "Account deletion requested", user=request.username)
 
         # User can be deleted. Remove from associated data structures.
         if request.username in self.accounts:
-            self.accounts.remove(request.username)
-            if self.messages.get(request.username):
-                self.messages.pop(request.username)
-            msg = colored(
-                f"\nAccount {request.username} successfully deleted!\n", "green")
-            print(f"\nUser {request.username} account deleted.\n")
+            del self.accounts[request.username]
+            self.account_index.remove(request.username)
+            await self.persist((self.storage.delete_account, request.username))
+            self.mailbox(request.username).clear()
+            self.log.info("account", "Account deleted", user=request.username)
+            return app.ServerReply(status=app.DELETED, username=request.username)
 
         # User has already been deleted.
-        else:
-            msg = colored(f"\nYour account has already been deleted.\n", "red")
-            print(f"\nUser {request.username} account already deleted.\n")
-
-        return app.ServerReply(message=msg)
-
-    def listenForMessages(self, request_iterator, context):
-        """Stream run in a thread by client, listens for messages."""
-
-        print(f"user {request_iterator.username} listening stream opened")
-
-        # Polls while user is still online.
-        while context.is_active():
-
-            # Stream messages to the client one at a time.
-            if self.messages.get(request_iterator.username):
-                msg = self.messages[request_iterator.username].pop(0)
-                yield msg
-
-        # Disconnect the client.
-        self.live_users.remove(request_iterator.username)
-
-        print(f"user {request_iterator.username} disconnected")
+        self.log.info("account", "Account deletion rejected, no such user", user=request.username)
+        return app.ServerReply(status=app.NO_SUCH_USER, username=request.username)
+
+    def mailbox(self, username):
+        """The user's Mailbox, kept across deletion so a listener never waits on a stale one."""
+
+        return self.messages.setdefault(username, Mailbox())
+
+    async def persist(self, *calls):
+        """Make storage calls, given as (method, *args), in one commit on the storage thread.
+
+        The event loop serves other calls meanwhile. Storage writes run on a single
+        thread, so they are committed in the order they were made.
+        """
+
+        if calls:
+            await asyncio.get_running_loop().run_in_executor(self.storage_executor, self.write, calls)
+
+    def write(self, calls):
+        """Run storage calls in one transaction, timing it (on the storage thread)."""
+
+        started = time.perf_counter()
+        with self.storage.transaction():
+            for method, *args in calls:
+                method(*args)
+        self.persist_seconds.observe(time.perf_counter() - started, "storage")
+
+    @instrumented
+    async def acknowledge(self, request: app.Acknowledgement, context):
+        """Remove a user's messages up to and including an id the client has received.
+
+        Acknowledgements are cumulative, so a client sends one per batch of messages.
+        """
+
+        count = await self.drop_acknowledged(request.username, request.message_id)
+        return app.ServerReply(status=app.OK, username=request.username, count=count)
+
+    async def drop_acknowledged(self, username, msg_id):
+        """Drop acknowledged messages from the mailbox and storage; returns how many."""
+
+        count = self.mailbox(username).acknowledge(msg_id)
+        if count:
+            await self.persist((self.storage.dequeue, username, count),
+                               (self.storage.set_message_id, username, self.accounts.get(username, 0)))
+        return count
+
+    async def listenForMessages(self, request: app.ListenRequest, context):
+        """Stream run in a thread by client, listens for messages.
+
+        Messages up to resume_after count as acknowledged; newer ones are streamed
+        and stay stored until the client acknowledges them. The stream holds the
+        user's session: a client reopening a broken stream is online again without
+        logging in, and the session ends with the newest stream only.
+        """
+
+        self.log.debug("request", "Listening stream opened", user=request.username)
+        self.requests.inc("listenForMessages")
+
+        if request.username not in self.accounts:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "No such user.")
+        token = object()
+        self.listeners[request.username] = token
+        self.live_users.add(request.username)
+
+        # Stream messages to the client while the user is online; the wait is cancelled
+        # when the client goes away.
+        mailbox = self.mailbox(request.username)
+        last_id = request.resume_after
+        try:
+            await self.drop_acknowledged(request.username, last_id)
+            while True:
+                for msg in await mailbox.newer_than(last_id):
+                    yield msg
+                    last_id = msg.id
+                    self.messages_pushed.inc()
+                    self.bytes_sent.inc(amount=msg.ByteSize())
+
+        # Disconnect the client, unless a newer stream has taken over its session.
+        finally:
+            if self.listeners.get(request.username) is token:
+                del self.listeners[request.username]
+                self.live_users.discard(request.username)
+                self.log.info("session", "Disconnected", user=request.username)
 
 
 # Run the server upon file execution.
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=25))
-    rpc.add_ChatAppServicer_to_server(ChatApp(), server)
+async def serve():
+    server = grpc.aio.server()
+    chat_app = ChatApp(log_level=log_level)
+    rpc.add_ChatAppServicer_to_server(chat_app, server)
     server.add_insecure_port(ip + ':' + str(port))
-    server.start()
-    print(f"Server started, listening on port {port}.\n")
-    server.wait_for_termination()
+    await server.start()
+    metrics_server = MetricsServer(chat_app.metrics, metrics_port)
+    chat_app.log.info("server", "Server started", port=port, metrics=f"http://localhost:{metrics_port}/metrics")
+    try:
+        await server.wait_for_termination()
+    finally:
+        metrics_server.close()
+        chat_app.storage_executor.shutdown()
+        chat_app.log.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig()
-    serve()
+    asyncio.run(serve())
@@ -0,0 +1,137 @@
+import math
+import socket
+import threading
+import time
+from collections import deque
+from protocol import FrameReader, ProtocolError, encode_frame, PING
+
+
+class PhiAccrual():
+    """Phi-accrual suspicion level for one replica (Hayashibara et al.).
+
+    Instead of a yes/no timeout, phi grows with how unlikely the current silence is
+    given the heartbeat inter-arrival times seen so far: phi = 1 means about a 10%
+    chance the replica is still alive and merely slow, phi = 8 about one in 10^8.
+    """
+
+    def __init__(self, interval, window=100, min_std=None):
+        # Inter-arrival times of the latest heartbeats (seconds).
+        self.intervals = deque([interval], maxlen=window)
+
+        # Floor on the standard deviation, so a perfectly regular history is not over-confident.
+        self.min_std = min_std if min_std is not None else interval / 4
+
+        # When the last heartbeat arrived (time.monotonic()), None before the first.
+        self.last = None
+
+    def heartbeat(self, now):
+        """Record a heartbeat arriving at `now`."""
+
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    def phi(self, now):
+        """Suspicion level at `now`; 0 before the first heartbeat."""
+
+        if self.last is None:
+            return 0
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((x - mean) ** 2 for x in self.intervals) / len(self.intervals)
+        std = max(math.sqrt(variance), self.min_std)
+
+        # Logistic approximation of the normal tail, as used by Akka and Cassandra.
+        # The tail is computed in log space so long silences do not underflow.
+        y = (now - self.last - mean) / std
+        exponent = y * (1.5976 + 0.070566 * y * y)
+        return exponent / math.log(10) + math.log10(1 + math.exp(-exponent))
+
+
+class FailureDetector():
+    """Pings every replica from a background thread on connections of its own.
+
+    A replica is suspected once its phi exceeds `threshold`, once nothing has come
+    back for `timeout` seconds, or while it cannot be reached at all. Clients use it
+    to leave a dead or hung leader without waiting on their own requests.
+    """
+
+    def __init__(self, stop_event, interval=0.2, timeout=2, threshold=8):
+        # Stops the monitoring threads along with the client.
+        self.stop_event = stop_event
+
+        # Seconds between pings to each replica.
+        self.interval = interval
+
+        # Seconds of silence after which a replica is suspected regardless of phi.
+        self.timeout = timeout
+
+        # Phi above which a replica is suspected.
+        self.threshold = threshold
+
+        # Guards the dictionaries below.
+        self.lock = threading.Lock()
+
+        # A dictionary with (host, port) as keys and their PhiAccrual as values.
+        self.history = {}
+
+        # Replicas whose monitor currently has no connection to them.
+        self.down = set()
+
+    def watch(self, host, port):
+        """Start pinging a replica (once per address)."""
+
+        with self.lock:
+            if (host, port) in self.history:
+                return
+            self.history[(host, port)] = PhiAccrual(self.interval)
+        threading.Thread(target=self.monitor, args=(host, port), daemon=True).start()
+
+    def monitor(self, host, port):
+        """Ping one replica every interval, reconnecting while it is unreachable."""
+
+        nonce = 0
+        while not self.stop_event.is_set():
+            try:
+                with socket.create_connection((host, port), timeout=self.timeout) as connection:
+                    reader = FrameReader(connection)
+                    while not self.stop_event.is_set():
+                        nonce += 1
+                        sent = time.monotonic()
+                        connection.sendall(encode_frame(PING, nonce))
+
+                        # Skip late echoes of earlier pings.
+                        frame = reader.read_frame()
+                        while frame is not None and frame != (PING, [nonce]):
+                            frame = reader.read_frame()
+                        if frame is None:
+                            break
+                        with self.lock:
+                            self.history[(host, port)].heartbeat(time.monotonic())
+                            self.down.discard((host, port))
+                        self.stop_event.wait(max(0, self.interval - (time.monotonic() - sent)))
+            except (OSError, ProtocolError):
+                pass
+            with self.lock:
+                self.down.add((host, port))
+            self.stop_event.wait(self.interval)
+
+    def phi(self, host, port):
+        """Current suspicion level of a replica."""
+
+        with self.lock:
+            history = self.history.get((host, port))
+            return history.phi(time.monotonic()) if history else 0
+
+    def suspected(self, host, port):
+        """Whether a replica should be treated as failed."""
+
+        now = time.monotonic()
+        with self.lock:
+            history = self.history.get((host, port))
+            if history is None:
+                return False
+            if (host, port) in self.down:
+                return True
+            if history.last is None:
+                return False
+            return now - history.last > self.timeout or history.phi(now) > self.threshold
@@ -0,0 +1,182 @@
+import random
+import sys
+import threading
+import time
+from collections import deque
+from termcolor import colored
+
+# Severity levels; records below a logger's level are discarded by the caller at once.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+LEVEL_COLORS = {DEBUG: "blue", WARNING: "yellow", ERROR: "red"}
+
+
+def parse_level(level):
+    """A level from its name ("info") or number."""
+
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVELS[level.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown log level {level}, expected one of {', '.join(LEVELS)}")
+
+
+class RateLimit():
+    """Token bucket letting through `rate` records per second, in bursts of up to `burst`.
+
+    Updated without a lock: concurrent callers may let a record more or less through,
+    which is fine for logging and keeps the check off any lock.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+
+        # Records that may still go through, and when the bucket was last refilled.
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Logger():
+    """Leveled, sampled log records, written to a stream by a background thread.
+
+    Logging only filters the record and appends it to a deque, whose appends and pops
+    are atomic, so callers never take a lock or wait for the terminal. The writer
+    formats and writes whatever has gathered every `interval` seconds. Records beyond
+    `capacity` are dropped, so a slow stream costs records rather than memory.
+    Warnings and errors bypass sampling and rate limits.
+    """
+
+    def __init__(self, level=INFO, sampling=None, rate_limits=None, stream=None, interval=0.05,
+                 capacity=100000, color=True):
+        # Records below this level are discarded.
+        self.level = parse_level(level)
+
+        # A dictionary with categories as keys and the fraction of their records kept as values.
+        self.sampling = dict(sampling or {})
+
+        # A dictionary with categories as keys and a RateLimit for their records as values
+        # (given as records per second).
+        self.rate_limits = {category: RateLimit(rate) for category, rate in (rate_limits or {}).items()}
+
+        # Where records are written (None writes to whatever sys.stdout is at the time).
+        self.stream = stream
+
+        # Seconds the writer sleeps between batches.
+        self.interval = interval
+
+        # Maximum records waiting for the writer.
+        self.capacity = capacity
+
+        # Whether levels are colored as in the clients' output.
+        self.color = color
+
+        # Records waiting to be written, as (time, level, category, message, fields).
+        self.records = deque()
+
+        # Records dropped because the queue was full or their category over its rate
+        # limit (counted without a lock, so approximate), and how many were reported.
+        self.dropped = 0
+        self.limited = 0
+        self.reported = (0, 0)
+
+        # Set to make the writer flush at once.
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def log(self, level, category, message, **fields):
+        """Queue a record; `fields` are written after the message as key=value pairs."""
+
+        if level < self.level:
+            return
+        if level < WARNING:
+            fraction = self.sampling.get(category)
+            if fraction is not None and random.random() >= fraction:
+                return
+            limit = self.rate_limits.get(category)
+            if limit is not None and not limit.allow():
+                self.limited += 1
+                return
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+            return
+        self.records.append((time.time(), level, category, message, fields))
+
+    def debug(self, category, message, **fields):
+        self.log(DEBUG, category, message, **fields)
+
+    def info(self, category, message, **fields):
+        self.log(INFO, category, message, **fields)
+
+    def warning(self, category, message, **fields):
+        self.log(WARNING, category, message, **fields)
+
+    def error(self, category, message, **fields):
+        self.log(ERROR, category, message, **fields)
+
+    def format(self, record):
+        timestamp, level, category, message, fields = record
+        line = (time.strftime("%H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d} "
+                f"{LEVEL_NAMES.get(level, level):<7} {category:<11} {message}")
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if self.color and level in LEVEL_COLORS:
+            line = colored(line, LEVEL_COLORS[level])
+        return line + "\n"
+
+    def flush(self):
+        """Write every queued record (called by the writer thread)."""
+
+        lines = []
+        while True:
+            try:
+                lines.append(self.format(self.records.popleft()))
+            except IndexError:
+                break
+        dropped, limited = self.dropped, self.limited
+        if (dropped, limited) != self.reported:
+            lines.append(self.format((time.time(), WARNING, "logger", "Records skipped",
+                                      {"dropped": dropped - self.reported[0],
+                                       "rate_limited": limited - self.reported[1]})))
+            self.reported = (dropped, limited)
+        if lines:
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("".join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def write_loop(self):
+        while True:
+            closed = self.closed
+            self.flush()
+            if closed:
+                return
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def close(self):
+        """Write what is still queued and stop the writer."""
+
+        self.closed = True
+        self.wakeup.set()
+        self.writer.join()
@@ -0,0 +1,204 @@
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the default histogram buckets, from 100µs to 10s.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# Content type of the Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(pairs):
+    """{name="value",...} for a list of (name, value) pairs ("" when there are none)."""
+
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric():
+    """A named family of samples, one per combination of label values.
+
+    Updates take a short lock, so any thread may record; rendering copies the values
+    under the same lock.
+    """
+
+    # The Prometheus metric type.
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+
+        # Names of the labels, whose values are passed positionally when recording.
+        self.labels = tuple(labels)
+
+        # A dictionary with tuples of label values as keys and their current state as values.
+        self.values = {}
+
+        # Guards values.
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """(suffix, label pairs, value) of every sample, for render()."""
+
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield "", list(zip(self.labels, label_values)), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, pairs, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(pairs)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A total that only goes up, such as requests served or bytes sent."""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    With `function`, the value is computed when scraped instead: it returns a number,
+    or for a labelled gauge a dictionary with tuples of label values as keys. This keeps
+    state the server already holds (sessions, queue depths) off the request path.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+
+        # Computes the current values at scrape time (None if they are set instead).
+        self.function = function
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        values = self.function()
+        if not self.labels:
+            yield "", [], values
+            return
+        for label_values, value in values.items():
+            yield "", list(zip(self.labels, label_values)), value
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, with their count and sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+
+        # Upper bounds of the buckets, ascending (+Inf is implied).
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                # Per-bucket (not yet cumulative) counts, then the count of the +Inf bucket and the sum.
+                state = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, list(state)) for label_values, state in self.values.items()]
+        for label_values, state in values:
+            pairs = list(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                total += count
+                yield "_bucket", pairs + [("le", format_value(float(bound)))], total
+            yield "_count", pairs, total
+            yield "_sum", pairs, state[-1]
+
+
+class MetricsRegistry():
+    """The metrics of one server, rendered together for a scrape."""
+
+    def __init__(self):
+        # Registered metrics in the order they were created.
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """Every metric in the Prometheus text format."""
+
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class MetricsServer():
+    """Serves a registry at http://<host>:<port>/metrics from a daemon thread."""
+
+    def __init__(self, registry, port, host="localhost"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+        # The port actually bound (useful when asked for port 0).
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,344 @@
+import bisect
+import itertools
+import os
+import re
+from collections import deque
+from protocol import FIELD_LEN, encode_field
+
+# What happens to a message for an offline user whose queue is over budget.
+# reject: the message is refused and the sender is told so.
+# drop-oldest: the oldest queued messages are dropped to make room.
+# spill: the oldest queued messages move to a file on disk.
+OVERFLOW_POLICIES = ("reject", "drop-oldest", "spill")
+
+# Bytes read from a spill file at a time when streaming messages back.
+READ_CHUNK = 64 * 1024
+
+# Size of a spilled message's type tag and length prefix.
+SPILL_HEADER = 1 + FIELD_LEN.size
+
+
+def pack_message(msg_id, sender, text):
+    """Store a queued message as "id:sender:text" (usernames never contain ':').
+
+    Ids count up per recipient, so clients can acknowledge everything up to an id.
+    """
+
+    return f"{msg_id}:{sender}:{text}"
+
+
+def unpack_message(entry):
+    """Return (id, sender, text) of a queued message.
+
+    Entries queued before messages were numbered have id 0, and the oldest ones
+    have no separator and no sender either.
+    """
+
+    match = re.fullmatch(r"(\d+):(\w+):(.*)", entry, re.DOTALL)
+    if match:
+        return int(match[1]), match[2], match[3]
+    sender, sep, text = entry.partition(':')
+    if not sep or not re.fullmatch(r"\w+", sender):
+        return 0, "", entry
+    return 0, sender, text
+
+
+def message_id(entry):
+    """The id of a queued message, without unpacking the rest (0 if it has none)."""
+
+    head, sep, rest = entry.partition(':')
+    return int(head) if sep and head.isdigit() and ':' in rest else 0
+
+
+class QueueBudget():
+    """Memory limits shared by every pending queue, and where queues spill to."""
+
+    def __init__(self, spill_dir, queue_limit=1024 * 1024, memory_limit=64 * 1024 * 1024,
+                 policy="spill"):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+
+        # Directory holding spill files.
+        self.spill_dir = spill_dir
+
+        # Bytes a single recipient may keep queued in memory.
+        self.queue_limit = queue_limit
+
+        # Bytes all recipients together may keep queued in memory.
+        self.memory_limit = memory_limit
+
+        # One of OVERFLOW_POLICIES.
+        self.policy = policy
+
+        # Bytes currently queued in memory across all queues.
+        self.memory_bytes = 0
+
+        # Numbers spill files so a drained file is never reused.
+        self.file_ids = itertools.count()
+
+    def fits(self, queue_bytes, size):
+        """Whether `size` more bytes fit in a queue holding `queue_bytes` in memory."""
+
+        return (queue_bytes + size <= self.queue_limit
+                and self.memory_bytes + size <= self.memory_limit)
+
+    def spill_file(self, username):
+        """Create a new spill file for a user's queue."""
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return SpillFile(os.path.join(self.spill_dir, f"{username}.{next(self.file_ids)}.q"))
+
+
+class SpillFile():
+    """Append-only file of spilled messages, read back with positional reads.
+
+    Queues copied for a snapshot share the file; it is unlinked once the live queue
+    drains it, and the descriptor stays open until the last copy is gone.
+    """
+
+    def __init__(self, path):
+        # Location of the file (removed by discard()).
+        self.path = path
+
+        # Descriptor used for appends and positional reads.
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+
+        # Bytes written so far.
+        self.size = 0
+
+    def append(self, data):
+        """Append bytes and return the new size of the file."""
+
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+        return self.size
+
+    def read(self, offset, size):
+        """Read up to `size` bytes at `offset`."""
+
+        return os.pread(self.fd, size, offset)
+
+    def discard(self):
+        """Remove the file from disk; readers holding it keep working."""
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __del__(self):
+        os.close(self.fd)
+
+
+class PendingQueue():
+    """FIFO of messages for one offline user, spilling its oldest part to disk.
+
+    Messages on disk are always older than messages in memory, so iteration reads
+    the spill file first and then the in-memory deque.
+    """
+
+    def __init__(self, username, budget):
+        # The recipient the messages are queued for.
+        self.username = username
+
+        # Shared QueueBudget the queue accounts its memory to.
+        self.budget = budget
+
+        # Newest messages, kept in memory.
+        self.memory = deque()
+
+        # Bytes of messages in `memory`.
+        self.memory_bytes = 0
+
+        # SpillFile holding the oldest messages, or None.
+        self.spill = None
+
+        # Offset of the first message still queued in the spill file.
+        self.spill_start = 0
+
+        # Number of messages queued in the spill file.
+        self.spilled = 0
+
+        # Position in the spill file (counting every message written to it) of the first
+        # message still queued.
+        self.spill_first = 0
+
+        # Where each chunk written to the spill file starts, as (id of its first message,
+        # offset, position), so readers can seek to a message instead of scanning for it.
+        self.spill_index = []
+
+    def __len__(self):
+        return self.spilled + len(self.memory)
+
+    def __bool__(self):
+        return bool(self.spilled or self.memory)
+
+    def __iter__(self):
+        yield from self.read_spilled()
+        yield from self.memory
+
+    def newer_than(self, msg_id, max_bytes=None):
+        """The queued messages with an id above `msg_id`, oldest first.
+
+        With `max_bytes`, stops once the messages returned add up to that many bytes
+        (always returning at least one). Ids grow along the queue, so the in-memory part
+        is bisected and the spill file is only read from the chunk holding the first
+        newer message on, and only when every message in memory is newer.
+        """
+
+        first = self.first_newer(msg_id)
+        messages = itertools.islice(self.memory, first, None)
+        if first == 0 and self.spilled:
+            spilled = (msg for msg, _ in self.scan_spilled(start=self.seek(msg_id))
+                       if message_id(msg) > msg_id)
+            messages = itertools.chain(spilled, messages)
+
+        newer = []
+        size = 0
+        for msg in messages:
+            newer.append(msg)
+            size += len(msg)
+            if max_bytes is not None and size >= max_bytes:
+                break
+        return newer
+
+    def first_newer(self, msg_id):
+        """Index in `memory` of the first message with an id above `msg_id`."""
+
+        low, high = 0, len(self.memory)
+        while low < high:
+            middle = (low + high) // 2
+            if message_id(self.memory[middle]) <= msg_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def seek(self, msg_id):
+        """(offset, position) in the spill file to scan from for the messages above `msg_id`."""
+
+        i = bisect.bisect_left(self.spill_index, (msg_id + 1,)) - 1
+        if i < 0 or self.spill_index[i][2] < self.spill_first:
+            return self.spill_start, self.spill_first
+        return self.spill_index[i][1:]
+
+    def copy(self):
+        """A queue with the same contents; the spill file is shared, not copied."""
+
+        other = PendingQueue(self.username, self.budget)
+        other.memory = deque(self.memory)
+        other.memory_bytes = self.memory_bytes
+        other.spill = self.spill
+        other.spill_start = self.spill_start
+        other.spilled = self.spilled
+        other.spill_first = self.spill_first
+        other.spill_index = list(self.spill_index)
+        return other
+
+    def append(self, msg):
+        """Queue a message, spilling older ones if the queue or all queues exceed the budget."""
+
+        self.memory.append(msg)
+        self.memory_bytes += len(msg)
+        self.budget.memory_bytes += len(msg)
+
+        if self.budget.policy == "spill":
+            if self.budget.memory_bytes > self.budget.memory_limit:
+                self.spill_oldest(0)
+            elif self.memory_bytes > self.budget.queue_limit:
+                self.spill_oldest(self.budget.queue_limit // 2)
+
+    def spill_oldest(self, keep_bytes):
+        """Move the oldest in-memory messages to disk until at most `keep_bytes` remain."""
+
+        if self.spill is None:
+            self.spill = self.budget.spill_file(self.username)
+            self.spill_start = 0
+            self.spill_first = 0
+            self.spill_index = []
+
+        if self.memory:
+            entry = (message_id(self.memory[0]), self.spill.size, self.spill_first + self.spilled)
+        chunk = []
+        while self.memory and self.memory_bytes > keep_bytes:
+            msg = self.memory.popleft()
+            self.memory_bytes -= len(msg)
+            self.budget.memory_bytes -= len(msg)
+            chunk.append(encode_field(msg))
+            self.spilled += 1
+        if chunk:
+            self.spill_index.append(entry)
+            self.spill.append(b"".join(chunk))
+
+    def read_spilled(self, limit=None):
+        """Yield up to `limit` spilled messages, oldest first."""
+
+        return (msg for msg, _ in self.scan_spilled(limit))
+
+    def scan_spilled(self, limit=None, start=None):
+        """Yield spilled messages with the offset just past each, reading in chunks.
+
+        `start` is an (offset, position) from seek() to begin at instead of the oldest message.
+        """
+
+        pos, first = start or (self.spill_start, self.spill_first)
+        count = self.spilled - (first - self.spill_first)
+        if limit is not None:
+            count = min(limit, count)
+        buf = b""
+        i = 0
+        for _ in range(count):
+            while True:
+                if len(buf) - i >= SPILL_HEADER:
+                    (size,) = FIELD_LEN.unpack_from(buf, i + 1)
+                    if len(buf) - i >= SPILL_HEADER + size:
+                        break
+                    need = SPILL_HEADER + size
+                else:
+                    need = SPILL_HEADER
+                more = self.spill.read(pos + len(buf), max(need, READ_CHUNK))
+                if not more:
+                    raise OSError(f"Spill file {self.spill.path} is truncated")
+                buf = buf[i:] + more
+                pos += i
+                i = 0
+            start = i + SPILL_HEADER
+            i = start + size
+            yield buf[start:i].decode('UTF-8'), pos + i
+
+    def drop(self, count):
+        """Remove the `count` oldest messages (spilled ones first)."""
+
+        from_disk = min(count, self.spilled)
+        if from_disk:
+            for _, end in self.scan_spilled(from_disk):
+                pass
+            self.spill_start = end
+            self.spill_first += from_disk
+            self.spilled -= from_disk
+            while self.spill_index and self.spill_index[0][2] < self.spill_first:
+                self.spill_index.pop(0)
+            if not self.spilled:
+                self.spill.discard()
+                self.spill = None
+                self.spill_start = 0
+                self.spill_first = 0
+
+        for _ in range(min(count - from_disk, len(self.memory))):
+            msg = self.memory.popleft()
+            self.memory_bytes -= len(msg)
+            self.budget.memory_bytes -= len(msg)
+
+    def release(self):
+        """Give back the queue's memory budget and spill file when it is deleted.
+
+        The messages themselves are left in place for a snapshot that may still read them.
+        """
+
+        self.budget.memory_bytes -= self.memory_bytes
+        self.memory_bytes = 0
+        if self.spill is not None:
+            self.spill.discard()
@@ -0,0 +1,92 @@
+import base64
+import bisect
+
+# Accounts per page when a client does not ask for a size.
+DEFAULT_PAGE_SIZE = 100
+
+# Largest page a client may ask for.
+MAX_PAGE_SIZE = 1000
+
+
+class PageTokenError(Exception):
+    """Raised when a continuation token or page size cannot be used."""
+
+
+def encode_token(page_size, last_username):
+    """Opaque continuation token resuming a listing after `last_username`."""
+
+    raw = f"{page_size}:{last_username}".encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_token(token):
+    """Return (page_size, last_username) from a token made by encode_token."""
+
+    try:
+        page_size, last_username = base64.urlsafe_b64decode(token.encode('ascii')).decode('UTF-8').split(':', 1)
+        return int(page_size), last_username
+    except ValueError:
+        raise PageTokenError("Invalid page token.")
+
+
+def page_request(page_size=None, token=None):
+    """Resolve a client's page size and token into (page_size, last_username).
+
+    An explicit page size overrides the one carried by the token.
+    """
+
+    last_username = ""
+    token_size = None
+    if token:
+        token_size, last_username = decode_token(token)
+    if page_size is None or page_size == "":
+        page_size = token_size if token_size is not None else DEFAULT_PAGE_SIZE
+    try:
+        page_size = int(page_size)
+    except ValueError:
+        raise PageTokenError("Page size must be a number.")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise PageTokenError(f"Page size must be between 1 and {MAX_PAGE_SIZE}.")
+    return page_size, last_username
+
+
+class AccountIndex():
+    """Sorted list of usernames, so listings can resume from a username in O(log n).
+
+    Creation order cannot be resumed once accounts are deleted, so pages are in
+    username order.
+    """
+
+    def __init__(self, usernames=()):
+        # Every username, sorted.
+        self.usernames = sorted(usernames)
+
+    def add(self, username):
+        i = bisect.bisect_left(self.usernames, username)
+        if i == len(self.usernames) or self.usernames[i] != username:
+            self.usernames.insert(i, username)
+
+    def remove(self, username):
+        i = bisect.bisect_left(self.usernames, username)
+        if i < len(self.usernames) and self.usernames[i] == username:
+            del self.usernames[i]
+
+    def page(self, page_size, last_username=""):
+        """Return (usernames, next_token) for the page after `last_username`.
+
+        next_token is None on the last page.
+        """
+
+        start = bisect.bisect_right(self.usernames, last_username)
+        page = self.usernames[start:start + page_size]
+        if start + page_size < len(self.usernames):
+            return page, encode_token(page_size, page[-1])
+        return page, None
+
+    def position(self, last_username=""):
+        """Index in `usernames` of the first username after `last_username`."""
+
+        return bisect.bisect_right(self.usernames, last_username)
+
+    def __len__(self):
+        return len(self.usernames)
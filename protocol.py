@@ -0,0 +1,245 @@
+import struct
+from collections import namedtuple
+
+# Frame header: payload length (4 bytes, big endian) followed by the opcode.
+HEADER = struct.Struct("!IB")
+
+# Length prefix for string and bytes fields.
+FIELD_LEN = struct.Struct("!I")
+
+# Payload of an integer field.
+FIELD_INT = struct.Struct("!q")
+
+# Frames larger than this are rejected instead of buffered.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Field type tags.
+TYPE_STR = ord('s')
+TYPE_INT = ord('i')
+TYPE_BYTES = ord('b')
+
+# Client requests.
+CREATE = 'c'
+LOGIN = 'l'
+LIST = 'u'
+SEND = 's'
+DELETE = 'd'
+FILTER = 'f'
+HELP = 'h'
+
+# A client acknowledging every pushed message up to and including an id; never replied to.
+ACKNOWLEDGE = 'a'
+
+# Server responses: the reply to a request (see reply_fields), and a message pushed to a
+# user as (id, sender, text). A message stays queued until the client acknowledges it.
+REPLY = 'r'
+MESSAGE = 'm'
+
+# Reply status codes, numbered as the Status enum of grpcApp/proto/chatapp.proto.
+# Servers only report what happened; clients turn the status into text.
+OK = 0
+CREATED = 1
+LOGGED_IN = 2
+DELETED = 3
+SENT = 4
+QUEUED = 5
+ACCOUNTS = 6
+USAGE = 7
+INVALID_ARGUMENTS = 10
+NOT_LOGGED_IN = 11
+ALREADY_LOGGED_IN = 12
+ACCOUNT_EXISTS = 13
+INVALID_USERNAME = 14
+NO_SUCH_USER = 15
+USER_ONLINE = 16
+NOT_YOUR_ACCOUNT = 17
+QUEUE_FULL = 18
+REJECTED = 19
+UNKNOWN_REQUEST = 20
+FAILED = 21
+UNAVAILABLE = 22
+
+# Replication between servers: the leader's handshake (with where its log changes term),
+# a shipped log record with its term, a heartbeat, and a follower's acknowledgement of
+# the newest record it holds.
+REPLICATE = 'R'
+APPEND = 'A'
+HEARTBEAT = 'B'
+ACK = 'K'
+
+# A chunk of the leader's snapshot for a follower the log cannot catch up (empty when
+# done, along with the term of the snapshot's record).
+INSTALL = 'I'
+
+# Leader election: a candidate's request for a vote.
+VOTE = 'V'
+
+# Sent instead of a reply by a replica that is not the leader, naming the leader if known.
+REDIRECT = 'T'
+
+# A client's failure detector probing a replica; any replica echoes its nonce in a REPLY.
+PING = 'P'
+
+# Sharding: a message to a user on another shard, sent to the sender's shard, which
+# answers with a RELAY frame naming the logged-in sender.
+RELAY = 'F'
+
+# Sharding: a relayed message delivered by the recipient's shard.
+DELIVER = 'D'
+
+# Sharding: move an account and its pending messages out of a shard, in chunks.
+EXPORT = 'E'
+
+# Sharding: receive an exported account and a chunk of its pending messages.
+IMPORT = 'N'
+
+# Sharding: a router proving it holds the shared peer secret, which opens the opcodes
+# below on its connection; clients never get to send them.
+AUTHENTICATE = 'Y'
+PEER_ONLY = (RELAY, DELIVER, EXPORT, IMPORT)
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a frame that cannot be decoded."""
+
+
+def encode_field(value):
+    """Encode a single str, int or bytes field with its type tag."""
+
+    if isinstance(value, str):
+        data = value.encode('UTF-8')
+        return bytes((TYPE_STR,)) + FIELD_LEN.pack(len(data)) + data
+    if isinstance(value, (bool, int)):
+        return bytes((TYPE_INT,)) + FIELD_INT.pack(int(value))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes((TYPE_BYTES,)) + FIELD_LEN.pack(len(value)) + bytes(value)
+    raise TypeError(f"Cannot encode field of type {type(value).__name__}")
+
+
+def encode_frame(op_code, *fields):
+    """Encode an opcode and its typed fields as one length-prefixed frame."""
+
+    body = b"".join(encode_field(field) for field in fields)
+    if len(body) + 1 > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(body) + 1} bytes exceeds limit")
+    return HEADER.pack(len(body) + 1, ord(op_code)) + body
+
+
+def encode_reply(reply):
+    """Encode a handler's reply (a tuple of fields from reply_fields) as a REPLY frame.
+
+    A reply that is already an encoded frame is passed through.
+    """
+
+    if isinstance(reply, bytes):
+        return reply
+    if isinstance(reply, tuple):
+        return encode_frame(REPLY, *reply)
+    return encode_frame(REPLY, reply)
+
+
+# A decoded reply, with the same attribute names as chatapp.proto's ServerReply.
+Reply = namedtuple("Reply", "status username detail count page_token accounts")
+
+# One listed account, like chatapp.proto's AccountInfo.
+AccountInfo = namedtuple("AccountInfo", "username live")
+
+
+def reply_fields(status, username="", detail="", count=0, page_token="", accounts=()):
+    """A handler's typed reply as REPLY frame fields.
+
+    The layout follows ServerReply: the status, the account it concerns, why a
+    request was rejected, a count (e.g. messages dropped), the next page token,
+    then each listed account as a username and live pair.
+    """
+
+    fields = (status, username, detail, count, page_token)
+    return fields + tuple(field for username, live in accounts for field in (username, int(live)))
+
+
+def parse_reply(fields):
+    """Turn the fields of a REPLY frame back into a Reply."""
+
+    status, username, detail, count, page_token = fields[:5]
+    accounts = [AccountInfo(username, bool(live)) for username, live in zip(fields[5::2], fields[6::2])]
+    return Reply(status, username, detail, count, page_token, accounts)
+
+
+def decode_fields(body):
+    """Decode the typed fields that follow the opcode of a frame."""
+
+    fields = []
+    view = memoryview(body)
+    pos = 0
+    while pos < len(view):
+        tag = view[pos]
+        pos += 1
+        if tag == TYPE_INT:
+            if pos + FIELD_INT.size > len(view):
+                raise ProtocolError("Truncated integer field")
+            fields.append(FIELD_INT.unpack_from(view, pos)[0])
+            pos += FIELD_INT.size
+        elif tag in (TYPE_STR, TYPE_BYTES):
+            if pos + FIELD_LEN.size > len(view):
+                raise ProtocolError("Truncated field length")
+            (size,) = FIELD_LEN.unpack_from(view, pos)
+            pos += FIELD_LEN.size
+            if pos + size > len(view):
+                raise ProtocolError("Truncated field")
+            data = bytes(view[pos:pos + size])
+            fields.append(data.decode('UTF-8') if tag == TYPE_STR else data)
+            pos += size
+        else:
+            raise ProtocolError(f"Unknown field type {tag}")
+    return fields
+
+
+class FrameReader():
+    """Buffers bytes from a socket and splits them into complete frames."""
+
+    def __init__(self, connection=None, bufsize=65536):
+        # The socket frames are read from (None when fed by an event loop).
+        self.connection = connection
+
+        # How many bytes to ask for per recv call.
+        self.bufsize = bufsize
+
+        # Bytes received but not yet consumed as a complete frame.
+        self.buffer = bytearray()
+
+        # Total bytes received, fed or read from the socket.
+        self.received = 0
+
+    def feed(self, data):
+        """Append bytes received elsewhere (e.g. by a selector loop)."""
+
+        self.buffer += data
+        self.received += len(data)
+
+    def next_frame(self):
+        """Pop one complete frame from the buffer as (op_code, fields), or None."""
+
+        if len(self.buffer) < HEADER.size:
+            return None
+        length, op = HEADER.unpack_from(self.buffer)
+        if length < 1 or length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Invalid frame length {length}")
+        end = HEADER.size + length - 1
+        if len(self.buffer) < end:
+            return None
+        fields = decode_fields(bytes(self.buffer[HEADER.size:end]))
+        del self.buffer[:end]
+        return chr(op), fields
+
+    def read_frame(self):
+        """Block until a complete frame arrives; return None once the peer closes."""
+
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            data = self.connection.recv(self.bufsize)
+            if not data:
+                return None
+            self.buffer += data
+            self.received += len(data)
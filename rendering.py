@@ -0,0 +1,129 @@
+from termcolor import colored
+from protocol import (CREATE, LOGIN, LIST, SEND, DELETE, FILTER, OK, CREATED, LOGGED_IN, DELETED, SENT,
+                      QUEUED, ACCOUNTS, USAGE, INVALID_ARGUMENTS, NOT_LOGGED_IN, ALREADY_LOGGED_IN,
+                      ACCOUNT_EXISTS, INVALID_USERNAME, NO_SUCH_USER, USER_ONLINE, NOT_YOUR_ACCOUNT,
+                      QUEUE_FULL, REJECTED, UNKNOWN_REQUEST, FAILED, UNAVAILABLE)
+
+# Commands of the gRPC client that send several messages in one call.
+SEND_BATCH = 'b'
+SEND_FILE = 'm'
+
+# The syntax of each command, shown when it is given the wrong arguments.
+COMMANDS = {
+    CREATE: "c|<username>",
+    LOGIN: "l|<username>",
+    SEND: "s|<recipient_username>|<message>",
+    FILTER: "f|<filter_regex>|<page_size>",
+    DELETE: "d|<confirm_username>",
+    LIST: "u|<page_size>",
+    SEND_BATCH: "b|<recipient_username>,<recipient_username>,...|<message>",
+    SEND_FILE: "m|<path>",
+}
+
+
+def render_help(header="\nUsage help below:\n", batches=False):
+    """The list of commands, under `header` (with the batch commands if `batches`)."""
+
+    msg = header
+    msg += "\nCreate an account.        c|<username>"
+    msg += "\nLog into an account.      l|<username>"
+    msg += "\nSend a message.           s|<recipient_username>|<message>"
+    if batches:
+        msg += "\nSend to several users.    b|<recipient_username>,<recipient_username>,...|<message>"
+        msg += "\nSend a file's messages.   m|<path> (one <recipient_username>|<message> per line)"
+    msg += "\nFilter accounts.          f|<filter_regex>|<page_size>"
+    msg += "\nDelete your account.      d|<confirm_username>"
+    msg += "\nList users and names.     u|<page_size>"
+    msg += "\nUsage help (this page).   h\n"
+    return colored(msg, 'yellow')
+
+
+def render_accounts(accounts):
+    """Text listing accounts (protocol or chatapp AccountInfo), one per line."""
+
+    return "\n" + "\n".join([(colored(f"{a.username} ", "blue") + (colored("(live)", "green") if a.live else ""))
+                              for a in accounts]) + "\n"
+
+
+def render_batch(reply):
+    """Text for a chatapp BatchReply: how many messages went out, and which recipients do not exist."""
+
+    msg = colored(f"\n{reply.sent} of {len(reply.statuses)} message(s) sent.\n", "green")
+    missing = [status.recipient for status in reply.statuses if status.status == NO_SUCH_USER]
+    if missing:
+        msg += colored(f"No such user: {', '.join(missing)}. Verify recipient usernames.\n", "red")
+    return msg
+
+
+def render_message(sender, text):
+    """A message pushed by the server, prefixed by its sender when there is one."""
+
+    if not sender:
+        return text
+    return colored(f"[{sender}] ", "grey") + text
+
+
+def render_reply(op_code, reply):
+    """Text shown for a server's reply (a protocol.Reply or a chatapp ServerReply) to `op_code`."""
+
+    status = reply.status
+    username = reply.username
+
+    if status == CREATED:
+        return colored(f"\nNew account created! User ID: {username}. Please log in.\n", "green")
+    if status == LOGGED_IN:
+        msg = colored(f"\nLogin successful - welcome back {username}!\n", "green")
+        if reply.count:
+            msg += colored(f"{reply.count} pending message(s) delivered.\n", "green")
+        return msg
+    if status == DELETED:
+        return colored(f"\nAccount {username} has been deleted.\n", "green")
+    if status == SENT:
+        return colored(f"\nMessage sent to {username}.\n", "green")
+    if status == QUEUED:
+        msg = colored(f"\nMessage will be delivered to {username} after the account is online.\n", "green")
+        if reply.count:
+            msg += colored(f"{reply.count} older undelivered message(s) were dropped to make room.\n", "yellow")
+        return msg
+    if status == ACCOUNTS:
+        if reply.accounts:
+            return render_accounts(reply.accounts)
+        if op_code == FILTER:
+            return colored("\nNo matching users!\n", "red")
+        return colored("\nNo existing users!\n", "red")
+    if status == USAGE:
+        return render_help()
+    if status == OK:
+        return ""
+
+    if status == INVALID_ARGUMENTS:
+        msg = f"\nInvalid arguments! Usage: {COMMANDS.get(op_code, 'h')}\n"
+    elif status == NOT_LOGGED_IN:
+        msg = "\nPlease log in to send a message!\n" if op_code == SEND else "\nPlease log in first!\n"
+    elif status == ALREADY_LOGGED_IN:
+        msg = "\nPlease disconnect first!\n" if op_code == CREATE else "\nPlease log out first!\n"
+    elif status == ACCOUNT_EXISTS:
+        msg = f"\nAccount {username} already exists!\n"
+    elif status == INVALID_USERNAME:
+        msg = "\nUsername must be alphanumeric and 2-20 characters!\n"
+    elif status == NO_SUCH_USER and op_code == SEND:
+        msg = "\nMessage failed to send! Verify recipient username.\n"
+    elif status == NO_SUCH_USER and op_code == DELETE:
+        msg = "\nIncorrect username for confirmation.\n"
+    elif status == NO_SUCH_USER:
+        msg = f"\nUser {username} does not exist. Please create an account.\n"
+    elif status == USER_ONLINE:
+        msg = f"\nUser {username} already logged in. Please try again.\n"
+    elif status == NOT_YOUR_ACCOUNT:
+        msg = "\nYou can only delete your own account.\n"
+    elif status == QUEUE_FULL:
+        msg = f"\nMessage rejected! {username} has too many undelivered messages.\n"
+    elif status == UNKNOWN_REQUEST:
+        msg = "\nInvalid request, use \"h\" for usage help!\n"
+    elif status == UNAVAILABLE:
+        msg = f"\n{reply.detail or 'Server unavailable'}, please try again.\n"
+    elif status in (REJECTED, FAILED):
+        msg = f"\n{reply.detail or 'Request failed.'}\n"
+    else:
+        msg = f"\nUnexpected reply status {status}.\n"
+    return colored(msg, "red")
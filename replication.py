@@ -0,0 +1,341 @@
+import socket
+import threading
+import itertools
+from collections import deque
+import time
+from protocol import FrameReader, ProtocolError, encode_frame, APPEND, ACK, HEARTBEAT, INSTALL, REPLICATE
+from wal import RECORD
+
+# Bytes of log records shipped to a follower before waiting for its acknowledgement.
+BATCH_BYTES = 1024 * 1024
+
+# Bytes of snapshot sent per INSTALL frame.
+CHUNK_BYTES = 1024 * 1024
+
+
+class ReplicationError(Exception):
+    """Raised when a backup cannot be brought up to date from the log."""
+
+
+class QuorumTimeout(Exception):
+    """Raised when the write quorum has not acknowledged a logged mutation in time."""
+
+
+def parse_replica(address, default_host):
+    """Turn "host:port" or "port" into a (host, port) pair."""
+
+    host, _, port = address.rpartition(':')
+    return (host or default_host, int(port))
+
+
+class ReplicationLog():
+    """The newest log records, encoded as APPEND frames for shipping to followers.
+
+    Records are published in sequence order while the server's mutation lock is held,
+    so the window is always contiguous. Followers' acknowledgements decide when a
+    record is held by the write quorum and its request may be answered.
+    """
+
+    def __init__(self, last_seq, capacity=100000, quorum=1, commit_timeout=1):
+        # Signals links waiting for new records and requests waiting for a quorum.
+        self.cond = threading.Condition()
+
+        # (seq, frame, time published) for the newest `capacity` records.
+        self.records = deque(maxlen=capacity)
+
+        # Sequence number of the newest record published.
+        self.last_seq = last_seq
+
+        # Replicas, counting this one, that must hold a record before it is acknowledged.
+        self.quorum = quorum
+
+        # Seconds a request waits for the quorum before it is answered as unavailable.
+        self.commit_timeout = commit_timeout
+
+        # Newest record acknowledged by each follower, by (host, port).
+        self.acks = {}
+
+        # Newest record held by the write quorum.
+        self.committed_seq = last_seq
+
+        # First record of the current term. Older records only commit along with a
+        # newer one, since a quorum holding them may still be overwritten by another leader.
+        self.term_start = 0
+
+        # Called after committed_seq advances (e.g. to wake an event loop).
+        self.on_commit = None
+
+    def reset(self, seq):
+        """Start over after record `seq` (once a snapshot has replaced all state)."""
+
+        with self.cond:
+            self.records.clear()
+            self.last_seq = seq
+            self.committed_seq = seq
+
+    def reset_acks(self):
+        """Forget followers' positions when a new term starts.
+
+        Records from earlier terms that have not committed stay uncommitted until a
+        record of the new term reaches the quorum.
+        """
+
+        with self.cond:
+            self.acks = {}
+            self.term_start = self.last_seq + 1
+
+    def publish(self, seq, term, op, fields):
+        """Add a record that has just been applied, logged in `term`."""
+
+        frame = encode_frame(APPEND, seq, term, op, *fields)
+        with self.cond:
+            self.records.append((seq, frame, time.monotonic()))
+            self.last_seq = seq
+            if self.quorum <= 1:
+                self.committed_seq = seq
+            self.cond.notify_all()
+
+    def ack(self, replica, seq):
+        """Record a follower's acknowledgement and advance the committed record."""
+
+        with self.cond:
+            self.acks[replica] = seq
+            acked = sorted(self.acks.values(), reverse=True)
+            if self.quorum <= 1 or len(acked) < self.quorum - 1:
+                return
+            committed = min(acked[self.quorum - 2], self.last_seq)
+            if committed <= self.committed_seq or committed < self.term_start:
+                return
+            self.committed_seq = committed
+            self.cond.notify_all()
+        if self.on_commit:
+            self.on_commit()
+
+    def is_committed(self, seq):
+        """Whether the write quorum holds record `seq`."""
+
+        return self.committed_seq >= seq
+
+    def is_expired(self, seq):
+        """Whether record `seq` has waited `commit_timeout` without reaching the quorum."""
+
+        if self.committed_seq >= seq:
+            return False
+        with self.cond:
+            if not self.records or seq < self.records[0][0]:
+                return True
+            published = self.records[seq - self.records[0][0]][2]
+        return time.monotonic() - published >= self.commit_timeout
+
+    def wait_committed(self, seq):
+        """Block until the quorum holds record `seq`; False if the wait timed out."""
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.committed_seq >= seq, timeout=self.commit_timeout)
+            return self.committed_seq >= seq
+
+    def after(self, seq, timeout, limit=BATCH_BYTES):
+        """Return frames for records newer than `seq`, up to about `limit` bytes.
+
+        Waits up to `timeout` seconds for a record and returns [] if none arrives.
+        Returns None when `seq` is older than the window, so the records must be read
+        from the write-ahead log instead.
+        """
+
+        with self.cond:
+            if self.last_seq <= seq:
+                self.cond.wait(timeout)
+            if self.last_seq <= seq:
+                return []
+            if not self.records or self.records[0][0] > seq + 1:
+                return None
+            frames = []
+            size = 0
+            for _, frame, _ in itertools.islice(self.records, seq + 1 - self.records[0][0], None):
+                frames.append(frame)
+                size += len(frame)
+                if size >= limit:
+                    break
+            return frames
+
+
+class ReplicaLink():
+    """Ships the leader's log to one follower, resuming from the follower's last record.
+
+    The handshake describes the leader's log by where its terms change. The follower
+    answers with an ACK carrying the newest record both logs share, after discarding
+    any records of its own beyond it, and answers every batch or heartbeat with the
+    newest record it has applied and logged and its term, so a reconnecting follower
+    continues exactly where the logs agree and a deposed leader learns of the newer
+    term. The link stops once its term is over.
+
+    Every acknowledgement counts towards the write quorum. Links are independent, so
+    acks from followers beyond the quorum still arrive in the background and keep
+    each follower's health score current.
+    """
+
+    def __init__(self, server, host, port, term, retry_interval=0.1, ack_timeout=1, install_timeout=60):
+        # The leading Server whose log is shipped.
+        self.server = server
+
+        # Address of the follower.
+        self.host = host
+        self.port = port
+
+        # The term the leader was elected for.
+        self.term = term
+
+        # Seconds between connection attempts while the backup is down.
+        self.retry_interval = retry_interval
+
+        # Seconds to wait for a batch to be acknowledged before reconnecting.
+        self.ack_timeout = ack_timeout
+
+        # Seconds a follower may take to load a snapshot before we reconnect.
+        self.install_timeout = install_timeout
+
+        # Newest record the follower has acknowledged.
+        self.acked_seq = 0
+
+        # When the follower last acknowledged anything (time.monotonic()).
+        self.last_ack = 0
+
+        # Whether the follower is currently connected and receiving records.
+        self.connected = False
+
+        # Smoothed seconds from sending a batch to its acknowledgement.
+        self.latency = 0
+
+        # Weight of the newest sample in the smoothed latency.
+        self.smoothing = 0.2
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Reconnect and ship records until the server stops or the term ends."""
+
+        while self.active():
+            try:
+                connection = socket.create_connection((self.host, self.port), timeout=self.ack_timeout)
+            except OSError:
+                self.server.stop_event.wait(self.retry_interval)
+                continue
+            try:
+                self.ship(connection)
+            except (OSError, ProtocolError, ReplicationError) as e:
+                self.server.log.warning("replication", "Replication to follower interrupted",
+                                        follower=f"{self.host}:{self.port}", error=e)
+            finally:
+                self.connected = False
+                connection.close()
+            self.server.stop_event.wait(self.retry_interval)
+
+    def active(self):
+        """Whether the link's term is still being led by this server."""
+
+        return not self.server.stop_event.is_set() and self.server.election.is_leader(self.term)
+
+    def ship(self, connection):
+        """Send every record the follower is missing, then keep it up to date."""
+
+        reader = FrameReader(connection)
+        starts = [value for start in self.server.wal.term_starts() for value in start]
+        connection.sendall(encode_frame(REPLICATE, self.server.ip, self.server.port, self.term,
+                                        self.server.last_seq(), *starts))
+        self.acked_seq = self.read_ack(reader)
+        self.connected = True
+        self.server.log.info("replication", "Follower connected", follower=f"{self.host}:{self.port}",
+                             seq=self.acked_seq)
+
+        # A follower whose log shares no record with ours after its snapshot starts over.
+        if self.acked_seq < 0:
+            self.acked_seq = self.send_snapshot(connection, reader)
+        self.server.replication.ack((self.host, self.port), self.acked_seq)
+
+        while self.active():
+            frames = self.server.replication.after(self.acked_seq, timeout=self.server.election.heartbeat_interval)
+            if frames is None:
+                frames = self.read_wal(self.acked_seq)
+                if frames is None:
+                    # The log was compacted past the follower: send the snapshot, then the tail.
+                    self.acked_seq = self.send_snapshot(connection, reader)
+                    continue
+                if not frames:
+                    raise ReplicationError(f"log does not reach record {self.acked_seq + 1} yet")
+            if not frames:
+                frames = [encode_frame(HEARTBEAT, self.term)]
+            sent = time.monotonic()
+            connection.sendall(b"".join(frames))
+            self.acked_seq = self.read_ack(reader)
+            self.latency += self.smoothing * (self.last_ack - sent - self.latency)
+            self.server.replication.ack((self.host, self.port), self.acked_seq)
+
+    def health(self):
+        """Score the follower for monitoring: None while disconnected, otherwise
+        (records behind the leader, smoothed ack latency in seconds)."""
+
+        if not self.connected:
+            return None
+        return max(self.server.replication.last_seq - self.acked_seq, 0), self.latency
+
+    def read_wal(self, after, limit=BATCH_BYTES):
+        """Read records newer than `after` from the write-ahead log on disk.
+
+        Returns None if a snapshot has compacted the log past `after`.
+        """
+
+        frames = []
+        size = 0
+        for seq, term, op, fields in self.server.wal.scan(after):
+            if seq != after + len(frames) + 1:
+                return None
+            frame = encode_frame(APPEND, seq, term, op, *fields)
+            frames.append(frame)
+            size += len(frame)
+            if size >= limit:
+                break
+        if not frames and after < self.server.snapshot_seq:
+            return None
+        return frames
+
+    def send_snapshot(self, connection, reader):
+        """Stream our newest snapshot in chunks and return the record it covers.
+
+        Its records then follow from the log.
+        """
+
+        path = f"{self.server.port}.snapshot.send"
+        self.server.export_snapshot(path)
+        with open(path, 'rb') as f:
+            header = f.read(RECORD.size)
+            (_, _, seq) = RECORD.unpack(header)
+            self.server.log.info("replication", "Sending snapshot", follower=f"{self.host}:{self.port}", seq=seq)
+            chunk = header + f.read(CHUNK_BYTES - len(header))
+            while chunk:
+                connection.sendall(encode_frame(INSTALL, seq, chunk))
+                chunk = f.read(CHUNK_BYTES)
+        term = self.server.wal.term_at(seq)
+        connection.sendall(encode_frame(INSTALL, seq, b"", *(() if term is None else (term,))))
+        connection.settimeout(self.install_timeout)
+        acked_seq = self.read_ack(reader)
+        connection.settimeout(self.ack_timeout)
+        if acked_seq != seq:
+            raise ReplicationError(f"follower did not install the snapshot at record {seq}")
+        return acked_seq
+
+    def read_ack(self, reader):
+        """Wait for the follower to acknowledge and return the newest record it holds."""
+
+        frame = reader.read_frame()
+        if frame is None:
+            raise ProtocolError("follower closed the connection")
+        op_code, fields = frame
+        if op_code != ACK:
+            raise ProtocolError(f"unexpected frame {op_code} from follower")
+        acked_seq, term = fields
+        if term > self.term:
+            self.server.election.observe_term(term)
+            raise ReplicationError(f"follower is in newer term {term}")
+        self.last_ack = time.monotonic()
+        return acked_seq
@@ -0,0 +1,596 @@
+import socket, sys, os
+from _thread import *
+import threading, multiprocessing
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (FrameReader, ProtocolError, encode_frame, encode_reply, REPLY, MESSAGE, REDIRECT,
+                      CREATE, LOGIN, LIST, SEND, DELETE, FILTER, ACKNOWLEDGE, RELAY, DELIVER, EXPORT, IMPORT,
+                      AUTHENTICATE, PEER_ONLY, reply_fields, parse_reply, OK, LOGGED_IN, DELETED, ACCOUNTS, REJECTED, NO_SUCH_USER,
+                      INVALID_ARGUMENTS, UNAVAILABLE, UNKNOWN_REQUEST)
+from paging import MAX_PAGE_SIZE, PageTokenError, page_request, encode_token
+from sharding import HashRing, shard_name, parse_shard
+from logger import Logger
+
+
+class ShardingError(Exception):
+    """Raised when an account cannot be moved to its new shard."""
+
+
+class Upstream():
+    """A router connection to the leader of one shard, on behalf of one client.
+
+    Messages the shard pushes go straight to the client; replies are handed to the
+    caller waiting in call(). Redirects are followed, and after switching replicas
+    the client's login is repeated so its session moves along. With a secret, every
+    connection is authenticated first so the shard takes sharding requests from it.
+    """
+
+    def __init__(self, replicas, on_message=None, timeout=5, max_redirects=100, election_wait=0.05, secret=None):
+        # (host, port) of every replica of the shard.
+        self.replicas = replicas
+
+        # The peer secret shared with the shards (None sends no sharding requests).
+        self.secret = secret
+
+        # Called with each encoded MESSAGE frame the shard pushes.
+        self.on_message = on_message
+
+        # Seconds to wait for a connection or a reply before trying another replica.
+        self.timeout = timeout
+
+        # Redirects and reconnections followed for one request before giving up.
+        self.max_redirects = max_redirects
+
+        # Seconds to wait before retrying while the shard elects a leader.
+        self.election_wait = election_wait
+
+        # Serialises requests from the client's thread and from migrations.
+        self.lock = threading.Lock()
+
+        # The current connection, and the queue its reader thread fills with replies.
+        self.connection = None
+        self.replies = None
+
+        # The login request repeated after reconnecting (None when not logged in here).
+        self.login = None
+
+        # Index of the next replica to try after a failure.
+        self.next_replica = 0
+
+    def call(self, op_code, *fields):
+        """Send a request to the shard's leader; returns its reply frame, or None if unreachable."""
+
+        with self.lock:
+            address = None
+            for _ in range(self.max_redirects):
+                try:
+                    if self.connection is None or address is not None:
+                        self.connect(address or self.replicas[self.next_replica % len(self.replicas)])
+                        if self.secret is not None:
+                            self.authenticate()
+                        if self.login is not None:
+                            self.exchange(self.login)
+                    frame = self.exchange(encode_frame(op_code, *fields))
+                except OSError:
+                    frame = None
+                address = None
+
+                if frame is None:
+                    self.close()
+                    self.next_replica += 1
+                    time.sleep(self.election_wait)
+                elif frame[0] == REDIRECT:
+                    host, port = frame[1]
+                    if port:
+                        address = (host, port)
+                    else:
+                        time.sleep(self.election_wait)
+                else:
+                    return frame
+            return None
+
+    def send(self, op_code, *fields):
+        """Send a request that gets no reply to the current connection, if there is one.
+
+        Nothing is retried: a lost acknowledgement only means its messages are pushed
+        again after the next login, and the client skips them.
+        """
+
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.sendall(encode_frame(op_code, *fields))
+            except OSError:
+                pass
+
+    def connect(self, address):
+        """Replace the connection with one to `address`, read by a thread of its own."""
+
+        connection = socket.create_connection(address, timeout=self.timeout)
+        connection.settimeout(None)
+        self.close()
+        self.connection = connection
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_loop, args=(connection, self.replies), daemon=True).start()
+
+    def authenticate(self):
+        """Prove the connection is the router's; a refusal counts as an unreachable replica."""
+
+        frame = self.exchange(encode_frame(AUTHENTICATE, self.secret))
+        if frame is None or frame[0] != REPLY or frame[1][0] != OK:
+            raise OSError("the shard refused the peer secret")
+
+    def exchange(self, data):
+        """Send one request and wait for its reply (None on timeout or EOF)."""
+
+        self.connection.sendall(data)
+        try:
+            return self.replies.get(timeout=self.timeout)
+        except queue.Empty:
+            return None
+
+    def read_loop(self, connection, replies):
+        """Forward pushed messages to the client and queue everything else as replies."""
+
+        reader = FrameReader(connection)
+        try:
+            frame = reader.read_frame()
+            while frame is not None:
+                if frame[0] == MESSAGE:
+                    if self.on_message is not None:
+                        self.on_message(encode_frame(MESSAGE, *frame[1]))
+                else:
+                    replies.put(frame)
+                frame = reader.read_frame()
+        except (OSError, ProtocolError):
+            pass
+        replies.put(None)
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            # Wakes the reader thread, which exits on EOF.
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+        self.connection = None
+
+
+class RouterSession():
+    """What the router keeps for one client connection."""
+
+    def __init__(self, router, connection):
+        self.router = router
+
+        # The client's socket (None for the router's own migration session).
+        self.connection = connection
+
+        # Serialises writes of replies and pushed messages to the client.
+        self.send_lock = threading.Lock()
+
+        # A dictionary with shard names as keys and this client's Upstream to them as values.
+        self.upstreams = {}
+        self.upstreams_lock = threading.Lock()
+
+        # The shard the client is logged in on and the account it is logged in as.
+        self.home = None
+        self.username = None
+
+    def upstream(self, shard):
+        with self.upstreams_lock:
+            if shard not in self.upstreams:
+                self.upstreams[shard] = Upstream(self.router.shards[shard], self.push, secret=self.router.peer_secret)
+            return self.upstreams[shard]
+
+    def push(self, data):
+        if self.connection is None:
+            return
+        try:
+            with self.send_lock:
+                self.connection.sendall(data)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.upstreams_lock:
+            for upstream in self.upstreams.values():
+                upstream.close()
+
+
+class Router():
+    """Thin router partitioning accounts across Server groups with a consistent-hash ring.
+
+    Clients connect to the router as if it were a server. Creating, logging in,
+    sending and deleting go to the shard owning the account; a message to a user on
+    another shard is vouched for by the sender's shard and delivered by the
+    recipient's. Listing and filtering are sent to every shard at once and merged.
+    Adding a shard moves the accounts it takes over, with their pending messages,
+    while clients stay connected: requests for an account wait while it moves.
+    """
+
+    # Maximum number of connections waiting to be accepted.
+    backlog = 100
+
+    # Log records per second allowed, by category, so heavy load cannot flood the log.
+    log_rate_limits = {"connection": 100}
+
+    def __init__(self, ip, port, stop_event, shards, admin=False, peer_secret=None, log_level="info"):
+        # The IP address and port the router listens on.
+        self.ip = ip
+        self.port = port
+
+        # Secret proving to the shards that requests come from the router, read from
+        # CHAT_PEER_SECRET by default; without it messages cannot cross shards.
+        self.peer_secret = peer_secret if peer_secret is not None else os.environ.get("CHAT_PEER_SECRET")
+
+        # Stores an event that can close the router (used for testing)
+        self.stop_event = stop_event
+
+        # Leveled log of the router's activity, written by a background thread.
+        self.log = Logger(log_level, rate_limits=self.log_rate_limits)
+
+        # A dictionary with shard names as keys and their replica groups as values.
+        self.shards = {shard_name(replicas): replicas for replicas in shards}
+
+        # Assigns every username to a shard.
+        self.ring = HashRing(self.shards)
+
+        # The ring being migrated to while a shard is added (None otherwise).
+        self.next_ring = None
+
+        # Accounts already moved to their shard on next_ring.
+        self.moved = set()
+
+        # Accounts being moved right now; their requests wait until they land.
+        self.moving = set()
+
+        # A dictionary with usernames as keys and how many requests are using them as values.
+        self.active = {}
+
+        # Guards the migration state above (and the sessions) and signals when it changes.
+        self.migration = threading.Condition()
+
+        # Sessions of the connected clients, so their logins move along with accounts.
+        self.sessions = set()
+
+        # Sends the per-shard requests of a listing or filter in parallel.
+        self.pool = ThreadPoolExecutor(max_workers=32)
+
+        # Add shards typed on standard input as +<SHARD>.
+        if admin:
+            threading.Thread(target=self.admin_loop, daemon=True).start()
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.ip, self.port))
+        server.listen(self.backlog)
+        server.settimeout(1)
+
+        self.log.info("server", "Router started", port=self.port, shards=len(self.shards))
+
+        while not self.stop_event.is_set():
+            try:
+                connection, address = server.accept()
+                self.log.info("connection", "Connected", address=f"{address[0]}:{address[1]}")
+                start_new_thread(self.wire_protocol, (connection,))
+            except socket.timeout:
+                continue
+
+        server.close()
+        self.pool.shutdown(wait=False)
+        self.log.info("server", "Router stopped", port=self.port)
+        self.log.close()
+
+    def wire_protocol(self, connection):
+        """Route one client's requests, in order, until it disconnects."""
+
+        session = RouterSession(self, connection)
+        with self.migration:
+            self.sessions.add(session)
+        reader = FrameReader(connection)
+        try:
+            frame = reader.read_frame()
+            while frame is not None:
+                op_code, fields = frame
+                fields = [elt.strip() if isinstance(elt, str) else elt for elt in fields]
+                reply = self.handle_request(session, op_code, fields)
+                if reply is not None:
+                    session.push(reply)
+                frame = reader.read_frame()
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            with self.migration:
+                self.sessions.discard(session)
+            session.close()
+            connection.close()
+
+    def handle_request(self, session, op_code, fields):
+        """Route a request to the shards it concerns and return the encoded reply (None for none)."""
+
+        # Sharding requests are the router's own; its authenticated upstreams must not pass on a client's.
+        if op_code in PEER_ONLY or op_code == AUTHENTICATE:
+            return encode_reply(reply_fields(UNKNOWN_REQUEST))
+        if op_code == ACKNOWLEDGE:
+            if session.home is not None:
+                session.upstream(session.home).send(op_code, *fields)
+            return None
+        if op_code == LIST:
+            return self.list_accounts(session, fields)
+        if op_code == FILTER:
+            return self.filter_accounts(session, fields)
+
+        # The accounts the request touches: its target and the logged-in sender.
+        key = fields[0] if op_code in (CREATE, LOGIN, SEND, DELETE) and fields else None
+        usernames = {username for username in (key, session.username) if username}
+        if op_code == CREATE and key:
+            self.wait_for_owner(key)
+        self.acquire(usernames)
+        try:
+            if op_code == CREATE and key:
+                frame = session.upstream(self.owner(key)).call(op_code, *fields)
+
+            elif op_code == LOGIN and key and session.home is None:
+                shard = self.owner(key)
+                upstream = session.upstream(shard)
+                frame = upstream.call(op_code, *fields)
+
+                if frame is not None and frame[0] == REPLY and frame[1][0] == LOGGED_IN:
+                    session.home, session.username = shard, frame[1][1]
+                    upstream.login = encode_frame(LOGIN, session.username)
+
+            elif op_code == SEND and key and session.home is not None and self.owner(key) != session.home:
+                frame = session.upstream(session.home).call(RELAY, *fields)
+                if frame is not None and frame[0] == RELAY:
+                    frame = session.upstream(self.owner(key)).call(DELIVER, *frame[1])
+
+            elif op_code in (SEND, DELETE) and session.home is None and key:
+                frame = session.upstream(self.owner(key)).call(op_code, *fields)
+
+            else:
+                # Logged-in requests and help go to the client's own shard.
+                frame = session.upstream(session.home or self.ring.shards()[0]).call(op_code, *fields)
+
+                # A deleted account's session is over.
+                if (op_code == DELETE and frame is not None and frame[0] == REPLY
+                        and frame[1][0] == DELETED and frame[1][1] == session.username):
+                    session.upstreams[session.home].login = None
+                    session.home = session.username = None
+        finally:
+            self.release(usernames)
+
+        if frame is None:
+            return encode_reply(reply_fields(UNAVAILABLE, detail="Shard unavailable"))
+        return encode_frame(frame[0], *frame[1])
+
+    def list_accounts(self, session, fields):
+        """Merge one page from every shard into a page of the whole listing.
+
+        Each shard is asked for a full page after the same username, so the first
+        page_size of their union, in username order, is the next page overall.
+        """
+
+        try:
+            page_size, last_username = page_request(*fields[:2])
+        except PageTokenError as e:
+            return encode_reply(reply_fields(REJECTED, detail=str(e)))
+
+        token = encode_token(page_size, last_username) if last_username else ""
+        frames = self.scatter(session, LIST, str(page_size), token)
+        if not isinstance(frames, list):
+            return frames
+
+        return self.merge(frames, page_size)
+
+    def filter_accounts(self, session, fields):
+        """Filter every shard's accounts at once and merge their pages of matches.
+
+        Pages are merged as in list_accounts: each shard's page of matches after the
+        same username holds all of that shard's share of the next page overall.
+        """
+
+        if not 1 <= len(fields) <= 3:
+            return encode_reply(reply_fields(INVALID_ARGUMENTS))
+        try:
+            page_size, last_username = page_request(*fields[1:3])
+        except PageTokenError as e:
+            return encode_reply(reply_fields(REJECTED, detail=str(e)))
+
+        token = encode_token(page_size, last_username) if last_username else ""
+        frames = self.scatter(session, FILTER, fields[0], str(page_size), token)
+        if not isinstance(frames, list):
+            return frames
+
+        return self.merge(frames, page_size)
+
+    def scatter(self, session, op_code, *fields):
+        """Send a request to every shard in parallel.
+
+        Returns their reply frames, or the encoded reply to send instead when a shard
+        is unreachable or rejects the request.
+        """
+
+        with self.migration:
+            shards = list(self.shards)
+        upstreams = [session.upstream(shard) for shard in shards]
+        frames = list(self.pool.map(lambda upstream: upstream.call(op_code, *fields), upstreams))
+        for frame in frames:
+            if frame is None:
+                return encode_reply(reply_fields(UNAVAILABLE, detail="Shard unavailable"))
+            if frame[0] != REPLY or frame[1][0] != ACCOUNTS:
+                return encode_frame(frame[0], *frame[1])
+        return frames
+
+    def merge(self, frames, page_size):
+        """The ACCOUNTS reply for the first page_size (username, live) pairs of every
+        shard's page, in username order, with the token to resume after them.
+
+        An account seen on two shards while it moves is listed once.
+        """
+
+        accounts = {}
+        more = False
+        for _, fields in frames:
+            reply = parse_reply(fields)
+            more = more or bool(reply.page_token)
+            for username, live in reply.accounts:
+                accounts[username] = accounts.get(username, False) or live
+        accounts = sorted(accounts.items())
+        page = accounts[:page_size]
+        more = more or len(accounts) > page_size
+
+        next_token = encode_token(page_size, page[-1][0]) if more and page else ""
+        return encode_reply(reply_fields(ACCOUNTS, page_token=next_token, accounts=page))
+
+    def owner(self, username):
+        """The shard holding an account (call while it is acquired)."""
+
+        with self.migration:
+            if self.next_ring is not None and username in self.moved:
+                return self.next_ring.owner(username)
+            return self.ring.owner(username)
+
+    def wait_for_owner(self, username):
+        """Hold back creating an account whose shard changes until the migration is over."""
+
+        with self.migration:
+            self.migration.wait_for(lambda: self.next_ring is None
+                                    or self.next_ring.owner(username) == self.ring.owner(username))
+
+    def acquire(self, usernames):
+        """Wait until none of the accounts is moving, then keep them from moving."""
+
+        with self.migration:
+            self.migration.wait_for(lambda: not usernames & self.moving)
+            for username in usernames:
+                self.active[username] = self.active.get(username, 0) + 1
+
+    def release(self, usernames):
+        with self.migration:
+            for username in usernames:
+                self.active[username] -= 1
+                if not self.active[username]:
+                    del self.active[username]
+            self.migration.notify_all()
+
+    def add_shard(self, replicas):
+        """Add a shard and move the accounts it now owns to it, while serving clients.
+
+        Only accounts whose owner changes are touched, about 1/N of them. If the
+        migration stops on an error, adding the same shard again resumes it.
+        """
+
+        name = shard_name(replicas)
+        with self.migration:
+            if self.next_ring is None:
+                if name in self.shards:
+                    self.log.warning("shard", "Shard already exists", shard=name)
+                    return False
+                self.shards[name] = replicas
+                self.next_ring = self.ring.copy()
+                self.next_ring.add(name)
+            elif name not in self.next_ring.shards():
+                self.log.warning("shard", "Another shard is still being added", shard=name)
+                return False
+
+        session = RouterSession(self, None)
+        moved = 0
+        try:
+            for shard in self.ring.shards():
+                last_username = ""
+                while True:
+                    token = encode_token(MAX_PAGE_SIZE, last_username) if last_username else ""
+                    frame = session.upstream(shard).call(LIST, str(MAX_PAGE_SIZE), token)
+                    if frame is None or frame[0] != REPLY or frame[1][0] != ACCOUNTS:
+                        raise ShardingError(f"cannot list the accounts of shard {shard}")
+                    reply = parse_reply(frame[1])
+                    for username, _ in reply.accounts:
+                        if self.next_ring.owner(username) != shard:
+                            self.move(session, username, shard, name)
+                            moved += 1
+                    if not reply.page_token:
+                        break
+                    last_username = reply.accounts[-1].username
+        except ShardingError as e:
+            self.log.error("shard", "Adding shard stopped", shard=name, moved=moved, error=e)
+            return False
+        finally:
+            session.close()
+
+        with self.migration:
+            self.ring = self.next_ring
+            self.next_ring = None
+            self.moved = set()
+            self.migration.notify_all()
+        self.log.info("shard", "Shard added", shard=name, moved=moved)
+        return True
+
+    def move(self, session, username, source, target):
+        """Move one account and its pending messages, in order, from `source` to `target`."""
+
+        with self.migration:
+            self.moving.add(username)
+            self.migration.wait_for(lambda: not self.active.get(username))
+        try:
+            done = False
+            while not done:
+                frame = session.upstream(source).call(EXPORT, username)
+                if frame is None:
+                    raise ShardingError(f"cannot export {username} from {source}")
+                if frame[0] == REPLY and frame[1][0] == NO_SUCH_USER:
+                    # Deleted since it was listed: nothing left to move.
+                    break
+                if frame[0] != EXPORT:
+                    raise ShardingError(f"{source} refused to export {username}")
+                _, done, last_id, *messages = frame[1]
+                reply = session.upstream(target).call(IMPORT, username, last_id, *messages)
+                if reply is None or reply[0] != REPLY or reply[1][0] != OK:
+                    raise ShardingError(f"{len(messages)} messages for {username} could not be imported into {target}")
+            with self.migration:
+                self.moved.add(username)
+                sessions = [s for s in self.sessions if s.username == username]
+
+            # Log the account's clients in again on its new shard.
+            for client in sessions:
+                upstream = client.upstream(target)
+                upstream.login = encode_frame(LOGIN, username)
+                upstream.call(LOGIN, username)
+                client.upstream(source).login = None
+                client.home = target
+        finally:
+            with self.migration:
+                self.moving.discard(username)
+                self.migration.notify_all()
+
+    def admin_loop(self):
+        """Add the shards typed on standard input, one per line as +<SHARD>."""
+
+        for line in sys.stdin:
+            line = line.strip()
+            if line.startswith('+'):
+                self.add_shard(parse_shard(line[1:], self.ip))
+            elif line:
+                print("Usage: +<REPLICA>,<REPLICA>,...")
+
+
+if __name__ == '__main__':
+
+    # Validate command line arguments.
+    if len(sys.argv) >= 4:
+        HOST = sys.argv[1]
+        PORT = int(sys.argv[2])
+
+        # Each shard is a replica group given as host:port (or port) separated by commas.
+        SHARDS = [parse_shard(spec, HOST) for spec in sys.argv[3:]]
+        stop_event_router = multiprocessing.Event()
+
+        # Start the router.
+        Router(HOST, PORT, stop_event_router, SHARDS, admin=True)
+    else:
+        print("Usage: python3 router.py <HOST> <PORT> <SHARD> [<SHARD> ...]")
+        print("       where <SHARD> is <REPLICA>,<REPLICA>,... and +<SHARD> on stdin adds one")
+        sys.exit(1)
@@ -1,14 +1,47 @@
 import socket, sys, csv
 from _thread import *
 import re
-from termcolor import colored
 import threading, multiprocessing
 import time
+import os
+import shutil
+import tempfile
+import hmac
+import bisect
+from protocol import (FrameReader, ProtocolError, encode_frame, encode_reply, MESSAGE, HELP, LIST, FILTER, ACKNOWLEDGE,
+                      REPLICATE, APPEND, HEARTBEAT, ACK, INSTALL, VOTE, REDIRECT, PING, RELAY, DELIVER,
+                      EXPORT, IMPORT, AUTHENTICATE, PEER_ONLY, reply_fields, OK, CREATED, LOGGED_IN, DELETED, SENT, QUEUED,
+                      ACCOUNTS, USAGE, INVALID_ARGUMENTS, NOT_LOGGED_IN, ALREADY_LOGGED_IN, ACCOUNT_EXISTS,
+                      INVALID_USERNAME, NO_SUCH_USER, USER_ONLINE, NOT_YOUR_ACCOUNT, QUEUE_FULL, REJECTED,
+                      UNKNOWN_REQUEST, FAILED, UNAVAILABLE)
+from wal import WriteAheadLog, LOG_CREATE, LOG_DELETE, LOG_ENQUEUE, LOG_DEQUEUE, LOG_NOOP
+from snapshot import read_snapshot, write_snapshot
+from storage import open_storage
+from sessions import SessionRegistry
+from offline_queue import PendingQueue, QueueBudget, pack_message, unpack_message, message_id
+from filters import RegexFilter, FilterError
+from paging import AccountIndex, PageTokenError, encode_token, page_request
+from replication import ReplicationLog, QuorumTimeout, parse_replica
+from election import Election
+from metrics import MetricsRegistry, MetricsServer
+from logger import Logger
 
 class Server():
     """Server class for primary and replica servers."""
 
-    def __init__(self, ip, port, stop_event):
+    # Maximum number of connections waiting to be accepted.
+    backlog = 100
+
+    # Fraction of log records kept, by category (see logger.Logger).
+    log_sampling = {"request": 0.1}
+
+    # Log records per second allowed, by category, so heavy load cannot flood the log.
+    log_rate_limits = {"connection": 100, "session": 100, "account": 100, "message": 100, "filter": 100,
+                       "shard": 100}
+
+    def __init__(self, ip, port, stop_event, durability="sync", idle_timeout=None,
+                 queue_policy="spill", replicas=None, write_quorum=None, storage="sqlite", metrics_port=None, log_level="info",
+                 peer_secret=None):
         # The IP address of the server running.
         self.ip = ip
 
@@ -18,23 +51,137 @@ class Server():
         # Stores an event that can close the server (used for testing)
         self.stop_event = stop_event
 
-        # A dictionary with username as key and pending messages as values.
+        # Leveled, sampled log written by a background thread, off the request path.
+        self.log = Logger(log_level, self.log_sampling, self.log_rate_limits)
+
+        # A dictionary with username as key and a PendingQueue of messages as values.
         self.pending_messages = {} 
 
-        # How many seconds the server waits before pickling the current queue.
-        self.pickle_interval = 1
+        # Memory limits for pending queues and what to do with messages beyond them.
+        self.budget = QueueBudget(f"{self.port}spill", policy=queue_policy)
+
+        # Compiles and evaluates filter_accounts patterns within a time budget.
+        self.filters = RegexFilter()
+
+        # Maximum bytes of queued messages coalesced into one write on delivery.
+        self.flush_bytes = 64 * 1024
+
+        # A dictionary with account names as keys, in creation order, and the newest
+        # message id given to each account as values (ids count up per recipient).
+        self.accounts = {}
+
+        # Account names in sorted order, for paginated listings.
+        self.account_index = AccountIndex()
+
+        # Logged in users, indexed both by username and by connection.
+        self.sessions = SessionRegistry()
+
+        # Seconds without any request before a connection is dropped (None waits forever).
+        self.idle_timeout = idle_timeout
+
+        # A dictionary with connections as keys and locks serialising their writes.
+        self.send_locks = {}
+
+        # A dictionary with connections as keys and the newest message id pushed to the
+        # session on them as values; older queued messages await their acknowledgement.
+        self.delivered = {}
+
+        # A dictionary with connections as keys and locks keeping their pushed messages in id order.
+        self.delivery_locks = {}
+
+        # Secret shared with the router, read from CHAT_PEER_SECRET by default (None admits no peers).
+        self.peer_secret = peer_secret if peer_secret is not None else os.environ.get("CHAT_PEER_SECRET")
+
+        # Connections that proved they hold peer_secret and may send PEER_ONLY requests.
+        self.peers = set()
+
+        # Serialises mutations so the log records them in the order they are applied.
+        self.lock = threading.Lock()
+
+        # How the write-ahead log acknowledges mutations (see wal.DURABILITY_MODES).
+        self.durability = durability
+
+        # How many seconds the server waits between background snapshots.
+        self.snapshot_interval = 30
+
+        # Minimum number of new log records before another snapshot is worth taking.
+        self.snapshot_min_records = 1000
+
+        # Sequence number of the newest log record covered by the stored snapshot.
+        self.snapshot_seq = 0
+
+        # Storage engine holding the latest snapshot of accounts and queued messages
+        # (see storage.STORAGE_ENGINES); the log holds every mutation after it.
+        self.storage = open_storage(storage, f"{self.port}.db")
+
+        # Ids of containers shared with an in-progress snapshot, copied before their next write.
+        self.shared = set()
 
-        # A list of account names.
-        self.accounts = []
+        # Serialises taking a snapshot with installing one received from the leader.
+        self.snapshot_lock = threading.Lock()
 
-        # A dictionary with usernames as keys and connection references as values.
-        self.conn_refs = {}
+        # Whether a snapshot from the leader is being loaded (no elections meanwhile).
+        self.installing = False
 
-        # A dictionary with logged in users.
-        self.logged_in = []
+        # Whether this replica has caught up with the leader since it started; until then
+        # it is too stale to answer reads itself and points clients to the leader.
+        self.caught_up = not replicas
 
-        # Retrieve accounts and pending messages from the current queue.
+        # (host, port) of every replica in the group, including this one (empty when unreplicated).
+        self.replicas = list(replicas or [])
+
+        # Replicas, counting the leader, holding a mutation before it is acknowledged
+        # (a majority by default, so an acknowledged write survives any failover).
+        self.write_quorum = write_quorum or len(self.replicas) // 2 + 1
+
+        # Metrics describing the server, served in Prometheus format over HTTP on
+        # localhost:metrics_port (None serves no endpoint).
+        self.metrics = MetricsRegistry()
+        self.metrics_port = metrics_port
+
+        # Requests handled and the time their handlers took, by opcode.
+        self.requests = self.metrics.counter("chat_requests_total", "Requests handled, by opcode.", ["op"])
+        self.request_seconds = self.metrics.histogram("chat_request_seconds",
+                                                      "Time spent handling requests, by opcode.", ["op"])
+
+        # Bytes read from and written to connections.
+        self.bytes_received = self.metrics.counter("chat_received_bytes_total", "Bytes read from connections.")
+        self.bytes_sent = self.metrics.counter("chat_sent_bytes_total", "Bytes written to connections.")
+
+        # Messages pushed to logged-in users, and the time each push of a user's queue took.
+        self.messages_pushed = self.metrics.counter("chat_messages_pushed_total",
+                                                    "Queued messages pushed to logged-in users.")
+        self.flush_seconds = self.metrics.histogram("chat_flush_seconds",
+                                                    "Time spent pushing a user's queued messages.")
+
+        # Time spent making state durable: "wal" group commits and "snapshot" writes to storage.
+        self.persist_seconds = self.metrics.histogram("chat_persist_seconds",
+                                                      "Time spent writing state to disk, by kind.", ["kind"])
+
+        # Gauges read from the server's own state when scraped, off the request path.
+        self.metrics.gauge("chat_sessions", "Users logged in.", function=lambda: len(self.sessions))
+        self.metrics.gauge("chat_queue_depth", "Messages queued and not yet acknowledged, by recipient.",
+                           ["recipient"], function=self.queue_depths)
+        self.metrics.gauge("chat_replication_lag_records", "Log records each follower is behind the leader.",
+                           ["replica"], function=lambda: self.replication_health(0))
+        self.metrics.gauge("chat_replication_ack_seconds", "Smoothed time each follower takes to acknowledge.",
+                           ["replica"], function=lambda: self.replication_health(1))
+
+        # Retrieve accounts and pending messages from the newest snapshot and the log tail
+        # (queues spill again as they are rebuilt, so old spill files are stale).
+        shutil.rmtree(self.budget.spill_dir, ignore_errors=True)
         self.unpack()
+        self.wal.on_flush = lambda seconds: self.persist_seconds.observe(seconds, "wal")
+
+        # Recent log records kept in memory for shipping to followers.
+        self.replication = ReplicationLog(self.wal.next_seq - 1, quorum=self.write_quorum)
+
+        # Elects the leader that serves clients and ships its log (None when unreplicated).
+        self.election = Election(self) if self.replicas else None
+
+        # Snapshot and compact the log in the background, off the request path.
+        self.snapshot_thread = threading.Thread(target=self.snapshot_loop, daemon=True)
+        self.snapshot_thread.start()
 
         # Specify the address domain and read properties of the socket.
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -43,399 +190,1112 @@ class Server():
         # Connect to the server at the specified port and IP address.
         server.bind((self.ip, self.port))
 
-        # Listen for a maximum of 100 active connections (can be adjusted).
-        server.listen(100)
+        # Queue up to `backlog` pending connections (can be adjusted).
+        server.listen(self.backlog)
 
-        print(f"Server started, listening on port {self.port}.\n")
+        self.log.info("server", "Server started", port=self.port)
 
-        server.settimeout(1)  # Set a timeout for the accept() method
+        # Serve metrics alongside the chat protocol.
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.log.info("server", "Serving metrics", url=f"http://localhost:{metrics_server.port}/metrics")
 
         # Main loop for the server to listen to client requests until timeout.
+        self.serve(server)
+
+        # Kill the server if the timeout event is set. 
+        server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        self.snapshot_thread.join()
+        self.filters.close()
+        self.wal.close()
+        self.storage.close()
+        self.log.info("server", "Server stopped", port=self.port)
+        self.log.close()
+
+    def serve(self, server):
+        """Accept connections until stopped, serving each one on its own thread."""
+
+        server.settimeout(1)  # Set a timeout for the accept() method
+
         while not self.stop_event.is_set():
             try:
                 connection, address = server.accept()
-                print('\nConnected to:', address[0], ':', address[1])
+                self.log.info("connection", "Connected", address=f"{address[0]}:{address[1]}")
                 start_new_thread(self.wire_protocol, (connection,))
             except socket.timeout:
                 continue
-        
-        # Kill the server if the timeout event is set. 
-        server.close()
-        print(f"Server stopped, no longer listening on port {self.port}.\n")
 
     def create_account(self, msg_list, connection):
         """Create an account, and associate with the appropriate socket. (c|<username>)"""
 
         if len(msg_list) != 2:
-            msg = (colored("\nInvalid arguments! Usage: c|<username>\n", "red"))
-            return msg
+            return reply_fields(INVALID_ARGUMENTS)
 
-        self.update_live_users()
         init_user = self.get_account(connection)
 
-        if init_user in self.logged_in:
-            msg = (colored("\nPlease disconnect first!\n", "red"))
-            return msg
+        if init_user is not None:
+            return reply_fields(ALREADY_LOGGED_IN, init_user)
 
         username = msg_list[1]
 
         if username in self.accounts:
-            print(f"\nUser {username} account creation rejected\n")
-            msg = colored(f"\nAccount {username} already exists!\n", "red")
-            return msg
-
-        if not re.fullmatch("\w{2,20}", username):
-            print(f"\nUser {username} account creation rejected\n")
-            msg = colored(
-                f"\nUsername must be alphanumeric and 2-20 characters!\n", "red")
-            return msg
-
-        self.accounts.append(username)
-        print(f"\nUser {username} account created\n")
-        msg = colored(
-            f"\nNew account created! User ID: {username}. Please log in.\n", "green")
-        return msg
+            self.log.info("account", "Account creation rejected, name taken", user=username)
+            return reply_fields(ACCOUNT_EXISTS, username)
+
+        if not re.fullmatch(r"\w{2,20}", username):
+            self.log.info("account", "Account creation rejected, invalid name", user=username)
+            return reply_fields(INVALID_USERNAME, username)
+
+        self.apply(LOG_CREATE, username)
+        self.log.info("account", "Account created", user=username)
+        return reply_fields(CREATED, username)
 
 
     def delete_account(self, msg_list, connection):
         """Delete the current user's account. (d|<confirm_username>)"""
 
         if len(msg_list) != 2:
-            msg = (colored("\nInvalid arguments! Usage: d|<confirm_username>\n", "red"))
-            return msg
+            return reply_fields(INVALID_ARGUMENTS)
 
         username = msg_list[1]
         init_user = self.get_account(connection)
 
         if (init_user != username):
-            msg = (colored("\nYou can only delete your own account.\n", "red"))
-            return msg
+            return reply_fields(NOT_YOUR_ACCOUNT, username)
 
-        print(f"\nUser {username} requesting account deletion.\n")
+        self.log.debug("request", "Account deletion requested", user=username)
 
         if username in self.accounts:
-            self.accounts.remove(username)
-            self.logged_in.remove(username)
-            if self.pending_messages.get(username):
-                self.pending_messages.pop(username)
-            print(f"\nUser {username} account deleted.\n")
-            msg = colored(f"\nAccount {username} has been deleted.\n", "green")
-            return msg
+            self.apply(LOG_DELETE, username)
+            self.sessions.logout_user(username)
+            self.log.info("account", "Account deleted", user=username)
+            return reply_fields(DELETED, username)
 
         else:
-            return (colored("\nIncorrect username for confirmation.\n", "red"))
-
-
-    def update_live_users(self):
-        """Check which socket connections are still live."""
+            return reply_fields(NO_SUCH_USER, username)
 
-        curr_users = []
-        for user in self.conn_refs:
-            try:
-                self.conn_refs[user].send("".encode('UTF-8'))
-                curr_users.append(user)
-            except:
-                pass
-
-        for user in self.logged_in:
-            if user not in curr_users:
-                self.logged_in.remove(user)
 
+    def list_accounts(self, msg_list):
+        """List a page of registered users and their status. (u|<page_size>|<page_token>)
 
-    def list_accounts(self):
-        """List all of the registered users and display their status. (u)"""
+        Replies with the (username, live) pairs of the page and the token for the
+        next page ("" on the last page).
+        """
 
-        print(f'\nListing accounts\n')
+        self.log.debug("request", "Listing accounts")
 
-        self.update_live_users()
+        try:
+            page_size, last_username = page_request(*msg_list[1:3])
+        except PageTokenError as e:
+            return reply_fields(REJECTED, detail=str(e))
 
-        if self.accounts:
-            acc_str = "\n" + "\n".join([(colored(f"{u} ", "blue") +
-                                         (colored("(live)", "green") if u in self.logged_in else ""))
-                                        for u in self.accounts]) + "\n"
+        with self.lock:
+            usernames, token = self.account_index.page(page_size, last_username)
 
-        else:
-            acc_str = colored("\nNo existing users!\n", "red")
-
-        return acc_str
+        accounts = [(u, self.sessions.is_live(u)) for u in usernames]
+        return reply_fields(ACCOUNTS, page_token=token or "", accounts=accounts)
 
 
     def verify_dupes(self, connection):
         """Verify if a user is already logged in when they try to log in."""
 
-        for username in self.logged_in:
-            if self.conn_refs[username] == connection:
-                return True
-        return False
+        return self.sessions.user(connection) is not None
 
 
     def login(self, msg_list, connection):
-        """Check that the user is not already logged in, log in to a particular user, and deliver unreceived messages if applicable."""
+        """Check that the user is not already logged in, log in to a particular user, and deliver unreceived messages if applicable.
 
-        if len(msg_list) != 2:
-            msg = (colored("\nInvalid arguments! Usage: l|<username>\n", "red"))
-            return msg
+        A client reconnecting passes the newest message id it received; older messages
+        count as acknowledged and only newer ones are sent again. A successful login
+        replies with how many pending messages were delivered.
+        """
+
+        if len(msg_list) not in (2, 3):
+            return reply_fields(INVALID_ARGUMENTS)
+
+        try:
+            resume_after = int(msg_list[2]) if len(msg_list) == 3 else 0
+        except ValueError:
+            return reply_fields(INVALID_ARGUMENTS)
 
         check_duplicate = self.verify_dupes(connection)
 
         if check_duplicate == True:
-            msg = (colored("\nPlease log out first!\n", "red"))
-            return msg
+            return reply_fields(ALREADY_LOGGED_IN, self.get_account(connection))
 
         username = msg_list[1]
 
-        print(f"\nLogin as user {username} requested\n")
+        self.log.debug("request", "Login requested", user=username)
 
-        self.update_live_users()
 
-        if username in self.logged_in:
-            print(f"\nLogin as {username} denied.\n")
-            msg = colored(
-                f"\nUser {username} already logged in. Please try again.\n", "red")
-            return msg
+        if username not in self.accounts:
+            self.log.info("session", "Login denied, no such user", user=username)
+            return reply_fields(NO_SUCH_USER, username)
 
-        elif username not in self.accounts:
-            print(f"\nLogin as {username} denied.\n")
-            msg = colored(
-                f"\nUser {username} does not exist. Please create an account.\n", "red")
-            return msg
+        elif not self.sessions.login(username, connection):
+            self.log.info("session", "Login denied, already online", user=username)
+            return reply_fields(USER_ONLINE, username)
 
         else:
-            self.conn_refs[username] = connection
-            print(f"\nLogin as user {username} completed.\n")
-            msg = colored(
-                f"\nLogin successful - welcome back {username}!\n", "green")
-            if username in self.pending_messages:
-                print(f"\nDelivering pending messages to {username}.\n")
-                self.send_msg(connection, username, colored(
-                    f"\nYou have pending messages! Delivering the  messages now...", "green"))
-                self.deliver_pending_messages(username)
-            self.logged_in.append(username)
-            return msg
+            self.log.info("session", "Logged in", user=username)
+            self.delivered[connection] = resume_after
+            try:
+                self.drop_acknowledged(username, resume_after)
+                delivered = 0
+                if self.pending_messages.get(username):
+                    self.log.debug("message", "Delivering pending messages", user=username)
+                    delivered = self.flush_messages(username) or 0
+            except QuorumTimeout:
+                # Answered as unavailable, so the client logs in again (probably at a new leader).
+                self.sessions.logout_connection(connection)
+                raise
+            return reply_fields(LOGGED_IN, username, count=delivered)
 
 
     def get_account(self, connection):
-        """Get account from connection refernce by reverse searching the live_users dictionary."""
-
-        for username in self.conn_refs:
-            if self.conn_refs[username] == connection:
-                return username
+        """Get the account logged in on a connection reference."""
+
+        return self.sessions.user(connection)
+
+
+    def flush_messages(self, username):
+        """Push a logged-in user's queued messages that its session has not been sent yet.
+
+        Messages go out in id order, once the log holds them, in writes of up to
+        flush_bytes. They are fetched about flush_bytes at a time, each batch under the
+        lock on its own, so a long or spilled queue never holds it for the whole backlog. Messages stay
+        queued until the client acknowledges them. Returns how many were pushed, or
+        None if the user is offline or the write failed.
+        """
+
+        connection = self.sessions.connection(username)
+        if connection is None:
+            return None
+        started = time.perf_counter()
+        pushed = 0
+        with self.delivery_locks.setdefault(connection, threading.Lock()):
+            while True:
+                with self.lock:
+                    queue = self.pending_messages.get(username)
+                    last_id = self.delivered.get(connection, 0)
+                    entries = queue.newer_than(last_id, self.flush_bytes) if queue else []
+                    seq = self.wal.next_seq - 1
+                if not entries:
+                    break
+                self.commit(seq)
+
+                # Frame the messages in writes up to the byte cap (always at least one message).
+                frames = []
+                size = 0
+                for msg in entries:
+                    frame = encode_frame(MESSAGE, *unpack_message(msg))
+                    if frames and size + len(frame) > self.flush_bytes:
+                        if not self.push(connection, b"".join(frames)):
+                            return None
+                        frames = []
+                        size = 0
+                    frames.append(frame)
+                    size += len(frame)
+                if not self.push(connection, b"".join(frames)):
+                    return None
+                self.delivered[connection] = message_id(entries[-1])
+                pushed += len(entries)
+        if pushed:
+            self.messages_pushed.inc(amount=pushed)
+            self.flush_seconds.observe(time.perf_counter() - started)
+        return pushed
+
+    def acknowledge(self, msg_list, connection):
+        """Drop the logged-in user's messages up to and including an id. (a|<message_id>)
+
+        Acknowledgements are cumulative and get no reply, so clients can send one for a
+        whole batch of messages without waiting.
+        """
+
+        username = self.get_account(connection)
+        if username is None or len(msg_list) != 2:
+            return None
+        try:
+            self.drop_acknowledged(username, int(msg_list[1]))
+        except (ValueError, QuorumTimeout):
+            pass
         return None
 
-
-    def deliver_pending_messages(self, recipient_name):
-        """Deliver pending messages to a user."""
-
-        while self.pending_messages[recipient_name]:
-            self.conn_refs[recipient_name].send(
-                self.pending_messages[recipient_name][0].encode('UTF-8'))
-            self.pending_messages[recipient_name].pop(0)
+    def drop_acknowledged(self, username, msg_id):
+        """Remove a user's queued messages with ids up to `msg_id`."""
+
+        with self.lock:
+            count = 0
+            for msg in self.pending_messages.get(username, ()):
+                if message_id(msg) > msg_id:
+                    break
+                count += 1
+            if not count:
+                return
+            seq = self.log_mutation(LOG_DEQUEUE, username, count)
+        self.commit(seq)
+
+    def push(self, connection, data):
+        """Write encoded frames to a client, one writer at a time per socket.
+
+        Returns False, after ending the connection's session, if the write failed.
+        """
+
+        try:
+            with self.send_locks.setdefault(connection, threading.Lock()):
+                connection.sendall(data)
+            self.bytes_sent.inc(amount=len(data))
+            return True
+        except OSError:
+            self.disconnect(connection)
+            return False
+
+    def disconnect(self, connection):
+        """End the session of a closed, failed or idle connection."""
+
+        username = self.sessions.logout_connection(connection)
+        if username is not None:
+            self.log.info("session", "Disconnected", user=username)
+        self.delivered.pop(connection, None)
+        self.peers.discard(connection)
+
+        # Wake the connection's own thread, which closes the socket on its way out.
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
     def send_msg(self, connection, recipient_name, msg):
         """Send a message to the given user."""
 
-        print(f"\nRequest received to send message to {recipient_name}.\n")
+        self.log.debug("request", "Message requested", recipient=recipient_name)
 
-        self.update_live_users()
         init_user = self.get_account(connection)
 
-        if init_user not in self.logged_in:
-            msg = (colored("\nPlease log in to send a message!\n", "red"))
-            return msg
+        if init_user is None:
+            return reply_fields(NOT_LOGGED_IN)
 
-        if recipient_name in self.accounts:
-            sender_name = self.get_account(connection)
-            if recipient_name in self.logged_in:
-                msg = colored(f"[{sender_name}] ", "grey") + msg
-                self.conn_refs[recipient_name].send(msg.encode('UTF-8'))
-                print(f"\nMessage sent to {recipient_name}.\n")
-                msg = colored(f"\nMessage sent to {recipient_name}.\n", "green")
-            else:
-                msg = colored(f"[{sender_name}] ", "grey") + msg
-                if recipient_name in self.pending_messages:
-                    self.pending_messages[recipient_name].append(msg)
-                else:
-                    self.pending_messages[recipient_name] = [msg]
-                print(
-                    f"\nMessage will be sent to {recipient_name} after the account is online.\n")
-                msg = colored(
-                    f"\nMessage will be delivered to {recipient_name} after the account is online.\n", "green")
-            return msg
+        return self.deliver(init_user, recipient_name, msg)
 
-        else:
-            msg = colored(
-                "\nMessage failed to send! Verify recipient username.\n", "red")
-            print(f"\nRequest to send message to {recipient_name} denied.\n")
-            return msg
+    def authenticate(self, msg_list, connection):
+        """Admit a router to the sharding opcodes on this connection. (Y|<secret>)"""
 
+        if (len(msg_list) != 2 or not isinstance(msg_list[1], str) or not self.peer_secret
+                or not hmac.compare_digest(msg_list[1].encode(), self.peer_secret.encode())):
+            self.log.warning("shard", "Peer authentication failed")
+            return reply_fields(REJECTED, detail="Not a peer")
+        self.peers.add(connection)
+        return reply_fields(OK)
 
-    def filter_accounts(self, msg_list):
-        """Filter accounts by a given regex."""
+    def relay_msg(self, connection, recipient_name, msg):
+        """Vouch for the sender of a message to a user on another shard. (F|<recipient>|<message>)
 
-        print(f'\nFiltering accounts.\n')
+        The router delivers the returned RELAY frame to the recipient's shard.
+        """
 
-        if len(msg_list) != 2:
-            msg = (colored("\nInvalid arguments! Usage: f|<filter_regex>\n", "red"))
-            return msg
+        init_user = self.get_account(connection)
 
-        self.update_live_users()
+        if init_user is None:
+            return reply_fields(NOT_LOGGED_IN)
 
-        fltr = msg_list[1]
-        def fun(x): return re.fullmatch(fltr, x)
-        filtered_accounts = list(filter(fun, self.accounts))
+        return encode_frame(RELAY, init_user, recipient_name, msg)
 
-        if len(list(filtered_accounts)) > 0:
-            acc_str = "\n" + "\n".join([(colored(f"{u} ", "blue") +
-                                         (colored("(live)", "green") if u in self.logged_in else ""))
-                                        for u in filtered_accounts]) + "\n"
+    def deliver(self, sender_name, recipient_name, msg):
+        """Queue a message until its recipient acknowledges it, pushing it right away if they are online."""
+
+        if recipient_name in self.accounts:
+            dropped = self.queue_message(recipient_name, sender_name, msg)
+            if dropped is None:
+                self.log.warning("message", "Message rejected, queue is full", recipient=recipient_name)
+                return reply_fields(QUEUE_FULL, recipient_name)
+            if self.flush_messages(recipient_name) is not None:
+                self.log.info("message", "Message sent", sender=sender_name, recipient=recipient_name)
+                return reply_fields(SENT, recipient_name)
+            self.log.info("message", "Message queued until the recipient is online", sender=sender_name,
+                          recipient=recipient_name)
+            return reply_fields(QUEUED, recipient_name, count=dropped)
 
         else:
-            acc_str = colored("\nNo matching users!\n", "red")
+            self.log.info("message", "Message denied, no such user", sender=sender_name, recipient=recipient_name)
+            return reply_fields(NO_SUCH_USER, recipient_name)
+
+
+    def export_account(self, username):
+        """Move an account off this shard: reply with an EXPORT frame (username, done, last_id, *messages).
+
+        Each call takes at most flush_bytes of the oldest pending messages; the call
+        that empties the queue deletes the account and ends its session.
+        """
+
+        if username not in self.accounts:
+            return reply_fields(NO_SUCH_USER, username)
+        messages = []
+        size = 0
+        with self.lock:
+            for msg in self.pending_messages.get(username, ()):
+                if messages and size + len(msg) > self.flush_bytes:
+                    break
+                messages.append(msg)
+                size += len(msg)
+            done = len(messages) == len(self.pending_messages.get(username, ()))
+            last_id = self.accounts[username]
+        if messages:
+            self.apply(LOG_DEQUEUE, username, len(messages))
+        if done:
+            self.apply(LOG_DELETE, username)
+            self.sessions.logout_user(username)
+            self.log.info("shard", "Account moved to another shard", user=username)
+        return encode_frame(EXPORT, username, int(done), last_id, *messages)
+
+    def import_account(self, username, last_id, messages):
+        """Take in an account exported by another shard along with its pending messages.
+
+        Messages keep their ids, and new ones continue from the account's last id.
+        """
+
+        if not re.fullmatch(r"\w{2,20}", username):
+            return reply_fields(INVALID_USERNAME, username)
+        if not isinstance(last_id, int) or not all(isinstance(msg, str) for msg in messages):
+            return reply_fields(INVALID_ARGUMENTS, username)
+        if username not in self.accounts:
+            self.apply(LOG_CREATE, username, last_id)
+            self.log.info("shard", "Account moved to this shard", user=username)
+        for msg in messages:
+            self.apply(LOG_ENQUEUE, username, msg)
+        return reply_fields(OK, username)
+
+    def queue_message(self, recipient_name, sender_name, msg):
+        """Queue a message under the overflow policy (unacknowledged messages count too).
+
+        Returns how many older messages were dropped to make room, or None if rejected.
+        """
+
+        if self.budget.policy == "spill":
+            self.enqueue(recipient_name, sender_name, msg)
+            return 0
+
+        size = len(pack_message(self.accounts.get(recipient_name, 0) + 1, sender_name, msg))
+
+        # Without spilling every queued message is in memory, so the queue is its own size.
+        queue = self.pending_messages.get(recipient_name)
+        queued = queue.memory_bytes if queue else 0
+        dropped = 0
+        if not self.budget.fits(queued, size):
+            if self.budget.policy == "reject" or not queue:
+                return None
+            freed = 0
+            with self.lock:
+                for old in queue:
+                    if self.budget.fits(queued - freed, size):
+                        break
+                    freed += len(old)
+                    dropped += 1
+            if not self.budget.fits(queued - freed, size):
+                return None
+            self.apply(LOG_DEQUEUE, recipient_name, dropped)
+        self.enqueue(recipient_name, sender_name, msg)
+        return dropped
+
+    def enqueue(self, recipient_name, sender_name, msg):
+        """Log a message under the recipient's next message id; returns the id."""
+
+        with self.lock:
+            msg_id = self.accounts.get(recipient_name, 0) + 1
+            seq = self.log_mutation(LOG_ENQUEUE, recipient_name, pack_message(msg_id, sender_name, msg))
+        self.commit(seq)
+        return msg_id
 
-        return acc_str
-    
-    def save(self):
-        """Save accounts and the message queue to csv files."""
-        port_csv = f"{self.port}.csv"
-        with open(port_csv, 'w') as f:
-            for key in self.pending_messages.keys():
-                queue = self.pending_messages[key]
-                for msg in queue:
-                    print(f"Writing pending msg: {self.pending_messages[key]}")
-                    f.write(f"{key},{msg}\n")
+    def filter_accounts(self, msg_list):
+        """Filter a page of accounts by a given regex. (f|<filter>|<page_size>|<page_token>)
+
+        Matches come in username order, in pages with the same tokens as list_accounts.
+        """
+
+        self.log.debug("request", "Filtering accounts")
 
-        port_users_csv = f"{self.port}users.csv"
-        with open(port_users_csv, 'w') as f:
-            for account in self.accounts:
-                f.write(f"{account}\n")
+        if not 2 <= len(msg_list) <= 4:
+            return reply_fields(INVALID_ARGUMENTS)
+
+        fltr = msg_list[1]
+        try:
+            page_size, last_username = page_request(*msg_list[2:4])
+        except PageTokenError as e:
+            return reply_fields(REJECTED, detail=str(e))
+
+        # Matching reads the index in place from the page's start, without the lock;
+        # an account created or deleted meanwhile may be missed or seen twice.
+        with self.lock:
+            usernames = self.account_index.usernames
+            start = self.account_index.position(last_username)
+        try:
+            filtered_accounts, position = self.filters.match(fltr, usernames, limit=page_size, start=start)
+        except FilterError as e:
+            self.log.info("filter", "Filter rejected", filter=fltr, reason=e)
+            return reply_fields(REJECTED, detail=str(e))
+
+        token = encode_token(page_size, filtered_accounts[-1]) if position is not None else ""
+        accounts = [(u, self.sessions.is_live(u)) for u in filtered_accounts]
+        return reply_fields(ACCOUNTS, page_token=token, accounts=accounts)
+    
+    def apply(self, op, *fields):
+        """Log a mutation, apply it in memory and wait until the log makes it durable."""
+
+        with self.lock:
+            seq = self.log_mutation(op, *fields)
+        self.commit(seq)
+        return seq
+
+    def log_mutation(self, op, *fields):
+        """Log a mutation and apply it in memory; the caller holds the lock and commits."""
+
+        term = self.election.term if self.election is not None else 0
+        seq = self.wal.append(op, *fields, term=term)
+        self.mutate(op, fields)
+        self.replication.publish(seq, term, op, fields)
+        return seq
+
+    def start_term(self, term):
+        """Log a no-op as the first record of a term just won.
+
+        Records left over from earlier terms commit once the quorum holds it, instead of
+        waiting for the next client write.
+        """
+
+        with self.lock:
+            if self.election.is_leader(term):
+                self.log_mutation(LOG_NOOP)
+
+    def last_seq(self):
+        """Sequence number of the newest record in the log."""
+
+        with self.lock:
+            return self.wal.next_seq - 1
+
+    def last_log(self):
+        """(term, seq) of the newest record in the log, for comparing logs in elections."""
+
+        with self.lock:
+            return self.wal.last_term(), self.wal.next_seq - 1
+
+    def apply_replicated(self, seq, term, op, fields):
+        """Apply a record shipped by the leader, keeping the leader's sequence numbers and terms.
+
+        A record we already hold from another term was never committed (a deposed leader
+        logged it); it is discarded with everything after it and replaced by the leader's.
+        """
+
+        with self.lock:
+            conflict = seq < self.wal.next_seq
+            if conflict and self.wal.term_at(seq) == term:
+                return
+            if conflict and seq <= self.snapshot_seq:
+                raise ProtocolError(f"Record {seq} from the leader conflicts with our snapshot")
+        if conflict:
+            self.discard_after(seq - 1)
+
+        with self.lock:
+            if seq != self.wal.next_seq:
+                raise ProtocolError(f"Expected record {self.wal.next_seq}, got {seq}")
+            self.wal.append(op, *fields, term=term)
+            self.mutate(op, fields)
+            self.replication.publish(seq, term, op, fields)
+
+    def match_log(self, leader_last_seq, leader_terms):
+        """The newest record our log shares with the leader's, or None if there is none after our snapshot.
+
+        `leader_terms` lists (first seq, term) wherever the leader's log changes term.
+        Logs holding a record with the same seq and term agree on every record before it,
+        so the shared prefix is found by bisection on (term, seq).
+        """
+
+        def leader_term(seq):
+            if seq == 0:
+                return 0
+            if seq > leader_last_seq or not leader_terms or seq < leader_terms[0][0]:
+                return None
+            return leader_terms[bisect.bisect_right(leader_terms, (seq, float("inf"))) - 1][1]
+
+        def shared(seq):
+            term = self.wal.term_at(seq)
+            return term is not None and term == leader_term(seq)
+
+        low, high = self.snapshot_seq, min(self.last_seq(), leader_last_seq)
+        if high < low or not shared(low):
+            return None
+        while low < high:
+            middle = (low + high + 1) // 2
+            if shared(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def discard_after(self, seq):
+        """Drop our log records newer than `seq`, which the leader's log does not share,
+        and rebuild the state from the stored snapshot and the records left."""
+
+        with self.snapshot_lock, self.lock:
+            old_wal = self.wal
+            old_wal.discard_after(seq)
+            for queue in self.pending_messages.values():
+                queue.release()
+            self.pending_messages = {}
+            self.accounts = {}
+            self.account_index = AccountIndex()
+            self.unpack()
+            self.wal.on_durable = old_wal.on_durable
+            self.wal.on_flush = old_wal.on_flush
+            self.replication.reset(seq)
+            self.caught_up = False
+        self.log.warning("replication", "Discarded records the leader does not have", after=seq)
+
+    def follow(self, connection, reader, leader_ip, leader_port, term, leader_last_seq=0, *leader_terms):
+        """Apply the log records a leader ships on this connection until it drops.
+
+        The leader's handshake describes its log by where its terms change; we keep the
+        records both logs share, discard the rest, and acknowledge the newest one kept,
+        or -1 for a snapshot when we share none after ours. Every batch or heartbeat is
+        then acknowledged with the newest record logged here, once durable, and our
+        term; a leader from an older term only gets the acknowledgement.
+        """
+
+        if self.election is None:
+            return
+        connection.settimeout(self.election.election_timeout[1] * 4)
+        install_path = f"{self.port}.snapshot.install"
+        install = None
+        try:
+            frame = None
+            while True:
+                if not self.election.observe_leader(term, leader_ip, leader_port):
+                    connection.sendall(encode_frame(ACK, self.last_seq(), self.election.term))
+                    return
+
+                if frame is None:
+                    matched = self.match_log(leader_last_seq, list(zip(leader_terms[::2], leader_terms[1::2])))
+                    if matched is not None and matched < self.last_seq():
+                        self.discard_after(matched)
+                    self.wal.wait(matched or 0)
+                    connection.sendall(encode_frame(ACK, -1 if matched is None else matched, term))
+
+                # Apply every record already buffered, then acknowledge them together.
+                acknowledge = False
+                while frame is not None:
+                    op_code, fields = frame
+                    if op_code == APPEND:
+                        self.apply_replicated(fields[0], fields[1], fields[2], fields[3:])
+                        acknowledge = True
+                    elif op_code == HEARTBEAT:
+                        # The leader has nothing newer: we are caught up.
+                        self.caught_up = True
+                        acknowledge = True
+                    elif op_code == INSTALL and fields[1]:
+                        # Snapshot chunks are only acknowledged once the whole snapshot is in.
+                        if install is None:
+                            install = open(install_path, 'wb')
+                        install.write(fields[1])
+                    elif op_code == INSTALL:
+                        if install is None:
+                            install = open(install_path, 'wb')
+                        install.close()
+                        install = None
+                        self.install_snapshot(install_path, fields[0], *fields[2:3])
+                        acknowledge = True
+                    else:
+                        raise ProtocolError(f"Unexpected frame {op_code} from leader")
+                    frame = reader.next_frame()
+                if acknowledge:
+                    last_seq = self.last_seq()
+                    self.wal.wait(last_seq)
+                    connection.sendall(encode_frame(ACK, last_seq, term))
+
+                frame = reader.read_frame()
+                if frame is None:
+                    return
+        except (OSError, ProtocolError, ValueError) as e:
+            self.log.warning("replication", "Replication interrupted", leader=f"{leader_ip}:{leader_port}", error=e)
+        finally:
+            if install is not None:
+                install.close()
+
+    def install_snapshot(self, path, seq, term=None):
+        """Replace all state with a snapshot received from the leader, as of record `seq`.
+
+        Used when the leader's log no longer reaches back to our last record, or when
+        our log shares no record with it after our own snapshot; the log starts over
+        after `seq`, whose term is `term` if the leader knows it.
+        """
+
+        # Loading can outlast the election timeout; the leader is still there meanwhile.
+        self.installing = True
+        try:
+            with open(path, 'rb+') as f:
+                os.fsync(f.fileno())
+            snapshot_seq, records = read_snapshot(path)
+            if snapshot_seq != seq:
+                raise ValueError(f"Snapshot is at record {snapshot_seq}, expected {seq}")
+
+            with self.snapshot_lock, self.lock:
+                for queue in self.pending_messages.values():
+                    queue.release()
+                self.pending_messages = {}
+                self.accounts = {}
+                self.account_index = AccountIndex()
+                for op, fields in records:
+                    self.mutate(op, fields)
+                self.storage.replace(seq, self.accounts, self.pending_messages)
+                self.storage.sync()
+                os.remove(path)
+
+                old_wal = self.wal
+                old_wal.close()
+                for _, name in old_wal.segments:
+                    os.remove(name)
+                self.wal = WriteAheadLog(f"{self.port}.wal", self.durability,
+                                         on_durable=old_wal.on_durable, start_seq=seq + 1, start_term=term)
+                self.wal.on_flush = old_wal.on_flush
+                self.snapshot_seq = seq
+                self.replication.reset(seq)
+        finally:
+            self.election.deadline = self.election.next_deadline()
+            self.installing = False
+        self.log.info("replication", "Installed the leader's snapshot", seq=seq)
+
+    def redirect(self, op_code):
+        """A REDIRECT frame naming the leader if this replica must not serve the request.
+
+        Followers answer reads themselves from their (possibly slightly stale) copy once
+        they have caught up with the leader after starting, and ignore acknowledgements,
+        which expect no answer and are repeated at the next login.
+        """
+
+        if (self.election is None or op_code in (HELP, VOTE, PING, ACKNOWLEDGE, AUTHENTICATE)
+                or self.election.is_leader() or (op_code in (LIST, FILTER) and self.caught_up)):
+            return None
+        host, port = self.election.leader or ("", 0)
+        return encode_frame(REDIRECT, host, port)
+
+    def end_sessions(self):
+        """Log every user out after losing leadership; their clients log in at the new leader."""
+
+        for username, _ in self.sessions.items():
+            self.sessions.logout_user(username)
+
+    def commit(self, seq):
+        """Hold the calling connection thread until its logged mutation is durable and
+        held by the write quorum; raises QuorumTimeout if the quorum does not answer in time.
+
+        The mutation is then neither confirmed nor undone: a new leader keeps it only if
+        a follower had logged it, so the request is answered as unavailable.
+        """
+
+        self.wal.wait(seq)
+        if not self.replication.wait_committed(seq):
+            self.log.warning("replication", "Record not acknowledged by the write quorum", seq=seq,
+                             quorum=self.write_quorum)
+            raise QuorumTimeout(seq)
+
+    def is_committed(self, seq):
+        """Whether a reply that waits on log record `seq` may be sent."""
+
+        return self.wal.is_durable(seq) and self.replication.is_committed(seq)
+
+    def is_expired(self, seq):
+        """Whether log record `seq` is durable but the write quorum did not acknowledge it in time."""
+
+        return self.wal.is_durable(seq) and self.replication.is_expired(seq)
+
+    def unavailable(self):
+        """The reply to a request whose mutation the write quorum did not acknowledge."""
+
+        return reply_fields(UNAVAILABLE, detail="Not acknowledged by enough replicas")
+
+    def mutate(self, op, fields):
+        """Apply a logged mutation to the in-memory accounts and message queues."""
+
+        if op == LOG_CREATE:
+            self.writable_accounts()[fields[0]] = fields[1] if len(fields) > 1 else 0
+            self.account_index.add(fields[0])
+        elif op == LOG_DELETE:
+            if fields[0] in self.accounts:
+                del self.writable_accounts()[fields[0]]
+                self.account_index.remove(fields[0])
+            queue = self.pending_messages.pop(fields[0], None)
+            if queue is not None:
+                queue.release()
+        elif op == LOG_ENQUEUE:
+            username, msg = fields
+            msg_id = message_id(msg)
+            if not msg_id:
+                # Queued before messages were numbered: number it as the next message.
+                msg_id = self.accounts.get(username, 0) + 1
+                msg = pack_message(msg_id, *unpack_message(msg)[1:])
+            self.writable_queue(username).append(msg)
+            if self.accounts.get(username, msg_id) < msg_id:
+                self.writable_accounts()[username] = msg_id
+        elif op == LOG_DEQUEUE:
+            queue = self.writable_queue(fields[0])
+            queue.drop(fields[1])
+            if not queue:
+                del self.pending_messages[fields[0]]
+
+    def writable_accounts(self):
+        """Return the account index, first copying it if a snapshot is still reading it."""
+
+        if id(self.accounts) in self.shared:
+            self.accounts = dict(self.accounts)
+        return self.accounts
+
+    def writable_queue(self, username):
+        """Return a user's pending queue, creating it or copying it away from a snapshot."""
+
+        queue = self.pending_messages.get(username)
+        if queue is None:
+            queue = self.pending_messages[username] = PendingQueue(username, self.budget)
+        elif id(queue) in self.shared:
+            queue = self.pending_messages[username] = queue.copy()
+        return queue
 
     def unpack(self):
-        """Unpack the accounts and message queue from csv files."""
-        port_csv = f"{self.port}.csv"
-        with open(port_csv, 'r') as f:
-            for line in f:
-                key, value = line.strip().split(',')
-                if self.pending_messages.get(key):
-                    self.pending_messages[key].append(value)
-                else:
-                    self.pending_messages[key] = [value]
-        
-        port_users_csv = f"{self.port}users.csv"
-        with open(port_users_csv, 'r') as f:
-            for line in f:
-                account = line.strip()
-                self.accounts.append(account)
+        """Load the newest snapshot from storage, then replay the log tail.
+
+        Servers that kept their snapshot in a file before storage engines existed
+        start from that file until their first snapshot is stored.
+        """
+
+        self.snapshot_seq, accounts, pending_messages = self.storage.load()
+        legacy_path = f"{self.port}.snapshot"
+        if not self.snapshot_seq and not accounts and os.path.exists(legacy_path):
+            self.snapshot_seq, records = read_snapshot(legacy_path)
+            for op, fields in records:
+                self.mutate(op, fields)
+        else:
+            for username, last_id in accounts.items():
+                self.mutate(LOG_CREATE, (username, last_id))
+            for username, queue in pending_messages.items():
+                for msg in queue:
+                    self.mutate(LOG_ENQUEUE, (username, msg))
+
+        # Append-only log of every mutation, group committed by a writer thread.
+        self.wal = WriteAheadLog(f"{self.port}.wal", self.durability,
+                                 start_seq=self.snapshot_seq + 1)
+        for seq, op, fields in self.wal.records(after=self.snapshot_seq):
+            self.mutate(op, fields)
+
+    def snapshot_loop(self):
+        """Background thread taking a snapshot whenever enough of the log is new."""
+
+        while not self.stop_event.wait(self.snapshot_interval):
+            if self.wal.next_seq - 1 - self.snapshot_seq >= self.snapshot_min_records:
+                self.snapshot()
+
+    def snapshot(self):
+        """Store a snapshot of the current state and delete the log segments it covers.
+
+        Only references are taken under the lock; containers shared with the snapshot
+        are copied by the next mutation that touches them, so requests never wait for
+        the snapshot to be written.
+        """
+
+        with self.snapshot_lock:
+            with self.lock:
+                seq = self.wal.next_seq - 1
+                accounts = self.accounts
+                pending_messages = dict(self.pending_messages)
+                self.shared = {id(accounts)} | {id(queue) for queue in pending_messages.values()}
+            started = time.perf_counter()
+            try:
+                self.storage.replace(seq, accounts, pending_messages)
+            finally:
+                with self.lock:
+                    self.shared = set()
+            self.persist_seconds.observe(time.perf_counter() - started, "snapshot")
+
+            # The log segments are the only other copy of the state until storage is on disk.
+            self.storage.sync()
+            self.snapshot_seq = seq
+            self.wal.rotate()
+            self.wal.truncate(seq)
+            return seq
+
+    def export_snapshot(self, path):
+        """Write the stored snapshot to `path` for a follower and return the record it covers.
+
+        Takes a snapshot first if none has been stored yet.
+        """
+
+        if not self.snapshot_seq:
+            self.snapshot()
+        with self.snapshot_lock:
+            seq, accounts, pending_messages = self.storage.load()
+            write_snapshot(path, seq, accounts, pending_messages)
+            return seq
 
     def wire_protocol(self, connection):
         """Main server thread that continues running until the connection is closed."""
 
-        pickleTime = time.time()
-        while True:
-            # Ensure persistence by pickling queue at a given interval
-            if time.time() > pickleTime + self.pickle_interval:
-                print("Saving accounts and messages.\n")
-                self.save()
-                pickleTime = time.time()
-            
-            # Preprocess the message by decoding it and splitting it by delimeter.
-            msg = connection.recv(4096)
-            msg_str = msg.decode('UTF-8')
-            msg_list = msg_str.split('|')
-            msg_list = [elt.strip() for elt in msg_list]
-            op_code = msg_list[0].strip()
-
-            # Create an account.
-            # Usage: c|<username>
-            if op_code == 'c':
-                msg = self.create_account(msg_list, connection)
-
-            # Log into an account.
-            # Usage: l|<username>
-            elif op_code == 'l':
-                msg = self.login(msg_list, connection)
-
-            # List all users and their status.
-            # Usage: u
-            elif op_code == 'u':
-                msg = self.list_accounts()
-
-            # Send a message to a user.
-            # Usage: s|<recipient_username>|<message>
-            elif op_code == 's':
-                if len(msg_list) != 3:
-                    msg = (colored(
-                        "\nInvalid arguments! Usage: s|<recipient_username>|<message>\n", "red"))
-                else:
-                    msg = self.send_msg(connection, msg_list[1], msg_list[2])
-
-            # Delete an account
-            # Usage: d|<confirm_username>
-            elif op_code == 'd':
-                msg = self.delete_account(msg_list, connection)
-
-            # Filter accounts using a certain wildcard.
-            # Usage: f|<filter_regex>
-            elif op_code == 'f':
-                msg = self.filter_accounts(msg_list)
-
-            # Print a list of all the commands.
-            # Usage: h
-            elif op_code == 'h':
-                msg = "\nUsage help below:\n"
-                msg += "\nCreate an account.        c|<username>"
-                msg += "\nLog into an account.      l|<username>"
-                msg += "\nSend a message.           s|<recipient_username>|<message>"
-                msg += "\nFilter accounts.          f|<filter_regex>"
-                msg += "\nDelete your account.      d|<confirm_username>"
-                msg += "\nList users and names.     u"
-                msg += "\nUsage help (this page).   h\n"
-                msg = colored(msg, 'yellow')
-
-            # Handles an invalid request and lists the correct usage for the user.
+        reader = FrameReader(connection)
+        received = 0
+        connection.settimeout(self.idle_timeout)
+        try:
+            while True:
+                # Block until a full request frame arrives (None once the client closes).
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+
+                # Answer every request that is already buffered, so pipelined requests share one send.
+                self.bytes_received.inc(amount=reader.received - received)
+                received = reader.received
+                replies = []
+                while frame is not None:
+                    op_code, fields = frame
+
+                    # A leader shipping its log takes over the connection.
+                    if op_code == REPLICATE:
+                        self.follow(connection, reader, *fields)
+                        return
+
+                    # Only the leader answers clients; other replicas point them to it.
+                    redirect = self.redirect(op_code)
+                    if redirect is not None:
+                        replies.append(redirect)
+                    else:
+                        msg_list = [op_code] + [elt.strip() if isinstance(elt, str) else elt for elt in fields]
+                        started = time.perf_counter()
+                        try:
+                            reply = self.handle_request(msg_list, connection)
+                        except QuorumTimeout:
+                            reply = self.unavailable()
+                        except Exception as e:
+                            self.log.error("request", "Request failed", op=op_code, error=e)
+                            reply = reply_fields(FAILED, detail="Request failed, please try again.")
+                        self.observe_request(op_code, started)
+                        if reply is not None:
+                            replies.append(self.reply_frame(reply))
+                    frame = reader.next_frame()
+
+                # Send encoded acknowledgments to the connected client
+                if not self.push(connection, b"".join(replies)):
+                    break
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            # EOF, errors and idle timeouts all end the connection's session here.
+            self.disconnect(connection)
+            self.send_locks.pop(connection, None)
+            self.delivery_locks.pop(connection, None)
+            connection.close()
+
+    def reply_frame(self, reply):
+        """Encode a handler's reply, answering FAILED instead if it does not fit in a frame."""
+
+        try:
+            return encode_reply(reply)
+        except ProtocolError as e:
+            self.log.error("request", "Reply could not be encoded", error=e)
+            return encode_reply(reply_fields(FAILED, detail="Reply too large, please ask for a smaller page."))
+
+    def observe_request(self, op_code, started):
+        """Count a handled request and the time since `started` (a time.perf_counter())."""
+
+        self.requests.inc(op_code)
+        self.request_seconds.observe(time.perf_counter() - started, op_code)
+
+    def queue_depths(self):
+        """Queued messages by recipient, for the chat_queue_depth gauge."""
+
+        return {(username,): len(queue) for username, queue in list(self.pending_messages.items())}
+
+    def replication_health(self, index):
+        """One figure of each follower's health() by address, while this replica leads.
+
+        Disconnected followers have no health and are left out.
+        """
+
+        if self.election is None:
+            return {}
+        figures = {}
+        for link in list(self.election.links):
+            health = link.health()
+            if health is not None:
+                figures[(f"{link.host}:{link.port}",)] = health[index]
+        return figures
+
+    def handle_request(self, msg_list, connection):
+        """Dispatch a decoded request to its handler and return its reply.
+
+        Replies are REPLY fields from reply_fields, or an already encoded frame of another
+        type; requests that get no reply return None.
+        """
+
+        op_code = msg_list[0]
+
+        # A candidate asking for this replica's vote.
+        # Usage: V|<term>|<candidate_ip>|<candidate_port>|<last_seq>|<last_term>
+        if op_code == VOTE:
+            if self.election is None:
+                return encode_frame(VOTE, 0, 0)
+            return encode_frame(VOTE, *self.election.request_vote(*msg_list[1:]))
+
+        # A client's heartbeat, answered by echoing its nonce.
+        # Usage: P|<nonce>
+        elif op_code == PING:
+            return encode_frame(PING, *msg_list[1:2])
+
+        # Create an account.
+        # Usage: c|<username>
+        elif op_code == 'c':
+            msg = self.create_account(msg_list, connection)
+
+        # Log into an account, resuming after the newest message received before.
+        # Usage: l|<username>|<last_message_id> (the id is optional)
+        elif op_code == 'l':
+            msg = self.login(msg_list, connection)
+
+        # Acknowledge every pushed message up to an id (no reply).
+        # Usage: a|<message_id>
+        elif op_code == ACKNOWLEDGE:
+            msg = self.acknowledge(msg_list, connection)
+
+        # List a page of users and their status.
+        # Usage: u|<page_size>|<page_token> (both optional)
+        elif op_code == 'u':
+            msg = self.list_accounts(msg_list)
+
+        # Send a message to a user.
+        # Usage: s|<recipient_username>|<message>
+        elif op_code == 's':
+            if len(msg_list) != 3:
+                msg = reply_fields(INVALID_ARGUMENTS)
             else:
-                msg = "\nInvalid request, use \"h\" for usage help!\n"
-                msg = colored(msg, 'red')
-
-            # Send encoded acknowledgment to the connected client
-            connection.send(msg.encode('UTF-8'))
-
-def test_two_fault():
-    """Test the two fault tolerance of servers by shutting 2 down."""
-    stop_event_server1 = multiprocessing.Event()
-    stop_event_server2 = multiprocessing.Event()
-    stop_event_server3 = multiprocessing.Event()
+                msg = self.send_msg(connection, msg_list[1], msg_list[2])
+
+        # Sharding: a router authenticating its connection with the shared secret.
+        # Usage: Y|<secret>
+        elif op_code == AUTHENTICATE:
+            msg = self.authenticate(msg_list, connection)
+
+        # Sharding requests are only taken from authenticated routers.
+        elif op_code in PEER_ONLY and connection not in self.peers:
+            msg = reply_fields(UNKNOWN_REQUEST)
+
+        # Sharding: vouch for the sender of a message to a user on another shard.
+        # Usage: F|<recipient_username>|<message>
+        elif op_code == RELAY and len(msg_list) == 3:
+            msg = self.relay_msg(connection, msg_list[1], msg_list[2])
+
+        # Sharding: a message relayed from the sender's shard.
+        # Usage: D|<sender_username>|<recipient_username>|<message>
+        elif op_code == DELIVER and len(msg_list) == 4:
+            msg = self.deliver(*msg_list[1:])
+
+        # Sharding: move an account and its pending messages to another shard.
+        # Usage: E|<username>  then  N|<username>|<last_message_id>|<message>|<message>...
+        elif op_code == EXPORT and len(msg_list) == 2:
+            msg = self.export_account(msg_list[1])
+        elif op_code == IMPORT and len(msg_list) >= 3:
+            msg = self.import_account(msg_list[1], msg_list[2], msg_list[3:])
+
+        # Delete an account
+        # Usage: d|<confirm_username>
+        elif op_code == 'd':
+            msg = self.delete_account(msg_list, connection)
+
+        # Filter accounts using a certain wildcard.
+        # Usage: f|<filter_regex>|<page_size>|<page_token> (both optional)
+        elif op_code == 'f':
+            msg = self.filter_accounts(msg_list)
+
+        # Print a list of all the commands.
+        # Usage: h
+        elif op_code == 'h':
+            msg = reply_fields(USAGE)
+
+        # Handles an invalid request; the client points the user to the usage help.
+        else:
+            msg = reply_fields(UNKNOWN_REQUEST)
 
-    # Creating the server threads. 
-    server1 = multiprocessing.Process(target=Server, args=("localhost", 5050, stop_event_server1))
-    server2 = multiprocessing.Process(target=Server, args=("localhost", 5051, stop_event_server2))
-    server3 = multiprocessing.Process(target=Server, args=("localhost", 5052, stop_event_server3))
+        return msg
 
-    # Starting servers. 
-    server1.start()
-    server2.start()
-    server3.start()
+def run_two_fault():
+    """Exercise the two fault tolerance of servers by shutting 2 down.
+
+    A leader needs a majority, so surviving two faults takes a group of five replicas.
+    The servers run in a temporary directory and are all stopped at the end.
+    """
+    ports = [5050, 5051, 5052, 5053, 5054]
+    replicas = [("localhost", port) for port in ports]
+
+    # Defining stop events for servers.
+    stop_events = [multiprocessing.Event() for _ in ports]
+
+    # Creating the server processes.
+    servers = [multiprocessing.Process(target=Server, args=("localhost", port, stop_event),
+                                       kwargs={"replicas": replicas})
+               for port, stop_event in zip(ports, stop_events)]
+
+    # Servers keep their logs and databases in the working directory.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.chdir(data_dir)
+        try:
+            # Starting servers.
+            for server in servers:
+                server.start()
+
+            time.sleep(30)  # Wait for 30 seconds
+            stop_events[0].set()  # Signal server1 to stop.
+
+            # Sleeping for 30 seconds and then shutting down the next server.
+            time.sleep(30)
+            stop_events[1].set()
+        finally:
+            for stop_event in stop_events:
+                stop_event.set()
+            for server in servers:
+                server.join(timeout=10)
+                if server.is_alive():
+                    server.terminate()
+                    server.join()
+            os.chdir(cwd)
 
-    time.sleep(30)  # Wait for 30 seconds
-    stop_event_server1.set()  # Signal server1 to stop.
+if __name__ == '__main__':
 
-    # Sleeping for 30 seconds and then shutting down the next server. 
-    time.sleep(30)
-    stop_event_server2.set()
+    # Serve metrics over HTTP when given --metrics <PORT>.
+    METRICS_PORT = None
+    if "--metrics" in sys.argv[:-1]:
+        index = sys.argv.index("--metrics")
+        METRICS_PORT = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
 
-if __name__ == '__main__':
+    # Log at the level given by --log-level <debug|info|warning|error>.
+    LOG_LEVEL = "info"
+    if "--log-level" in sys.argv[:-1]:
+        index = sys.argv.index("--log-level")
+        LOG_LEVEL = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
 
     # Validate command line arguments.
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 3 and sys.argv[1] != "test":
         HOST = sys.argv[1]
         PORT = int(sys.argv[2])
+
+        # The replica group as host:port (or port on this host), including this server.
+        REPLICAS = [parse_replica(address, HOST) for address in sys.argv[3:]]
+
         # Defining stop events for servers. 
         stop_event_server = multiprocessing.Event()
 
         # Start the server process.
-        Server(HOST, PORT, stop_event_server)
+        Server(HOST, PORT, stop_event_server, replicas=REPLICAS, metrics_port=METRICS_PORT, log_level=LOG_LEVEL)
     elif len(sys.argv) == 2 and sys.argv[1] == "test":
-        test_two_fault()
+        run_two_fault()
     else:
-        print("Usage: python3 server.py <HOST> <PORT>")
+        print("Usage: python3 server.py <HOST> <PORT> [<REPLICA> ...] [--metrics <METRICS_PORT>] "
+              "[--log-level <LEVEL>]")
         sys.exit(1)
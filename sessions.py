@@ -0,0 +1,67 @@
+import threading
+
+
+class SessionRegistry():
+    """Bidirectional index between logged in users and their connections."""
+
+    def __init__(self):
+        # Guards both indexes so they always agree.
+        self.lock = threading.Lock()
+
+        # A dictionary with usernames as keys and connection references as values.
+        self.connections = {}
+
+        # A dictionary with connection references as keys and usernames as values.
+        self.users = {}
+
+    def login(self, username, connection):
+        """Bind a user to a connection; False if either is already in a session."""
+
+        with self.lock:
+            if username in self.connections or connection in self.users:
+                return False
+            self.connections[username] = connection
+            self.users[connection] = username
+            return True
+
+    def logout_user(self, username):
+        """End a user's session and return its connection (or None)."""
+
+        with self.lock:
+            connection = self.connections.pop(username, None)
+            if connection is not None:
+                self.users.pop(connection, None)
+            return connection
+
+    def logout_connection(self, connection):
+        """End the session bound to a connection and return its user (or None)."""
+
+        with self.lock:
+            username = self.users.pop(connection, None)
+            if username is not None:
+                self.connections.pop(username, None)
+            return username
+
+    def user(self, connection):
+        """The user logged in on a connection, or None."""
+
+        return self.users.get(connection)
+
+    def connection(self, username):
+        """The connection a user is logged in on, or None."""
+
+        return self.connections.get(username)
+
+    def is_live(self, username):
+        """Whether a user currently has a session."""
+
+        return username in self.connections
+
+    def items(self):
+        """A point-in-time list of (username, connection) pairs."""
+
+        with self.lock:
+            return list(self.connections.items())
+
+    def __len__(self):
+        return len(self.connections)
@@ -0,0 +1,72 @@
+import bisect
+import hashlib
+from replication import parse_replica
+
+# Points each shard places on the ring; more points spread keys more evenly.
+VNODES = 128
+
+
+def shard_hash(key):
+    """Position of a key on the ring (stable across processes, unlike hash())."""
+
+    return int.from_bytes(hashlib.md5(key.encode('UTF-8')).digest()[:8], 'big')
+
+
+def shard_name(replicas):
+    """Name a shard by its replica group, e.g. "localhost:5050,localhost:5051"."""
+
+    return ",".join(f"{host}:{port}" for host, port in replicas)
+
+
+def parse_shard(spec, default_host):
+    """Turn "port,host:port,..." into the replica group of a shard."""
+
+    return [parse_replica(address, default_host) for address in spec.split(',') if address]
+
+
+class HashRing():
+    """Consistent-hash ring assigning usernames to shards.
+
+    Each shard owns the arcs ending at its VNODES points, so adding one of N shards
+    only moves the keys on the arcs it takes over, about 1/N of them.
+    """
+
+    def __init__(self, shards=(), vnodes=VNODES):
+        # Points per shard.
+        self.vnodes = vnodes
+
+        # Sorted ring positions, and the shard owning the arc ending at each.
+        self.points = []
+        self.owners = []
+
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard):
+        for i in range(self.vnodes):
+            point = shard_hash(f"{shard}#{i}")
+            j = bisect.bisect_left(self.points, point)
+            self.points.insert(j, point)
+            self.owners.insert(j, shard)
+
+    def remove(self, shard):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != shard]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def owner(self, key):
+        """The shard holding a username."""
+
+        if not self.points:
+            raise KeyError("No shards on the ring")
+        i = bisect.bisect_right(self.points, shard_hash(key))
+        return self.owners[i % len(self.points)]
+
+    def shards(self):
+        return sorted(set(self.owners))
+
+    def copy(self):
+        ring = HashRing(vnodes=self.vnodes)
+        ring.points = list(self.points)
+        ring.owners = list(self.owners)
+        return ring
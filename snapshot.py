@@ -0,0 +1,45 @@
+import os
+from wal import encode_record, read_records, LOG_CREATE, LOG_ENQUEUE
+
+# Marks the end of a complete snapshot; its field is the number of records before it.
+SNAPSHOT_END = 'e'
+
+
+def write_snapshot(path, seq, accounts, pending_messages):
+    """Atomically replace the snapshot at `path` with the state as of log record `seq`.
+
+    The snapshot is written as create and enqueue records, so it is read back with the
+    same decoder as the log. `accounts` maps each account name to the newest message id
+    given to it, which its create record carries.
+    """
+
+    tmp_path = path + ".tmp"
+    count = 0
+    with open(tmp_path, 'wb') as f:
+        for account, last_id in accounts.items():
+            f.write(encode_record(seq, LOG_CREATE, (account, last_id)))
+            count += 1
+        for username, queue in pending_messages.items():
+            for msg in queue:
+                f.write(encode_record(seq, LOG_ENQUEUE, (username, msg)))
+                count += 1
+        f.write(encode_record(seq, SNAPSHOT_END, (count,)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """Return (seq, records) from a complete snapshot, or (0, []) if there is none."""
+
+    if not os.path.exists(path):
+        return 0, []
+    records = []
+    with open(path, 'rb') as f:
+        for seq, _, op, fields, _ in read_records(f):
+            if op == SNAPSHOT_END:
+                if fields[0] != len(records):
+                    break
+                return seq, records
+            records.append((op, fields))
+    raise ValueError(f"Snapshot {path} is incomplete or corrupt")
@@ -0,0 +1,259 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Where accounts and queued messages are kept.
+# sqlite: tables in an SQLite database in WAL mode, kept across restarts.
+# memory: Python containers, lost when the process exits (tests and benchmarks).
+STORAGE_ENGINES = ("sqlite", "memory")
+
+# Statements on the request path. sqlite3 compiles each distinct SQL string once and
+# keeps it in the connection's statement cache, so these are prepared statements.
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS accounts ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL UNIQUE,"
+    " last_message_id INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS messages ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, body TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, id)",
+    "CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL)",
+)
+INSERT_ACCOUNT = "INSERT OR IGNORE INTO accounts (username, last_message_id) VALUES (?, ?)"
+UPDATE_MESSAGE_ID = "UPDATE accounts SET last_message_id = ? WHERE username = ?"
+DELETE_ACCOUNT = "DELETE FROM accounts WHERE username = ?"
+DELETE_MESSAGES = "DELETE FROM messages WHERE recipient = ?"
+SELECT_ACCOUNTS = "SELECT username, last_message_id FROM accounts ORDER BY id"
+INSERT_MESSAGE = "INSERT INTO messages (recipient, body) VALUES (?, ?)"
+DEQUEUE_MESSAGES = ("DELETE FROM messages WHERE id IN"
+                    " (SELECT id FROM messages WHERE recipient = ? ORDER BY id LIMIT ?)")
+SELECT_MESSAGES = "SELECT body FROM messages WHERE recipient = ? ORDER BY id"
+SELECT_ALL_MESSAGES = "SELECT recipient, body FROM messages ORDER BY id"
+SELECT_SEQ = "SELECT seq FROM checkpoint WHERE id = 0"
+UPSERT_SEQ = "INSERT INTO checkpoint (id, seq) VALUES (0, ?) ON CONFLICT (id) DO UPDATE SET seq = excluded.seq"
+
+
+def open_storage(engine, path):
+    """Open the storage engine named `engine` (see STORAGE_ENGINES); `path` is its database file."""
+
+    if engine == "sqlite":
+        return SQLiteStorage(path)
+    if engine == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage engine {engine}")
+
+
+class MemoryStorage():
+    """Accounts and queued messages in memory, with the interface of SQLiteStorage."""
+
+    def __init__(self):
+        # A dictionary with account names as keys, in creation order, and the newest
+        # message id given to each account as values.
+        self.account_names = {}
+
+        # A dictionary with username as key and a list of queued messages as values.
+        self.messages = {}
+
+        # Log record the stored state reflects, as set by replace().
+        self.seq = 0
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def sync(self):
+        pass
+
+    def create_account(self, username):
+        self.account_names[username] = 0
+
+    def set_message_id(self, username, msg_id):
+        """Record the newest message id given to an account."""
+
+        if username in self.account_names:
+            self.account_names[username] = msg_id
+
+    def delete_account(self, username):
+        """Remove an account along with its queued messages."""
+
+        self.account_names.pop(username, None)
+        self.messages.pop(username, None)
+
+    def accounts(self):
+        """Every account name, in creation order."""
+
+        return list(self.account_names)
+
+    def enqueue(self, username, msg):
+        self.messages.setdefault(username, []).append(msg)
+
+    def dequeue(self, username, count):
+        """Drop a user's `count` oldest queued messages."""
+
+        queue = self.messages.get(username)
+        if queue is not None:
+            del queue[:count]
+            if not queue:
+                del self.messages[username]
+
+    def pending(self, username):
+        """A user's queued messages, oldest first."""
+
+        return list(self.messages.get(username, ()))
+
+    def load(self):
+        """Return (seq, {account: last message id}, {username: messages}) as stored."""
+
+        return (self.seq, dict(self.account_names),
+                {username: list(queue) for username, queue in self.messages.items()})
+
+    def replace(self, seq, accounts, pending_messages):
+        """Replace everything stored with the state as of log record `seq`.
+
+        `accounts` maps each account name to the newest message id given to it.
+        """
+
+        self.account_names = dict(accounts)
+        self.messages = {username: list(queue) for username, queue in pending_messages.items() if queue}
+        self.seq = seq
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage():
+    """Accounts and queued messages in an SQLite database in WAL mode.
+
+    Each call commits on its own unless it runs inside transaction(), which commits
+    once at the end. In WAL mode with synchronous=NORMAL a commit appends to the
+    database's log without an fsync; the log is fsynced when SQLite checkpoints it,
+    so a process crash loses nothing and a power failure only the latest commits.
+    Callers about to drop another copy of the data, such as the log segments a
+    snapshot covers, call sync() first.
+    """
+
+    def __init__(self, path, synchronous="NORMAL"):
+        # The database file.
+        self.path = path
+
+        # Serialises use of the connection, which is shared across threads.
+        self.lock = threading.RLock()
+
+        # Nesting depth of transaction(); commits wait until it is back to 0.
+        self.depth = 0
+
+        # sqlite3 opens a transaction before the first write and commit() ends it.
+        self.db = sqlite3.connect(path, check_same_thread=False, cached_statements=64)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA synchronous={synchronous}")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+
+        # Databases created before messages were numbered lack the column.
+        if "last_message_id" not in [row[1] for row in self.db.execute("PRAGMA table_info(accounts)")]:
+            self.db.execute("ALTER TABLE accounts ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+
+    @property
+    def seq(self):
+        """Log record the stored state reflects, as set by replace()."""
+
+        with self.lock:
+            row = self.db.execute(SELECT_SEQ).fetchone()
+            return row[0] if row else 0
+
+    @contextmanager
+    def transaction(self):
+        """Group the calls made inside into one commit (rolled back if one fails)."""
+
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if not self.depth:
+                    self.db.rollback()
+                raise
+            self.depth -= 1
+            self.commit()
+
+    def commit(self):
+        if not self.depth:
+            self.db.commit()
+
+    def sync(self):
+        """Make every commit so far durable: a full checkpoint fsyncs the log and the database."""
+
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(FULL)").fetchall()
+
+    def create_account(self, username):
+        with self.lock:
+            self.db.execute(INSERT_ACCOUNT, (username, 0))
+            self.commit()
+
+    def set_message_id(self, username, msg_id):
+        """Record the newest message id given to an account."""
+
+        with self.lock:
+            self.db.execute(UPDATE_MESSAGE_ID, (msg_id, username))
+            self.commit()
+
+    def delete_account(self, username):
+        """Remove an account along with its queued messages."""
+
+        with self.lock:
+            self.db.execute(DELETE_ACCOUNT, (username,))
+            self.db.execute(DELETE_MESSAGES, (username,))
+            self.commit()
+
+    def accounts(self):
+        """Every account name, in creation order."""
+
+        with self.lock:
+            return [username for username, _ in self.db.execute(SELECT_ACCOUNTS)]
+
+    def enqueue(self, username, msg):
+        with self.lock:
+            self.db.execute(INSERT_MESSAGE, (username, msg))
+            self.commit()
+
+    def dequeue(self, username, count):
+        """Drop a user's `count` oldest queued messages."""
+
+        with self.lock:
+            self.db.execute(DEQUEUE_MESSAGES, (username, count))
+            self.commit()
+
+    def pending(self, username):
+        """A user's queued messages, oldest first."""
+
+        with self.lock:
+            return [body for body, in self.db.execute(SELECT_MESSAGES, (username,))]
+
+    def load(self):
+        """Return (seq, {account: last message id}, {username: messages}) as stored."""
+
+        with self.lock:
+            pending_messages = {}
+            for recipient, body in self.db.execute(SELECT_ALL_MESSAGES):
+                pending_messages.setdefault(recipient, []).append(body)
+            return self.seq, dict(self.db.execute(SELECT_ACCOUNTS).fetchall()), pending_messages
+
+    def replace(self, seq, accounts, pending_messages):
+        """Replace everything stored with the state as of log record `seq`, in one commit.
+
+        `accounts` maps each account name to the newest message id given to it.
+        """
+
+        with self.transaction():
+            self.db.execute("DELETE FROM accounts")
+            self.db.execute("DELETE FROM messages")
+            self.db.executemany(INSERT_ACCOUNT, accounts.items())
+            self.db.executemany(INSERT_MESSAGE, ((username, msg) for username, queue in pending_messages.items()
+                                                 for msg in queue))
+            self.db.execute(UPSERT_SEQ, (seq,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
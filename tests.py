@@ -11,10 +11,54 @@ import warnings
 from collections import deque
 import os
 import csv, multiprocessing
+from protocol import (FrameReader, ProtocolError, encode_frame, encode_reply, reply_fields, parse_reply, ACCOUNTS,
+                      REPLY, MESSAGE, OK, CREATED, LOGGED_IN, SENT, QUEUED, USAGE, FAILED, REJECTED,
+                      UNKNOWN_REQUEST, INVALID_USERNAME, AUTHENTICATE, DELIVER, IMPORT, REPLICATE, APPEND,
+                      HEARTBEAT, ACK, REDIRECT, UNAVAILABLE, MAX_FRAME_SIZE, CREATE)
+from event_server import EventServer
+from wal import WriteAheadLog
+from snapshot import read_snapshot, write_snapshot
+from sessions import SessionRegistry
+from offline_queue import PendingQueue, QueueBudget, pack_message, unpack_message, message_id
+from filters import RegexFilter, FilterError, count_repeats
+from paging import AccountIndex, PageTokenError, page_request
+from replication import ReplicationLog, parse_replica
+from election import Election, FOLLOWER
+from heartbeat import PhiAccrual, FailureDetector
+from sharding import HashRing, shard_name
+from router import Router
+from storage import MemoryStorage, SQLiteStorage
+from rendering import render_reply, render_batch
+from benchmark import summarize, parse_mix, compare, load_grpc, GRPC_DIR
+from metrics import MetricsRegistry, MetricsServer
+from logger import Logger, DEBUG, INFO, WARNING
+import io
+import urllib.request
+import types
+import tempfile
+import shutil
+import asyncio
+import importlib.util
 
 DIR = 'test_logs'
 
 
+def load_chatapp_server():
+    """grpcApp's server module, or None when grpcio is not installed."""
+
+    try:
+        load_grpc()
+    except ImportError:
+        return None
+    spec = importlib.util.spec_from_file_location("chatapp_server", os.path.join(GRPC_DIR, "server.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+chatapp_server = load_chatapp_server()
+
+
 class PersistentTest(unittest.TestCase):
 
     # Convert a csv file to a list of its lines
@@ -127,7 +171,1198 @@ class PersistentTest(unittest.TestCase):
                 account = line.strip()
                 self.accounts.append(account)
 
-        
+
+
+class ProtocolTest(unittest.TestCase):
+
+    # Test that typed fields survive an encode/decode round trip.
+    def test_round_trip(self):
+        reader = FrameReader()
+        reader.feed(encode_frame('s', "varun", "hello | there", 42, b"\x00\x01"))
+        self.assertEqual(reader.next_frame(), ('s', ["varun", "hello | there", 42, b"\x00\x01"]))
+        self.assertIsNone(reader.next_frame())
+
+    # Test that pipelined frames split at arbitrary points are reassembled in order.
+    def test_split_and_merged_frames(self):
+        data = b"".join(encode_frame('s', "jim", f"msg {i}") for i in range(100))
+        data += encode_frame('u')
+        reader = FrameReader()
+        frames = []
+        for i in range(0, len(data), 7):
+            reader.feed(data[i:i + 7])
+            frame = reader.next_frame()
+            while frame is not None:
+                frames.append(frame)
+                frame = reader.next_frame()
+        self.assertEqual(len(frames), 101)
+        self.assertEqual(frames[42], ('s', ["jim", "msg 42"]))
+        self.assertEqual(frames[-1], ('u', []))
+
+    # Test that messages larger than a single recv buffer arrive whole.
+    def test_large_frame(self):
+        reader = FrameReader()
+        reader.feed(encode_frame('m', "x" * 100000))
+        self.assertEqual(len(reader.next_frame()[1][0]), 100000)
+
+    # Test that garbage headers are rejected instead of buffered forever.
+    def test_invalid_length(self):
+        reader = FrameReader()
+        reader.feed(b"\xff\xff\xff\xffc")
+        with self.assertRaises(ProtocolError):
+            reader.next_frame()
+
+    # Test that a typed reply keeps its status, page token and listed accounts on the wire.
+    def test_typed_reply(self):
+        reader = FrameReader()
+        reader.feed(encode_reply(reply_fields(ACCOUNTS, page_token="abc", accounts=[("jim", True), ("varun", False)])))
+        reply = parse_reply(reader.next_frame()[1])
+        self.assertEqual(reply.status, ACCOUNTS)
+        self.assertEqual(reply.page_token, "abc")
+        self.assertEqual([(a.username, a.live) for a in reply.accounts], [("jim", True), ("varun", False)])
+
+
+class WriteAheadLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "test.wal")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # Test that records are replayed in order with their sequence numbers after reopening.
+    def test_replay(self):
+        wal = WriteAheadLog(self.path)
+        wal.wait(wal.append('c', "jim"))
+        wal.append('q', "jim", "hello, there")
+        wal.close()
+
+        wal = WriteAheadLog(self.path)
+        self.assertEqual(list(wal.records()), [(1, 'c', ["jim"]), (2, 'q', ["jim", "hello, there"])])
+        self.assertEqual(wal.append('x', "jim", 1), 3)
+        wal.close()
+
+    # Test that a torn record at the end of the log is dropped on startup.
+    def test_torn_tail(self):
+        wal = WriteAheadLog(self.path)
+        wal.append('c', "jim")
+        wal.append('c', "varun")
+        wal.close()
+        segment = wal.segments[-1][1]
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 3)
+
+        wal = WriteAheadLog(self.path)
+        self.assertEqual(list(wal.records()), [(1, 'c', ["jim"])])
+        self.assertEqual(wal.append('c', "varun"), 2)
+        wal.close()
+
+    # Test that appends from many threads share group commits.
+    def test_group_commit(self):
+        commits = []
+        wal = WriteAheadLog(self.path, commit_window=0.01, on_durable=commits.append)
+
+        def writer(name):
+            for i in range(20):
+                wal.wait(wal.append('q', name, str(i)))
+
+        threads = [threading.Thread(target=writer, args=(f"user{i}",)) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wal.close()
+
+        wal = WriteAheadLog(self.path, durability="none")
+        self.assertEqual(len(list(wal.records())), 200)
+        self.assertLess(len(commits), 200)
+        wal.close()
+
+    # Test that truncation removes only segments fully covered by a snapshot.
+    def test_truncate_segments(self):
+        wal = WriteAheadLog(self.path, segment_size=100)
+        for i in range(40):
+            wal.wait(wal.append('c', f"user{i}"))
+        segments = len(wal.segments)
+        self.assertGreater(segments, 2)
+
+        removed = wal.truncate(20)
+        self.assertGreater(removed, 0)
+        self.assertLessEqual(wal.segments[0][0], 21)
+        self.assertEqual([seq for seq, _, _ in wal.records(after=20)], list(range(21, 41)))
+        wal.close()
+
+    # Test that each record keeps the term it was logged in across restarts.
+    def test_terms(self):
+        wal = WriteAheadLog(self.path)
+        wal.append('c', "jim")
+        wal.append('c', "varun", term=2)
+        wal.wait(wal.append('q', "jim", "hi", term=2))
+        wal.append('d', "jim", term=5)
+        wal.close()
+
+        wal = WriteAheadLog(self.path)
+        self.assertEqual([wal.term_at(seq) for seq in range(6)], [0, 0, 2, 2, 5, None])
+        self.assertEqual(wal.last_term(), 5)
+        self.assertEqual(list(wal.records(after=3)), [(4, 'd', ["jim"])])
+        wal.close()
+
+    # Test that discarding a suffix keeps older records, and that a log starting after a snapshot knows its term.
+    def test_discard_after(self):
+        wal = WriteAheadLog(self.path, segment_size=100)
+        for i in range(20):
+            wal.wait(wal.append('c', f"user{i}", term=1 + i // 10))
+        wal.discard_after(12)
+        wal = WriteAheadLog(self.path)
+        self.assertEqual([seq for seq, _, _ in wal.records()], list(range(1, 13)))
+        self.assertEqual((wal.term_at(12), wal.next_seq), (2, 13))
+        wal.discard_after(0)
+
+        wal = WriteAheadLog(self.path, start_seq=51, start_term=4)
+        wal.close()
+        wal = WriteAheadLog(self.path, start_seq=51)
+        self.assertEqual((wal.term_at(49), wal.term_at(50), wal.last_term()), (None, 4, 4))
+        wal.close()
+
+    # Test that a snapshot round trips accounts and queued messages.
+    def test_snapshot(self):
+        path = os.path.join(self.dir.name, "test.snapshot")
+        self.assertEqual(read_snapshot(path), (0, []))
+
+        write_snapshot(path, 7, {"jim": 2, "varun": 0}, {"jim": ["hello", "goodbye"], "varun": []})
+        seq, records = read_snapshot(path)
+        self.assertEqual(seq, 7)
+        self.assertEqual(records, [('c', ["jim", 2]), ('c', ["varun", 0]),
+                                   ('q', ["jim", "hello"]), ('q', ["jim", "goodbye"])])
+
+
+class SessionRegistryTest(unittest.TestCase):
+
+    # Test that both indexes are kept in step through logins and logouts.
+    def test_bidirectional(self):
+        sessions = SessionRegistry()
+        jim, varun = object(), object()
+        self.assertTrue(sessions.login("jim", jim))
+        self.assertTrue(sessions.login("varun", varun))
+        self.assertEqual(sessions.user(jim), "jim")
+        self.assertIs(sessions.connection("varun"), varun)
+
+        self.assertEqual(sessions.logout_connection(jim), "jim")
+        self.assertFalse(sessions.is_live("jim"))
+        self.assertIs(sessions.logout_user("varun"), varun)
+        self.assertIsNone(sessions.user(varun))
+        self.assertEqual(len(sessions), 0)
+
+    # Test that a user and a connection can each hold only one session.
+    def test_duplicate_login(self):
+        sessions = SessionRegistry()
+        conn = object()
+        self.assertTrue(sessions.login("jim", conn))
+        self.assertFalse(sessions.login("jim", object()))
+        self.assertFalse(sessions.login("varun", conn))
+
+
+class PendingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.budget = QueueBudget(self.dir.name, queue_limit=100, memory_limit=1000)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # Test that a queue over its budget spills to disk and still reads back in order.
+    def test_spill_order(self):
+        queue = PendingQueue("jim", self.budget)
+        messages = [f"message {i}" for i in range(300)]
+        for msg in messages:
+            queue.append(msg)
+
+        self.assertGreater(queue.spilled, 0)
+        self.assertLessEqual(queue.memory_bytes, 100)
+        self.assertEqual(self.budget.memory_bytes, queue.memory_bytes)
+        self.assertEqual(list(queue), messages)
+
+        queue.drop(250)
+        self.assertEqual(list(queue), messages[250:])
+        queue.drop(50)
+        self.assertFalse(queue)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    # Test that a copy taken for a snapshot is unaffected by draining the live queue.
+    def test_copy_shares_spill(self):
+        frozen = PendingQueue("jim", self.budget)
+        messages = [f"message {i}" for i in range(100)]
+        for msg in messages:
+            frozen.append(msg)
+
+        live = frozen.copy()
+        live.drop(100)
+        live.append("new")
+        self.assertEqual(list(frozen), messages)
+        self.assertEqual(list(live), ["new"])
+
+    # Test that queued messages keep their id and sender, and older entries without them still unpack.
+    def test_pack_message(self):
+        entry = pack_message(12, "jim", "see you at 10:30")
+        self.assertEqual(unpack_message(entry), (12, "jim", "see you at 10:30"))
+        self.assertEqual(message_id(entry), 12)
+        self.assertEqual(unpack_message("jim:hi"), (0, "jim", "hi"))
+        legacy = colored("[jim] ", "grey") + "hi"
+        self.assertEqual(unpack_message(legacy), (0, "", legacy))
+        self.assertEqual(message_id(legacy), 0)
+
+    # Test that the messages after an id are found whether they are in memory or spilled.
+    def test_newer_than(self):
+        queue = PendingQueue("jim", self.budget)
+        messages = [pack_message(i, "varun", f"message {i}") for i in range(1, 101)]
+        for msg in messages:
+            queue.append(msg)
+
+        self.assertGreater(queue.spilled, 0)
+        self.assertEqual(queue.newer_than(98), messages[98:])
+        self.assertEqual(queue.newer_than(5), messages[5:])
+        self.assertEqual(queue.newer_than(100), [])
+
+    # Test that spilled messages are found through the spill index and read back in byte-capped batches.
+    def test_newer_than_batches(self):
+        queue = PendingQueue("jim", self.budget)
+        messages = [pack_message(i, "varun", f"message {i}") for i in range(1, 201)]
+        for msg in messages:
+            queue.append(msg)
+        queue.drop(30)
+
+        self.assertGreater(len(queue.spill_index), 1)
+        self.assertGreater(queue.seek(150)[0], queue.spill_start)
+        self.assertEqual(queue.newer_than(150), messages[150:])
+
+        batches = []
+        last_id = 0
+        while True:
+            batch = queue.newer_than(last_id, 100)
+            if not batch:
+                break
+            self.assertLess(sum(map(len, batch[:-1])), 100)
+            batches.append(batch)
+            last_id = message_id(batch[-1])
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(batches, []), messages[30:])
+        self.assertEqual(queue.newer_than(0, 1), messages[30:31])
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "test.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # Test that both engines keep accounts in creation order and queues in FIFO order.
+    def test_engines(self):
+        for storage in (MemoryStorage(), SQLiteStorage(self.path)):
+            storage.create_account("varun")
+            storage.create_account("jim")
+            with storage.transaction():
+                for msg in ("one", "two", "three"):
+                    storage.enqueue("jim", msg)
+            storage.dequeue("jim", 1)
+            self.assertEqual(storage.accounts(), ["varun", "jim"])
+            self.assertEqual(storage.pending("jim"), ["two", "three"])
+
+            storage.set_message_id("varun", 4)
+            storage.delete_account("jim")
+            self.assertEqual(storage.load(), (0, {"varun": 4}, {}))
+            storage.replace(7, {"varun": 4, "bob": 1}, {"bob": ["1:varun:hi"]})
+            self.assertEqual(storage.load(), (7, {"varun": 4, "bob": 1}, {"bob": ["1:varun:hi"]}))
+            storage.close()
+
+    # Test that the SQLite engine keeps its contents across a restart.
+    def test_reopen(self):
+        storage = SQLiteStorage(self.path)
+        storage.create_account("jim")
+        storage.enqueue("jim", "1:varun:hello")
+        storage.set_message_id("jim", 1)
+        storage.close()
+
+        storage = SQLiteStorage(self.path)
+        self.assertEqual(storage.load(), (0, {"jim": 1}, {"jim": ["1:varun:hello"]}))
+        storage.close()
+
+    # Test that after sync() the database file alone holds the latest snapshot, without SQLite's log.
+    def test_sync(self):
+        storage = SQLiteStorage(self.path)
+        storage.replace(3, {"jim": 1}, {"jim": ["1:varun:hello"]})
+        storage.sync()
+        copy = os.path.join(self.dir.name, "copy.db")
+        shutil.copyfile(self.path, copy)
+        storage.close()
+
+        storage = SQLiteStorage(copy)
+        self.assertEqual(storage.load(), (3, {"jim": 1}, {"jim": ["1:varun:hello"]}))
+        storage.close()
+
+
+class RegexFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filters = RegexFilter(timeout=0.5)
+        self.accounts = [f"user{i}" for i in range(20)] + ["aaaaaaaaaaaaaaaaaaaaaaaaaaaaab"]
+
+    def tearDown(self):
+        self.filters.close()
+
+    # Test that simple patterns match inline and can be resumed after a limit.
+    def test_limit_and_resume(self):
+        matches, position = self.filters.match("user1.*", self.accounts, limit=5)
+        self.assertEqual(matches, ["user1", "user10", "user11", "user12", "user13"])
+        matches, position = self.filters.match("user1.*", self.accounts, start=position)
+        self.assertEqual(matches, ["user14", "user15", "user16", "user17", "user18", "user19"])
+        self.assertIsNone(position)
+
+    # Test that invalid patterns are rejected with a FilterError.
+    def test_invalid(self):
+        with self.assertRaises(FilterError):
+            self.filters.match("user(", self.accounts)
+
+    # Test that a catastrophic pattern times out and is then rejected without running.
+    def test_catastrophic(self):
+        self.assertEqual(self.filters.match("(user)1", self.accounts)[0], ["user1"])
+        with self.assertRaises(FilterError):
+            self.filters.match("(a+)+$", self.accounts)
+        start = time.monotonic()
+        with self.assertRaises(FilterError):
+            self.filters.match("(a+)+$", self.accounts)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    # Test that patterns with several quantifiers run in the sandbox even without groups.
+    def test_polynomial(self):
+        self.assertEqual([count_repeats(p) for p in ["user1", "user.*", r"a\*[*+]b", "[]*]x+?", "a{2}b*"]],
+                         [0, 1, 0, 2, 2])
+        self.assertFalse(self.filters.needs_sandbox("user.*"))
+        start = time.monotonic()
+        with self.assertRaises(FilterError):
+            self.filters.match("a*" * 12 + "b", ["a" * 20])
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class AccountIndexTest(unittest.TestCase):
+
+    # Test that following continuation tokens visits every account once, in order.
+    def test_pages(self):
+        index = AccountIndex(f"user{i:03d}" for i in range(250))
+        index.remove("user100")
+        index.add("user100")
+        seen = []
+        page_size, last_username = page_request(100)
+        while True:
+            usernames, token = index.page(page_size, last_username)
+            seen.extend(usernames)
+            if token is None:
+                break
+            page_size, last_username = page_request(None, token)
+        self.assertEqual(seen, [f"user{i:03d}" for i in range(250)])
+
+    # Test that a deleted cursor account does not break resuming after it.
+    def test_resume_after_delete(self):
+        index = AccountIndex(["aa", "bb", "cc", "dd"])
+        usernames, token = index.page(2)
+        index.remove("bb")
+        self.assertEqual(index.page(*page_request(None, token)), (["cc", "dd"], None))
+        self.assertEqual(index.position("bb"), 1)
+        self.assertEqual(index.position("dd"), 3)
+
+    # Test that malformed tokens and page sizes are rejected.
+    def test_invalid(self):
+        for args in [(None, "!!"), ("0",), ("lots",), (5000,)]:
+            with self.assertRaises(PageTokenError):
+                page_request(*args)
+
+
+class ReplicationLogTest(unittest.TestCase):
+
+    def decode(self, frames):
+        reader = FrameReader()
+        reader.feed(b"".join(frames))
+        seqs = []
+        frame = reader.next_frame()
+        while frame is not None:
+            seqs.append(frame[1][0])
+            frame = reader.next_frame()
+        return seqs
+
+    # Test that records newer than a backup's position are shipped in order.
+    def test_after(self):
+        log = ReplicationLog(0)
+        for seq in range(1, 11):
+            log.publish(seq, 1, 'c', (f"user{seq}",))
+        self.assertEqual(self.decode(log.after(3, timeout=0)), list(range(4, 11)))
+        self.assertEqual(log.after(10, timeout=0), [])
+        self.assertEqual(len(log.after(0, timeout=0, limit=1)), 1)
+
+    # Test that a position older than the in-memory window must be read from disk.
+    def test_window(self):
+        log = ReplicationLog(0, capacity=5)
+        for seq in range(1, 11):
+            log.publish(seq, 1, 'x', ("jim", 1))
+        self.assertIsNone(log.after(4, timeout=0))
+        self.assertEqual(self.decode(log.after(5, timeout=0)), list(range(6, 11)))
+
+    # Test that a log reset by an installed snapshot continues after the snapshot's record.
+    def test_reset(self):
+        log = ReplicationLog(0)
+        for seq in range(1, 6):
+            log.publish(seq, 1, 'c', (f"user{seq}",))
+        log.reset(100)
+        self.assertEqual(log.after(100, timeout=0), [])
+        self.assertIsNone(log.after(50, timeout=0))
+        log.publish(101, 1, 'c', ("jim",))
+        self.assertEqual(self.decode(log.after(100, timeout=0)), [101])
+
+    # Test that a record commits once the write quorum, counting the leader, has acknowledged it.
+    def test_quorum(self):
+        log = ReplicationLog(0, quorum=3, commit_timeout=0.05)
+        for seq in range(1, 6):
+            log.publish(seq, 1, 'c', (f"user{seq}",))
+        log.ack(("localhost", 5051), 5)
+        self.assertFalse(log.wait_committed(3))
+        log.ack(("localhost", 5052), 3)
+        self.assertEqual(log.committed_seq, 3)
+        self.assertTrue(log.wait_committed(3))
+        self.assertFalse(log.wait_committed(4))
+
+        # A write whose quorum timed out is not committed, and is no longer waited for.
+        self.assertFalse(log.is_committed(5))
+        self.assertTrue(log.is_expired(5))
+        self.assertFalse(log.is_expired(3))
+
+    # Test that a new leader's uncommitted tail from an earlier term only commits with a record of its own term.
+    def test_new_term(self):
+        log = ReplicationLog(0, quorum=2, commit_timeout=0.05)
+        for seq in range(1, 6):
+            log.publish(seq, 1, 'c', (f"user{seq}",))
+        log.ack(("localhost", 5051), 3)
+        self.assertEqual(log.committed_seq, 3)
+
+        log.reset_acks()
+        self.assertEqual(log.committed_seq, 3)
+        log.ack(("localhost", 5052), 5)
+        self.assertFalse(log.is_committed(4))
+
+        log.publish(6, 2, 'n', ())
+        log.ack(("localhost", 5052), 6)
+        self.assertEqual(log.committed_seq, 6)
+
+    # Test that replica addresses default to the server's host.
+    def test_parse_replica(self):
+        self.assertEqual(parse_replica("5051", "localhost"), ("localhost", 5051))
+        self.assertEqual(parse_replica("10.0.0.2:5052", "localhost"), ("10.0.0.2", 5052))
+
+
+class ElectionTest(unittest.TestCase):
+
+    def setUp(self):
+        # A stand-in server; the stop event keeps the election thread from running.
+        stop_event = threading.Event()
+        stop_event.set()
+        self.server = types.SimpleNamespace(ip="localhost", port=5099, stop_event=stop_event,
+                                            replicas=[("localhost", 5097), ("localhost", 5098),
+                                                      ("localhost", 5099)],
+                                            last_log=lambda: (2, 10), end_sessions=lambda: None,
+                                            installing=False, log=Logger("warning", stream=io.StringIO()))
+        self.election = Election(self.server)
+
+    def tearDown(self):
+        self.server.log.close()
+        os.remove("5099.term")
+
+    # Test that one vote is granted per term, only to candidates with a complete log.
+    def test_votes(self):
+        self.assertEqual(self.election.request_vote(1, "localhost", 5097, 9, 2), (1, 0))
+        self.assertEqual(self.election.request_vote(1, "localhost", 5098, 10, 2), (1, 1))
+        self.assertEqual(self.election.request_vote(1, "localhost", 5097, 12, 2), (1, 0))
+        self.assertEqual(self.election.request_vote(2, "localhost", 5097, 12, 2), (2, 1))
+        self.assertEqual(Election(self.server).load(), (2, "localhost:5097"))
+
+    # Test that a longer log from an older term loses to a shorter one from a newer term.
+    def test_votes_compare_terms(self):
+        self.assertEqual(self.election.request_vote(3, "localhost", 5097, 12, 1), (3, 0))
+        self.assertEqual(self.election.request_vote(4, "localhost", 5097, 8, 3), (4, 1))
+
+    # Test that followers ignore candidates while the leader is heard from, and stale leaders.
+    def test_leader_contact(self):
+        self.assertTrue(self.election.observe_leader(3, "localhost", 5097))
+        self.assertEqual(self.election.request_vote(4, "localhost", 5098, 10, 2), (3, 0))
+        self.assertFalse(self.election.observe_leader(2, "localhost", 5098))
+        self.assertEqual((self.election.role, self.election.leader), (FOLLOWER, ("localhost", 5097)))
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
+
+
+class FailureDetectorTest(unittest.TestCase):
+
+    # Test that suspicion stays low while heartbeats are regular and grows with silence.
+    def test_phi(self):
+        history = PhiAccrual(0.1)
+        for i in range(20):
+            history.heartbeat(i * 0.1)
+        self.assertLess(history.phi(1.95), 1)
+        self.assertGreater(history.phi(2.5), 8)
+        self.assertGreater(history.phi(3), history.phi(2.5))
+
+    # Test that a replica answering pings is trusted and one that stops answering is suspected.
+    def test_suspected(self):
+        listener = socket.create_server(("localhost", 0))
+        port = listener.getsockname()[1]
+        stop_event = threading.Event()
+
+        def echo():
+            connection, _ = listener.accept()
+            reader = FrameReader(connection)
+            frame = reader.read_frame()
+            while frame is not None and not stop_event.is_set():
+                connection.sendall(encode_frame('r', *frame[1]))
+                frame = reader.read_frame()
+            connection.close()
+
+        threading.Thread(target=echo, daemon=True).start()
+        detector = FailureDetector(threading.Event(), interval=0.02, timeout=0.5)
+        detector.watch("localhost", port)
+        time.sleep(0.3)
+        self.assertFalse(detector.suspected("localhost", port))
+        stop_event.set()
+        listener.close()
+        time.sleep(0.5)
+        self.assertTrue(detector.suspected("localhost", port))
+        detector.stop_event.set()
+
+
+class HashRingTest(unittest.TestCase):
+
+    # Test that usernames spread roughly evenly over the shards.
+    def test_balance(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.owner(f"user{i}") for i in range(3000)]
+        for shard in "abc":
+            self.assertGreater(owners.count(shard), 700)
+
+    # Test that adding a fourth shard only moves keys to it, about a quarter of them.
+    def test_add_moves_few_keys(self):
+        ring = HashRing(["a", "b", "c"])
+        before = {f"user{i}": ring.owner(f"user{i}") for i in range(3000)}
+        grown = ring.copy()
+        grown.add("d")
+        moved = [key for key, owner in before.items() if grown.owner(key) != owner]
+        self.assertTrue(all(grown.owner(key) == "d" for key in moved))
+        self.assertLess(abs(len(moved) / 3000 - 0.25), 0.08)
+        self.assertEqual(ring.owner("user1"), before["user1"])
+
+
+class MetricsTest(unittest.TestCase):
+
+    # Test that counters, gauges and cumulative histogram buckets render in the Prometheus text format.
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests.", ["op"])
+        latency = registry.histogram("request_seconds", "Latency.", buckets=(0.1, 1))
+        registry.gauge("depth", "Depth.", ["user"], function=lambda: {("jim",): 3})
+        requests.inc("s")
+        requests.inc("s", amount=2)
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+        text = registry.render()
+        self.assertIn("# TYPE requests_total counter\nrequests_total{op=\"s\"} 3", text)
+        self.assertIn('request_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('request_seconds_bucket{le="1"} 2', text)
+        self.assertIn('request_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("request_seconds_count 3", text)
+        self.assertIn("request_seconds_sum 5.55", text)
+        self.assertIn('depth{user="jim"} 3', text)
+
+    # Test that the endpoint serves the registry over HTTP.
+    def test_scrape(self):
+        registry = MetricsRegistry()
+        registry.counter("requests_total", "Requests.").inc()
+        server = MetricsServer(registry, 0)
+        try:
+            with urllib.request.urlopen(f"http://localhost:{server.port}/metrics") as response:
+                self.assertIn("requests_total 1", response.read().decode())
+        finally:
+            server.close()
+
+
+class LoggerTest(unittest.TestCase):
+
+    # Test that the writer thread writes records at or above the level, with their fields.
+    def test_levels(self):
+        stream = io.StringIO()
+        log = Logger("info", stream=stream, color=False)
+        log.debug("request", "Listing accounts")
+        log.info("session", "Logged in", user="jim")
+        log.warning("message", "Queue full", recipient="bob")
+        log.close()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("INFO    session     Logged in user=jim"))
+        self.assertIn("WARNING", lines[1])
+
+    # Test that sampling and rate limits drop records, but never warnings, and skips are reported.
+    def test_sampling_and_rate_limits(self):
+        stream = io.StringIO()
+        log = Logger(DEBUG, sampling={"request": 0}, rate_limits={"message": 5}, stream=stream, color=False)
+        for _ in range(20):
+            log.debug("request", "Listing accounts")
+            log.info("message", "Message sent")
+        log.warning("message", "Queue full")
+        log.close()
+        output = stream.getvalue()
+        self.assertNotIn("Listing accounts", output)
+        self.assertEqual(output.count("Message sent"), 5)
+        self.assertIn("Queue full", output)
+        self.assertIn("Records skipped dropped=0 rate_limited=15", output)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    # Test that percentiles use the nearest rank and report milliseconds.
+    def test_summarize(self):
+        summary = summarize([i * 1000000 for i in range(1, 1001)], errors=2)
+        self.assertEqual(summary["count"], 1000)
+        self.assertEqual(summary["errors"], 2)
+        self.assertEqual(summary["p50_ms"], 500)
+        self.assertEqual(summary["p99_ms"], 990)
+        self.assertEqual(summary["p999_ms"], 999)
+        self.assertEqual(summary["max_ms"], 1000)
+        self.assertIsNone(summarize([])["p99_ms"])
+        self.assertEqual(parse_mix("s=3, u=1"), {"s": 3.0, "u": 1.0})
+        self.assertRaises(ValueError, parse_mix, "x=1")
+
+    # Test that only changes beyond the tolerance, in the wrong direction, are regressions.
+    def test_compare(self):
+        def result(rate, p99):
+            return {"frontend": "socket", "scenario": "mix", "requests_per_sec": rate,
+                    "messages_per_sec": rate, "delivered_per_sec": rate, "latency": {"p99_ms": p99}}
+        baseline = {"results": [result(1000, 10)]}
+        self.assertEqual(compare([result(950, 10.5)], baseline, 0.1), [])
+        self.assertEqual(compare([result(2000, 5)], baseline, 0.1), [])
+        regressions = compare([result(800, 12)], baseline, 0.1)
+        self.assertEqual([r[2] for r in regressions],
+                         ["requests_per_sec", "messages_per_sec", "delivered_per_sec", "latency.p99_ms"])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class LiveServer():
+    """A Server (or EventServer) running on a thread, for tests that send it real frames.
+
+    Run it from a temporary directory: its log, storage and spill files go to the
+    current one.
+    """
+
+    def __init__(self, server_class, port=None, **kwargs):
+        self.port = port or free_port()
+        self.stop_event = threading.Event()
+        started = threading.Event()
+        servers = []
+
+        # Catch the instance as it starts serving; the constructor only returns once stopped.
+        class Started(server_class):
+            def serve(self, server):
+                servers.append(self)
+                started.set()
+                super().serve(server)
+
+        kwargs.setdefault("storage", "memory")
+        kwargs.setdefault("log_level", "warning")
+        self.thread = threading.Thread(target=Started, args=("localhost", self.port, self.stop_event),
+                                       kwargs=kwargs, daemon=True)
+        self.thread.start()
+        started.wait(10)
+        self.server = servers[0]
+
+    def connect(self):
+        return FrameClient(self.port)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(10)
+
+
+class FrameClient():
+    """A bare connection speaking the framed protocol, keeping pushed messages aside."""
+
+    def __init__(self, port):
+        self.connection = socket.create_connection(("localhost", port), timeout=5)
+        self.reader = FrameReader(self.connection)
+
+        # Fields of every MESSAGE frame received, in order.
+        self.messages = []
+
+    def send(self, op_code, *fields):
+        self.connection.sendall(encode_frame(op_code, *fields))
+
+    def reply(self):
+        """The next reply, collecting the messages pushed before it."""
+
+        while True:
+            frame = self.reader.read_frame()
+            if frame is None:
+                return None
+            if frame[0] == MESSAGE:
+                self.messages.append(frame[1])
+            elif frame[0] == REPLY:
+                return parse_reply(frame[1])
+            else:
+                return frame
+
+    def request(self, op_code, *fields):
+        self.send(op_code, *fields)
+        return self.reply()
+
+    def close(self):
+        self.connection.close()
+
+
+class LiveServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.servers = []
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for live in self.servers:
+            live.stop()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def start(self, server_class, **kwargs):
+        live = LiveServer(server_class, **kwargs)
+        self.servers.append(live)
+        return live
+
+    def connect(self, live):
+        client = live.connect()
+        self.clients.append(client)
+        return client
+
+
+class EventServerTest(LiveServerTest):
+
+    # Test that both engines answer pipelined requests in order and push messages to logged-in users.
+    def test_pipelined_requests(self):
+        for server_class in (Server, EventServer):
+            live = self.start(server_class, durability="none")
+            alice, bob = self.connect(live), self.connect(live)
+            alice.connection.sendall(b"".join(encode_frame(*request) for request in
+                                              [('c', "alice"), ('c', "bob"), ('l', "alice"), ('s', "bob", "hi"), ('h',)]))
+            self.assertEqual([alice.reply().status for _ in range(5)], [CREATED, CREATED, LOGGED_IN, QUEUED, USAGE])
+            self.assertEqual(bob.request('l', "bob").count, 1)
+            self.assertEqual(bob.messages, [[1, "alice", "hi"]])
+            self.assertEqual(alice.request('s', "bob", "again").status, SENT)
+            bob.send('a', 2)
+            self.assertEqual(bob.request('h').status, USAGE)
+            self.assertEqual(bob.messages[-1], [2, "alice", "again"])
+
+    # Test that a write's reply waits for its group commit while the loop keeps serving other clients.
+    def test_replies_wait_for_commit(self):
+        live = self.start(EventServer)
+        live.server.wal.commit_window = 0.5
+        writer, reader = self.connect(live), self.connect(live)
+        started = time.monotonic()
+        writer.send('c', "alice")
+        self.assertEqual(reader.request('h').status, USAGE)
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(writer.reply().status, CREATED)
+        self.assertGreater(time.monotonic() - started, 0.4)
+
+    # Test that the loop outlives clients that vanish mid-frame, send garbage or hit a failing handler.
+    def test_survives_bad_clients(self):
+        live = self.start(EventServer, durability="none")
+        vanishing = live.connect()
+        vanishing.connection.sendall(encode_frame('c', "alice")[:7])
+        vanishing.close()
+        garbage = self.connect(live)
+        garbage.connection.sendall(b"\xff" * 16)
+        self.assertIsNone(garbage.reply())
+        live.server.list_accounts = lambda msg_list: 1 / 0
+        client = self.connect(live)
+        self.assertEqual(client.request('u').status, FAILED)
+        self.assertEqual(client.request('c', "alice").status, CREATED)
+        self.assertEqual(self.connect(live).request('h').status, USAGE)
+
+    # Test that fields of the wrong type are answered as failed, and the connection keeps working.
+    def test_bad_field_types(self):
+        for server_class in (Server, EventServer):
+            live = self.start(server_class, durability="none")
+            client = self.connect(live)
+            self.assertEqual(client.request('c', 5).status, FAILED)
+            self.assertEqual(client.request('u', 10, 7).status, FAILED)
+            self.assertEqual(client.request('c', "alice").status, CREATED)
+
+    # Test that a spilled backlog arrives in order, in writes capped at flush_bytes, and leaves no spill file.
+    def test_backlog_delivery(self):
+        for server_class in (Server, EventServer):
+            live = self.start(server_class, durability="none")
+            live.server.budget.queue_limit = 1000
+            live.server.flush_bytes = 500
+            writes = []
+            push = live.server.push
+
+            def recording_push(connection, data):
+                writes.append(len(data))
+                return push(connection, data)
+
+            live.server.push = recording_push
+            sender, recipient = self.connect(live), self.connect(live)
+            self.assertEqual(sender.request('c', "alice").status, CREATED)
+            self.assertEqual(sender.request('c', "bob").status, CREATED)
+            self.assertEqual(sender.request('l', "alice").status, LOGGED_IN)
+            sender.connection.sendall(b"".join(encode_frame('s', "bob", f"message {i:03d}") for i in range(100)))
+            self.assertEqual([sender.reply().status for _ in range(100)], [QUEUED] * 100)
+            self.assertGreater(live.server.pending_messages["bob"].spilled, 0)
+
+            writes.clear()
+            self.assertEqual(recipient.request('l', "bob").count, 100)
+            self.assertEqual([msg[0] for msg in recipient.messages], list(range(1, 101)))
+            self.assertEqual(recipient.messages[-1], [100, "alice", "message 099"])
+            self.assertGreaterEqual(len(writes), 4)
+            self.assertLessEqual(max(writes), live.server.flush_bytes)
+
+            recipient.send('a', 100)
+            self.assertEqual(recipient.request('h').status, USAGE)
+            self.assertFalse(live.server.pending_messages.get("bob"))
+            self.assertEqual(os.listdir(f"{live.port}spill"), [])
+
+    # Test that a user goes offline when its connection closes or idles out, without probing sockets.
+    def test_presence(self):
+        for server_class in (Server, EventServer):
+            live = self.start(server_class, durability="none", idle_timeout=0.5)
+            alice, bob, observer = self.connect(live), self.connect(live), self.connect(live)
+            self.assertEqual(observer.request('c', "alice").status, CREATED)
+            self.assertEqual(observer.request('c', "bob").status, CREATED)
+            self.assertEqual(alice.request('l', "alice").status, LOGGED_IN)
+            self.assertEqual(bob.request('l', "bob").status, LOGGED_IN)
+
+            def presence():
+                return {account.username: account.live for account in observer.request('u').accounts}
+
+            self.assertEqual(presence(), {"alice": True, "bob": True})
+            alice.close()
+            deadline = time.monotonic() + 5
+            while presence()["alice"] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(presence(), {"alice": False, "bob": True})
+
+            # The observer keeps its connection busy while bob's sits idle.
+            while presence()["bob"] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(presence(), {"alice": False, "bob": False})
+            self.assertIsNone(bob.reply())
+
+    # Test that filter matches come back in pages that resume from their token, and oversized replies fail cleanly.
+    def test_filter_pages(self):
+        for server_class in (Server, EventServer):
+            live = self.start(server_class, durability="none")
+            client = self.connect(live)
+            for name in ("dave", "user3", "user1", "user2", "bob"):
+                client.send('c', name)
+            self.assertEqual([client.reply().status for _ in range(5)], [CREATED] * 5)
+
+            first = client.request('f', "user.*", 2)
+            self.assertEqual([account.username for account in first.accounts], ["user1", "user2"])
+            last = client.request('f', "user.*", "", first.page_token)
+            self.assertEqual([account.username for account in last.accounts], ["user3"])
+            self.assertEqual(last.page_token, "")
+            self.assertEqual(client.request('f', "user.*", "", "not a token").status, REJECTED)
+
+            reader = FrameReader()
+            reader.feed(live.server.reply_frame(reply_fields(ACCOUNTS, detail="x" * MAX_FRAME_SIZE)))
+            self.assertEqual(parse_reply(reader.next_frame()[1]).status, FAILED)
+
+
+class PeerAuthenticationTest(LiveServerTest):
+
+    # Test that shards take sharding requests only from connections holding the peer secret.
+    def test_peer_only_requests(self):
+        live = self.start(EventServer, durability="none", peer_secret="s3cret")
+        client = self.connect(live)
+        self.assertEqual(client.request('c', "bob").status, CREATED)
+        self.assertEqual(client.request(DELIVER, "alice", "bob", "forged").status, UNKNOWN_REQUEST)
+        self.assertEqual(client.request(AUTHENTICATE, "guess").status, REJECTED)
+        self.assertEqual(client.request(IMPORT, "carol", 0).status, UNKNOWN_REQUEST)
+        self.assertEqual(client.request(AUTHENTICATE, "s3cret").status, OK)
+        self.assertEqual(client.request(IMPORT, "no:pe", 0).status, INVALID_USERNAME)
+        self.assertEqual(client.request(DELIVER, "alice", "bob", "relayed").status, QUEUED)
+        self.assertNotIn("no:pe", live.server.accounts)
+
+    # Test that the router relays messages across shards but refuses sharding requests from clients.
+    def test_router(self):
+        shards = []
+        for _ in range(2):
+            live = self.start(Server, durability="none", peer_secret="s3cret")
+            shards.append([("localhost", live.port)])
+        ring = HashRing([shard_name(replicas) for replicas in shards])
+        names = {}
+        for i in range(100):
+            names.setdefault(ring.owner(f"user{i}"), f"user{i}")
+        sender, recipient = names.values()
+
+        port = free_port()
+        stop_event = threading.Event()
+        router = threading.Thread(target=Router, args=("localhost", port, stop_event, shards),
+                                  kwargs={"peer_secret": "s3cret", "log_level": "warning"}, daemon=True)
+        router.start()
+        self.addCleanup(router.join, 10)
+        self.addCleanup(stop_event.set)
+        for _ in range(100):
+            try:
+                client = FrameClient(port)
+                break
+            except OSError:
+                time.sleep(0.05)
+        self.clients.append(client)
+
+        self.assertEqual(client.request('c', recipient).status, CREATED)
+        self.assertEqual(client.request('c', sender).status, CREATED)
+        self.assertEqual(client.request('l', sender).status, LOGGED_IN)
+        self.assertEqual(client.request(DELIVER, sender, recipient, "forged").status, UNKNOWN_REQUEST)
+        self.assertEqual(client.request(AUTHENTICATE, "s3cret").status, UNKNOWN_REQUEST)
+        self.assertEqual(client.request('s', recipient, "hi").status, QUEUED)
+
+        # Filter pages merge across the shards in username order.
+        first = client.request('f', r"user\d+", 1)
+        last = client.request('f', r"user\d+", "", first.page_token)
+        self.assertEqual([account.username for account in first.accounts + last.accounts], sorted(names.values()))
+        self.assertEqual(last.page_token, "")
+
+
+class ReplicaGroupTest(LiveServerTest):
+
+    def lead(self, live, term, log):
+        """Connect to a follower as the leader of `term` whose log is [(seq, term, username)]."""
+
+        leader = self.connect(live)
+        starts = [(seq, record_term) for i, (seq, record_term, _) in enumerate(log)
+                  if not i or log[i - 1][1] != record_term]
+        leader.send(REPLICATE, "localhost", 1, term, len(log), *[value for start in starts for value in start])
+        return leader
+
+    # Test that a follower drops records a deposed leader never committed and takes the new leader's.
+    def test_divergent_log(self):
+        port = free_port()
+        live = self.start(Server, port=port, durability="none", replicas=[("localhost", port), ("localhost", 1)])
+        old = [(1, 100, "alice"), (2, 100, "bob"), (3, 100, "carol")]
+        leader = self.lead(live, 100, [])
+        self.assertEqual(leader.reader.read_frame(), (ACK, [0, 100]))
+        leader.connection.sendall(b"".join(encode_frame(APPEND, seq, term, 'c', name) for seq, term, name in old))
+        self.assertEqual(leader.reader.read_frame(), (ACK, [3, 100]))
+        leader.close()
+
+        new = old[:2] + [(3, 200, "dave"), (4, 200, "erin")]
+        leader = self.lead(live, 200, new)
+        self.assertEqual(leader.reader.read_frame(), (ACK, [2, 200]))
+        self.assertEqual(list(live.server.accounts), ["alice", "bob"])
+        leader.connection.sendall(b"".join(encode_frame(APPEND, seq, term, 'c', name) for seq, term, name in new[2:]))
+        self.assertEqual(leader.reader.read_frame(), (ACK, [4, 200]))
+        self.assertEqual(list(live.server.accounts), ["alice", "bob", "dave", "erin"])
+        self.assertEqual(live.server.last_log(), (200, 4))
+
+    # Test that a leader whose followers never acknowledge answers writes as unavailable, not as done.
+    def test_quorum_timeout(self):
+        for server_class in (Server, EventServer):
+            port = free_port()
+            live = self.start(server_class, port=port, durability="none",
+                              replicas=[("localhost", port), ("localhost", free_port()), ("localhost", free_port())])
+            live.server.replication.commit_timeout = 0.2
+
+            # Win the election with a stand-in follower's vote, then leave it silent.
+            election = live.server.election
+            for _ in range(200):
+                if election.is_leader():
+                    break
+                with election.lock:
+                    election.majority = 1
+                time.sleep(0.01)
+            election.has_lease = lambda now: True
+            client = self.connect(live)
+            reply = client.request('c', "alice")
+            self.assertEqual(reply.status, UNAVAILABLE)
+            self.assertEqual(render_reply(CREATE, reply).count("try again"), 1)
+            self.assertEqual(client.request('h').status, USAGE)
+
+            # The silent followers are left out of the replication gauges.
+            self.assertNotIn("chat_replication_lag_records{", live.server.metrics.render())
+
+    # Test that a follower points reads to the leader until it has caught up after starting.
+    def test_reads_wait_until_caught_up(self):
+        port = free_port()
+        live = self.start(Server, port=port, durability="none", replicas=[("localhost", port), ("localhost", 1)])
+        leader = self.lead(live, 100, [(1, 100, "alice")])
+        self.assertEqual(leader.reader.read_frame(), (ACK, [0, 100]))
+        client = self.connect(live)
+        self.assertEqual(client.request('u')[0], REDIRECT)
+        leader.connection.sendall(encode_frame(APPEND, 1, 100, 'c', "alice") + encode_frame(HEARTBEAT, 100))
+        self.assertEqual(leader.reader.read_frame(), (ACK, [1, 100]))
+        self.assertEqual(client.request('u').accounts, [("alice", False)])
+
+
+@unittest.skipUnless(chatapp_server, "grpcio is not installed")
+class MailboxTest(unittest.TestCase):
+
+    # Test that a listener sleeps until a newer message arrives, and stops waiting when cancelled.
+    def test_wait_for_messages(self):
+        Message = load_grpc()[1].Message
+
+        async def run():
+            mailbox = chatapp_server.Mailbox()
+            listener = asyncio.create_task(mailbox.newer_than(0))
+            await asyncio.sleep(0.05)
+            self.assertFalse(listener.done())
+            mailbox.put(Message(senderName="varun", message="hi", id=1))
+            self.assertEqual([msg.id for msg in await asyncio.wait_for(listener, 1)], [1])
+
+            mailbox.put(Message(id=2))
+            mailbox.put(Message(id=3))
+            self.assertEqual([msg.id for msg in await mailbox.newer_than(1)], [2, 3])
+            self.assertEqual(mailbox.acknowledge(2), 2)
+            self.assertEqual([msg.id for msg in mailbox.queue], [3])
+
+            listener = asyncio.create_task(mailbox.newer_than(3))
+            await asyncio.sleep(0.05)
+            listener.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await listener
+
+        asyncio.run(run())
+
+
+@unittest.skipUnless(chatapp_server, "grpcio is not installed")
+class ChatAppTest(unittest.TestCase):
+
+    def serve(self, body):
+        """Run the coroutine `body(chat, stub, app)` against a ChatApp served on grpc.aio."""
+
+        grpc, app, rpc = load_grpc()
+
+        async def run():
+            chat = chatapp_server.ChatApp(storage="memory", log_level="warning")
+            server = grpc.aio.server()
+            rpc.add_ChatAppServicer_to_server(chat, server)
+            port = server.add_insecure_port("localhost:0")
+            await server.start()
+            try:
+                async with grpc.aio.insecure_channel(f"localhost:{port}") as channel:
+                    await body(chat, rpc.ChatAppStub(channel), app)
+            finally:
+                await server.stop(0)
+                chat.storage_executor.shutdown()
+                chat.log.close()
+
+        asyncio.run(run())
+
+    # Test that more open listener streams than the old thread pool had workers still leave unary calls served.
+    def test_listeners_share_loop(self):
+        async def body(chat, stub, app):
+            names = [f"user{i}" for i in range(40)]
+            for name in names:
+                self.assertEqual((await stub.createAccount(app.Account(username=name))).status, app.CREATED)
+                self.assertEqual((await stub.logIn(app.Account(username=name))).status, app.LOGGED_IN)
+            streams = [stub.listenForMessages(app.ListenRequest(username=name)) for name in names]
+
+            started = time.monotonic()
+            reply = await stub.sendMessage(app.Message(senderName="user1", recipientName="user0", message="hi"))
+            self.assertEqual(reply.status, app.SENT)
+            msg = await asyncio.wait_for(streams[0].read(), 5)
+            self.assertEqual((msg.id, msg.senderName, msg.message), (1, "user1", "hi"))
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual((await stub.acknowledge(app.Acknowledgement(username="user0", message_id=1))).count, 1)
+
+            # Closing a stream logs its user out.
+            for stream in streams:
+                stream.cancel()
+            for _ in range(100):
+                if not chat.live_users:
+                    break
+                await asyncio.sleep(0.02)
+            self.assertEqual(chat.live_users, set())
+            self.assertEqual(chat.storage.pending("user0"), [])
+
+        self.serve(body)
+
+    # Test that batched and client-streamed sends report a status per message and store every message.
+    def test_send_batches(self):
+        async def body(chat, stub, app):
+            for name in ("alice", "bob"):
+                self.assertEqual((await stub.createAccount(app.Account(username=name))).status, app.CREATED)
+            recipients = ["bob", "nobody", "bob"]
+            batch = app.MessageBatch(messages=[app.Message(senderName="alice", recipientName=recipient,
+                                                           message=f"batch {i}")
+                                               for i, recipient in enumerate(recipients)])
+            reply = await stub.sendMessageBatch(batch)
+            self.assertEqual([status.status for status in reply.statuses], [app.QUEUED, app.NO_SUCH_USER, app.QUEUED])
+            self.assertEqual([status.recipient for status in reply.statuses], recipients)
+            self.assertEqual(reply.sent, 2)
+            self.assertIn("2 of 3 message(s) sent", render_batch(reply))
+            self.assertIn("No such user: nobody.", render_batch(reply))
+
+            # A stream longer than a storage batch is committed a batch at a time.
+            chat.stream_batch = 3
+            reply = await stub.sendMessages(iter([app.Message(senderName="alice", recipientName="bob",
+                                                              message=f"stream {i}") for i in range(7)]))
+            self.assertEqual([status.status for status in reply.statuses], [app.QUEUED] * 7)
+            self.assertEqual(reply.sent, 7)
+            self.assertEqual([msg.id for msg in chat.mailbox("bob").queue], list(range(1, 10)))
+            self.assertEqual(chat.storage.pending("bob")[-1], pack_message(9, "alice", "stream 6"))
+
+        self.serve(body)
+
+    # Test that a reopened listener stream keeps its user online without a new login, and only the newest stream ends the session.
+    def test_resumed_listener(self):
+        async def body(chat, stub, app):
+            for name in ("alice", "bob"):
+                self.assertEqual((await stub.createAccount(app.Account(username=name))).status, app.CREATED)
+            self.assertEqual((await stub.logIn(app.Account(username="alice"))).status, app.LOGGED_IN)
+
+            async def wait_offline(username):
+                for _ in range(100):
+                    if username not in chat.live_users:
+                        return
+                    await asyncio.sleep(0.02)
+                self.fail(f"{username} is still online")
+
+            first = stub.listenForMessages(app.ListenRequest(username="alice"))
+            await stub.sendMessage(app.Message(senderName="bob", recipientName="alice", message="one"))
+            self.assertEqual((await first.read()).id, 1)
+            first.cancel()
+            await wait_offline("alice")
+
+            # The client reopens its stream after the newest message it showed.
+            second = stub.listenForMessages(app.ListenRequest(username="alice", resume_after=1))
+            reply = await stub.sendMessage(app.Message(senderName="bob", recipientName="alice", message="two"))
+            self.assertEqual(reply.status, app.SENT)
+            self.assertEqual((await second.read()).id, 2)
+            self.assertEqual((await stub.logIn(app.Account(username="alice"))).status, app.USER_ONLINE)
+
+            # A stream replaced by a newer one leaves the session to it.
+            third = stub.listenForMessages(app.ListenRequest(username="alice", resume_after=2))
+            await stub.sendMessage(app.Message(senderName="bob", recipientName="alice", message="three"))
+            self.assertEqual((await third.read()).id, 3)
+            second.cancel()
+            await asyncio.sleep(0.1)
+            self.assertIn("alice", chat.live_users)
+            third.cancel()
+            await wait_offline("alice")
+
+        self.serve(body)
@@ -0,0 +1,356 @@
+import bisect
+import os
+import struct
+import threading
+import time
+import zlib
+from protocol import ProtocolError, decode_fields, encode_field
+
+# Record header: body length, CRC32 of the body and the record's sequence number.
+RECORD = struct.Struct("!IIQ")
+
+# Mutations recorded in the log.
+LOG_CREATE = 'c'
+LOG_DELETE = 'd'
+LOG_ENQUEUE = 'q'
+LOG_DEQUEUE = 'x'
+
+# Logged by a new leader to open its term; changes nothing.
+LOG_NOOP = 'n'
+
+# sync: append() callers wait for the fsync covering their record.
+# async: the writer fsyncs each commit window, callers never wait.
+# none: records are written to the OS but never fsynced.
+DURABILITY_MODES = ("sync", "async", "none")
+
+
+def encode_record(seq, op, fields, term=0):
+    """Encode one log record as header + typed fields.
+
+    The leader's term at the time, if any, comes first as an int field; records from
+    before terms were logged (and snapshots) start with the op and count as term 0.
+    """
+
+    body = (encode_field(term) if term else b"") + encode_field(op) + b"".join(encode_field(field) for field in fields)
+    return RECORD.pack(len(body), zlib.crc32(body), seq) + body
+
+
+def read_records(f):
+    """Yield (seq, term, op, fields, end_offset) for each intact record in an open log file."""
+
+    offset = f.tell()
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        length, crc, seq = RECORD.unpack(header)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        try:
+            fields = decode_fields(body)
+            term = fields.pop(0) if fields and isinstance(fields[0], int) else 0
+            op, *fields = fields
+        except (ProtocolError, ValueError, UnicodeDecodeError):
+            return
+        offset += RECORD.size + length
+        yield seq, term, op, fields, offset
+
+
+class WriteAheadLog():
+    """Append-only log of state mutations, fsynced in groups by a writer thread.
+
+    The log is split into segment files named <path>.<first seq>, so segments that a
+    snapshot already covers can be deleted with truncate(). Every record carries the
+    term of the leader that logged it, so replicas can compare their logs.
+    """
+
+    def __init__(self, path, durability="sync", commit_window=0.001, on_durable=None,
+                 segment_size=4 * 1024 * 1024, start_seq=1, start_term=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {durability}")
+
+        # Prefix of the segment files.
+        self.path = path
+
+        # One of DURABILITY_MODES.
+        self.durability = durability
+
+        # Seconds the writer waits after the first record to gather a larger group.
+        self.commit_window = commit_window
+
+        # Called with the newest durable sequence number after every group commit.
+        self.on_durable = on_durable
+
+        # Called with the seconds each group commit spent writing and fsyncing.
+        self.on_flush = None
+
+        # Bytes after which the writer starts a new segment.
+        self.segment_size = segment_size
+
+        # Guards the fields below and signals the writer and waiting callers.
+        self.cond = threading.Condition()
+
+        # Encoded records accepted but not yet written.
+        self.pending = []
+
+        # Whether the next group should start a new segment.
+        self.rotate_requested = False
+
+        # Whether close() has been called.
+        self.closed = False
+
+        # A log written before segmentation becomes the first segment.
+        if os.path.isfile(self.path):
+            os.rename(self.path, self.segment_name(1))
+
+        # Segment files as (first_seq, filename), oldest first.
+        self.segments = self.find_segments()
+
+        # Sequence number of the newest record written (and fsynced, unless durability is none).
+        self.durable_seq = start_seq - 1
+
+        # Drop a torn record left by a crash and continue numbering after the last intact one.
+        while self.segments:
+            last = None
+            end = 0
+            with open(self.segments[-1][1], 'rb+') as f:
+                for last, _, _, _, end in read_records(f):
+                    pass
+                f.truncate(end)
+            if last is not None:
+                self.durable_seq = max(self.durable_seq, last)
+                break
+            os.remove(self.segments.pop()[1])
+        self.next_seq = self.durable_seq + 1
+
+        # Where the term of the record before the log is kept, when a snapshot replaced it.
+        self.base_path = f"{self.path}.base"
+        if start_term is not None:
+            self.save_base(start_seq - 1, start_term)
+
+        # (first seq, term) wherever the term changes along the log, oldest first.
+        self.terms = self.scan_terms()
+
+        # The segment being appended to (opened by the writer when there is none).
+        self.file = open(self.segments[-1][1], 'ab') if self.segments else None
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def segment_name(self, first_seq):
+        """File name of the segment whose first record is `first_seq`."""
+
+        return f"{self.path}.{first_seq}"
+
+    def find_segments(self):
+        """List existing segment files, oldest first."""
+
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        segments = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                segments.append((int(name[len(prefix):]), os.path.join(directory, name)))
+        return sorted(segments)
+
+    def records(self, after=0):
+        """Yield (seq, op, fields) for every written record newer than `after`."""
+
+        for seq, _, op, fields in self.scan(after):
+            yield seq, op, fields
+
+    def scan(self, after=0):
+        """Yield (seq, term, op, fields) for every written record newer than `after`."""
+
+        with self.cond:
+            segments = list(self.segments)
+        for i, (_, name) in enumerate(segments):
+            # Skip whole segments that end before the requested position.
+            if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+                continue
+            try:
+                with open(name, 'rb') as f:
+                    for seq, term, op, fields, _ in read_records(f):
+                        if seq > after:
+                            yield seq, term, op, fields
+            except FileNotFoundError:
+                continue
+
+    def scan_terms(self):
+        """Where the term changes in the records on disk, after the base record if one is saved."""
+
+        terms = []
+        try:
+            with open(self.base_path, 'r') as f:
+                seq, term = (int(value) for value in f.read().split(','))
+            if seq < self.next_seq:
+                terms.append((seq, term))
+        except (FileNotFoundError, ValueError):
+            pass
+        for seq, term, _, _ in self.scan(after=terms[0][0] if terms else 0):
+            if not terms or terms[-1][1] != term:
+                terms.append((seq, term))
+        return terms
+
+    def save_base(self, seq, term):
+        """Persist the term of record `seq`, which the log starts after."""
+
+        tmp_path = self.base_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(f"{seq},{term}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.base_path)
+
+    def term_at(self, seq):
+        """The term of record `seq` (0 before the first record), or None if it is not known."""
+
+        if seq == 0:
+            return 0
+        with self.cond:
+            if seq >= self.next_seq or not self.terms or seq < self.terms[0][0]:
+                return None
+            return self.terms[bisect.bisect_right(self.terms, (seq, float("inf"))) - 1][1]
+
+    def last_term(self):
+        """The term of the newest record (0 when there is none)."""
+
+        with self.cond:
+            return self.terms[-1][1] if self.terms else 0
+
+    def term_starts(self):
+        """(first seq, term) wherever the term changes, from the oldest record whose term is known."""
+
+        with self.cond:
+            return list(self.terms)
+
+    def rotate(self):
+        """Start a new segment with the next group, so the current one can be truncated later."""
+
+        with self.cond:
+            self.rotate_requested = True
+
+    def truncate(self, upto_seq):
+        """Delete closed segments whose records are all below `upto_seq`.
+
+        Record `upto_seq` itself is kept, so its term stays known after a snapshot.
+        """
+
+        removable = []
+        with self.cond:
+            while len(self.segments) > 1 and self.segments[1][0] <= upto_seq:
+                removable.append(self.segments.pop(0)[1])
+            while self.segments and len(self.terms) > 1 and self.terms[1][0] <= self.segments[0][0]:
+                self.terms.pop(0)
+        for name in removable:
+            os.remove(name)
+        return len(removable)
+
+    def append(self, op, *fields, term=0):
+        """Queue a record logged in `term` for the next group commit and return its sequence number."""
+
+        with self.cond:
+            if self.closed:
+                raise ValueError("Write-ahead log is closed")
+            seq = self.next_seq
+            self.next_seq += 1
+            if not self.terms or self.terms[-1][1] != term:
+                self.terms.append((seq, term))
+            self.pending.append(encode_record(seq, op, fields, term))
+            self.cond.notify_all()
+        return seq
+
+    def is_durable(self, seq):
+        """Check whether a caller may acknowledge the record with this sequence number."""
+
+        return self.durability != "sync" or self.durable_seq >= seq
+
+    def wait(self, seq):
+        """Block until the record is durable (returns at once unless durability is sync)."""
+
+        with self.cond:
+            while not self.is_durable(seq) and not self.closed:
+                self.cond.wait()
+
+    def write_loop(self):
+        """Writer thread: one write and one fsync per group of pending records."""
+
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending and self.closed:
+                    return
+                deadline = time.monotonic() + self.commit_window
+                while not self.closed and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                batch, self.pending = self.pending, []
+                last_seq = self.next_seq - 1
+                rotate, self.rotate_requested = self.rotate_requested, False
+
+            started = time.perf_counter()
+            if self.file is None or rotate or self.file.tell() >= self.segment_size:
+                self.open_segment(last_seq - len(batch) + 1)
+            self.file.write(b"".join(batch))
+            self.file.flush()
+            if self.durability != "none":
+                os.fsync(self.file.fileno())
+            if self.on_flush:
+                self.on_flush(time.perf_counter() - started)
+
+            with self.cond:
+                self.durable_seq = last_seq
+                self.cond.notify_all()
+            if self.on_durable:
+                self.on_durable(last_seq)
+
+    def open_segment(self, first_seq):
+        """Close the current segment and continue in a new one starting at `first_seq`."""
+
+        if self.file is not None:
+            self.file.close()
+        name = self.segment_name(first_seq)
+        self.file = open(name, 'ab')
+        with self.cond:
+            self.segments.append((first_seq, name))
+
+        # Make the new directory entry durable before records depend on it.
+        if self.durability != "none" and hasattr(os, "O_DIRECTORY"):
+            fd = os.open(os.path.dirname(os.path.abspath(name)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def discard_after(self, seq):
+        """Close the log and delete every record newer than `seq` from disk.
+
+        Used by a follower whose newest records were never committed by the leader;
+        a new log is opened to continue after `seq`.
+        """
+
+        self.close()
+        for first_seq, name in reversed(self.segments):
+            if first_seq > seq:
+                os.remove(name)
+                continue
+            with open(name, 'rb+') as f:
+                end = 0
+                for record_seq, _, _, _, offset in read_records(f):
+                    if record_seq > seq:
+                        break
+                    end = offset
+                f.truncate(end)
+                os.fsync(f.fileno())
+            break
+
+    def close(self):
+        """Commit everything still pending and close the log file."""
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        if self.file is not None:
+            self.file.close()